@@ -112,8 +112,9 @@ setup(name="tfatool",
       version=tfatool._version.__version__,
       scripts=["flashair-util", "flashair-config"],
       licence="MIT",
-      packages=["tfatool"],
+      packages=["tfatool", "tfatool.aio"],
       install_requires=install_requires,
+      extras_require={"numpy": ["numpy"], "xxhash": ["xxhash"]},
       description=description,
       long_description=long_description,
       classifiers=classifiers,
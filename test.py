@@ -1,12 +1,22 @@
+import io
 import os
+import asyncio
+import json
+import threading
+import time
+import zlib
+import pytest
 import arrow
+import requests
 import tqdm
 
 from urllib import parse
 from tfatool.info import Config, WifiMode, DriveMode
 from tfatool.info import Upload, WriteProtectMode
 from tfatool.config import config
-from tfatool import command, upload, util, sync
+from tfatool import command, upload, util, sync, info, cgi
+from tfatool import filters, fattime, inotify, poll, emulator, trace, aio
+from tfatool import checksum, journal, supervisor
 
 
 def test_config_construction():
@@ -74,10 +84,10 @@ def test_datetime_encode_decode():
     dtime = dtime.to("local")
 
     # encode to FAT32 time
-    encoded = upload._encode_time(ctime)
+    encoded = fattime.encode(ctime)
 
     # decode to arrow datetime
-    decoded = command._decode_time(encoded >> 16, encoded & 0xFFFF)
+    decoded = fattime.decode(*fattime.split(encoded))
 
     # accurate down to the second
     for attr in "year month day hour minute".split():
@@ -191,3 +201,1324 @@ def test_pbar_safe_update():
     sync._update_pbar(pbar, -1)  # no crash
     sync._update_pbar(pbar, 0)  # no crash
 
+
+
+def test_parallel_download_isolates_errors(monkeypatch, tmpdir):
+    files = [info.RawFileInfo("/DCIM", "F{}".format(n), "/DCIM/F{}".format(n),
+                              n * 10) for n in range(6)]
+    tmpdir.join("F0").write_binary(b"")  # F0 already exists locally
+
+    def fake_download(local_dir, f, url, replace, digest=None,
+                      fsync_policy=None):
+        if f.filename == "F3":
+            raise IOError("connection dropped")
+
+    monkeypatch.setattr(sync, "_download_remote_file", fake_download)
+    report = sync.down_by_files(files, local_dir=str(tmpdir), workers=3)
+    assert {f.filename for f in report.synced} == {"F1", "F2", "F4", "F5"}
+    assert [f.filename for f in report.skipped] == ["F0"]
+    assert [f.filename for f, _ in report.failed] == ["F3"]
+    assert report.nbytes == 10 + 20 + 40 + 50
+
+
+class _FakeResponse:
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size):
+        for n in range(0, len(self.content), chunk_size):
+            yield self.content[n:n + chunk_size]
+
+
+def test_resume_partial_download(tmpdir):
+    local_name = str(tmpdir.join("IMG_0001.JPG"))
+    data = b"0123456789" * 10
+    fileinfo = info.FileInfo("/DCIM", "IMG_0001.JPG", "/DCIM/IMG_0001.JPG",
+                             len(data), None, arrow.get(2016, 1, 2, 3, 4, 6))
+    part_name = local_name + sync.PART_SUFFIX
+    assert sync._resume_offset(part_name, fileinfo) == 0
+    with open(part_name, "wb") as part:
+        part.write(data[:40])
+    assert sync._resume_offset(part_name, fileinfo) == 40
+
+    response = _FakeResponse(206, data[40:], {"Content-Range": "bytes 40-99/100"})
+    sync._write_file_safely(local_name, fileinfo, response, 40)
+    with open(local_name, "rb") as local:
+        assert local.read() == data
+    assert sorted(os.listdir(str(tmpdir))) == ["IMG_0001.JPG"]
+
+
+def test_resume_falls_back_to_full_download(tmpdir):
+    local_name = str(tmpdir.join("IMG_0001.JPG"))
+    data = b"abcdefghij" * 10
+    fileinfo = info.FileInfo("/DCIM", "IMG_0001.JPG", "/DCIM/IMG_0001.JPG",
+                             len(data), None, arrow.get(2016, 1, 2, 3, 4, 6))
+    part_name = local_name + sync.PART_SUFFIX
+    sync._resume_offset(part_name, fileinfo)
+    with open(part_name, "wb") as part:
+        part.write(b"garbage")
+    response = _FakeResponse(200, data)  # Range header ignored
+    sync._write_file_safely(local_name, fileinfo, response, 7)
+    with open(local_name, "rb") as local:
+        assert local.read() == data
+
+
+def test_stale_partial_download_discarded(tmpdir):
+    local_name = str(tmpdir.join("IMG_0001.JPG"))
+    fileinfo = info.FileInfo("/DCIM", "IMG_0001.JPG", "/DCIM/IMG_0001.JPG",
+                             100, None, arrow.get(2016, 1, 2, 3, 4, 6))
+    part_name = local_name + sync.PART_SUFFIX
+    sync._resume_offset(part_name, fileinfo)
+    with open(part_name, "wb") as part:
+        part.write(b"x" * 50)
+    newer = fileinfo._replace(datetime=arrow.get(2016, 1, 2, 3, 4, 8))
+    assert sync._resume_offset(part_name, newer) == 0
+    assert not os.path.exists(part_name)
+
+
+def test_readinto_download_reuses_buffer_and_connection(tmpdir):
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    data = bytes(range(256)) * 1000
+    with emulator.Emulator(str(card_dir)) as card:
+        card.add_file("/DCIM/IMG_0001.JPG", data)
+        card.add_file("/DCIM/IMG_0002.JPG", data[::-1])
+        files = sorted(command.list_files(remote_dir="/DCIM", url=card.url))
+        connections = card.connections
+        tracer = trace.enable()
+        try:
+            for f in files:
+                local_name = str(local_dir.join(f.filename))
+                sync._stream_to_file(local_name, f, card.url,
+                                     chunk_size=10000)
+        finally:
+            trace.disable()
+        assert card.connections == connections  # kept alive
+    assert local_dir.join("IMG_0001.JPG").read_binary() == data
+    assert local_dir.join("IMG_0002.JPG").read_binary() == data[::-1]
+    writes = [e["args"] for e in tracer.chrome_trace()["traceEvents"]
+              if e["name"] == "sync.write_file"]
+    assert [w["bytes"] for w in writes] == [len(data)] * 2
+    assert sum(w["buffers"] for w in writes) <= 1
+    assert sorted(os.listdir(str(local_dir))) == ["IMG_0001.JPG",
+                                                  "IMG_0002.JPG"]
+
+
+def test_interrupted_preallocated_download_resumes(tmpdir):
+    local_name = str(tmpdir.join("IMG_0001.JPG"))
+    data = b"0123456789" * 10
+    fileinfo = info.FileInfo("/DCIM", "IMG_0001.JPG", "/DCIM/IMG_0001.JPG",
+                             len(data), None, arrow.get(2016, 1, 2, 3, 4, 6))
+    part_name = local_name + sync.PART_SUFFIX
+
+    class _Dropped(_FakeResponse):
+        def iter_content(self, chunk_size):
+            yield self.content[:30]
+            raise IOError("connection dropped")
+
+    sync._resume_offset(part_name, fileinfo)
+    with pytest.raises(IOError):
+        sync._write_file_safely(local_name, fileinfo, _Dropped(200, data))
+    assert os.path.getsize(part_name) == 30  # not the preallocated 100
+    assert sync._resume_offset(part_name, fileinfo) == 30
+
+    # a part file left preallocated by a crash can't be trusted
+    sync._write_file_safely(local_name, fileinfo, _FakeResponse(
+        206, data[30:], {"Content-Range": "bytes 30-99/100"}), 30)
+    with open(local_name, "rb") as local:
+        assert local.read() == data
+    os.rename(local_name, part_name)
+    sync._write_part_info(sync._part_info_path(part_name),
+                          dict(sync._part_info(fileinfo), preallocated=True))
+    assert sync._resume_offset(part_name, fileinfo) == 0
+    with pytest.raises(AssertionError):
+        sync._part_info_path(local_name)  # no sidecar for a finished file
+
+
+def test_fsync_policies(tmpdir, monkeypatch):
+    events = []
+    real_fsync, real_replace = os.fsync, os.replace
+    monkeypatch.setattr(os, "fsync", lambda fd: events.append(
+                        ("fsync", os.fstat(fd).st_ino)) or real_fsync(fd))
+    monkeypatch.setattr(os, "replace", lambda src, dst: events.append(
+                        ("replace", os.stat(src).st_ino)) or
+                        real_replace(src, dst))
+
+    def commit(policy, name, renamed=True):
+        part = tmpdir.join(name + sync.PART_SUFFIX)
+        part.write_binary(b"x")
+        policy.commit(str(part), str(tmpdir.join(name)))
+        assert tmpdir.join(name).check() == renamed
+        assert part.check() != renamed
+
+    off = sync.FsyncPolicy("off")
+    commit(off, "OFF.JPG")
+    off.flush()
+    assert off.fsyncs == 0 and [e for e, _ in events] == ["replace"]
+
+    del events[:]
+    per_file = sync.FsyncPolicy("file")
+    commit(per_file, "FILE.JPG")
+    assert per_file.fsyncs == 2  # the file, then its directory
+    file_ino = tmpdir.join("FILE.JPG").stat().ino
+    assert events == [("fsync", file_ino), ("replace", file_ino),
+                      ("fsync", tmpdir.stat().ino)]
+
+    del events[:]
+    batch = sync.FsyncPolicy("batch", files=3, seconds=60)
+    commit(batch, "A.JPG", renamed=False)
+    commit(batch, "B.JPG", renamed=False)
+    assert batch.fsyncs == 0 and not events  # nothing until the batch is full
+    commit(batch, "C.JPG")
+    assert batch.fsyncs == 3 + 1  # three files, one directory
+    assert [e for e, _ in events] == ["fsync"] * 3 + ["replace"] * 3 + \
+        ["fsync"]
+    commit(batch, "D.JPG", renamed=False)
+    batch.flush()
+    batch.flush()
+    assert tmpdir.join("D.JPG").check()
+    assert batch.fsyncs == 5 + 1
+
+    slow = sync.FsyncPolicy("batch", files=100, seconds=0)
+    commit(slow, "E.JPG")
+    assert slow.fsyncs == 2
+    with pytest.raises(ValueError):
+        sync.FsyncPolicy("sometimes")
+
+
+def test_stat_finished_before_flush(tmpdir):
+    policy = sync.FsyncPolicy("batch", files=100, seconds=60)
+    part = tmpdir.join("A.JPG" + sync.PART_SUFFIX)
+    part.write_binary(b"x" * 10)
+    policy.commit(str(part), str(tmpdir.join("A.JPG")))
+    assert sync._stat_finished(str(tmpdir.join("A.JPG"))).st_size == 10
+    policy.flush()
+    assert sync._stat_finished(str(tmpdir.join("A.JPG"))).st_size == 10
+    with pytest.raises(FileNotFoundError):
+        sync._stat_finished(str(tmpdir.join("B.JPG")))
+
+
+def test_downloads_flushed_when_done(tmpdir):
+    policy = sync.FsyncPolicy("batch", files=100, seconds=60)
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    with emulator.Emulator(str(card_dir)) as card:
+        for name in ("A.JPG", "B.JPG"):
+            card.add_file("/DCIM/100__TSB/" + name, b"x" * 100)
+            card.add_file("/DCIM/101__TSB/" + name, b"y" * 100)
+        report = sync.down_by_all(remote_dir="/DCIM",
+                                  local_dir=str(local_dir), url=card.url,
+                                  recursive=True, fsync_policy=policy)
+    assert len(report.synced) == 4
+    assert policy.fsyncs == 4 + 2  # four files in two directories
+    assert not list(local_dir.visit("*" + sync.PART_SUFFIX))
+
+
+def test_upload_session_request_count(monkeypatch):
+    sent = []
+
+    class _Success:
+        status_code = 200
+        text = "SUCCESS"
+    monkeypatch.setattr(upload.cgi, "send",
+                        lambda req, **_: sent.append(req) or _Success())
+    with upload.UploadSession("/DCIM") as session:
+        for _ in range(3):
+            session.upload("README.md")
+    params = [parse.urlparse(r.url).query.split("=")[0] for r in sent]
+    assert params == ["WRITEPROTECT", "UPDIR",
+                      "FTIME", "", "FTIME", "", "FTIME", "",
+                      "WRITEPROTECT"]
+
+
+def test_streaming_multipart_body():
+    progress = []
+    with upload.MultipartFile("README.md",
+                              progress=lambda *p: progress.append(p)) as body:
+        chunks = list(body)
+    data = b"".join(chunks)
+    with open("README.md", "rb") as readme:
+        content = readme.read()
+    assert len(data) == len(body)
+    assert max(len(c) for c in chunks) <= body.chunk_size
+    assert progress[-1] == (len(body), len(body))
+    boundary = body.boundary.encode()
+    assert data.startswith(b"--" + boundary + b"\r\n")
+    assert b'filename="README.md"' in data
+    assert data.endswith(b"\r\n--" + boundary + b"--\r\n")
+    head, _, rest = data.partition(b"\r\n\r\n")
+    assert rest[:len(content)] == content
+
+
+_LISTING = ("WLANSD_FILELIST\r\n"
+            "/DCIM/100__TSB,IMG_0001.JPG,1000,32,18489,42182\r\n"
+            "/DCIM/100__TSB,IMG_0002.JPG,2000,32,18489,42183\r\n")
+
+
+def test_remote_index_revalidation(monkeypatch, tmpdir):
+    from tfatool import index
+    fetched, changed = [], [False]
+
+    class _Listing:
+        text = _LISTING
+
+    monkeypatch.setattr(index.command, "_get",
+                        lambda *a, **kw: fetched.append(a) or _Listing())
+    monkeypatch.setattr(index.command, "memory_changed",
+                        lambda url: changed[0])
+    monkeypatch.setattr(index.command, "count_files",
+                        lambda remote_dir, url: 2)
+    mac = ["e8:e0:b7:00:00:01"]
+    monkeypatch.setattr(index.command, "get_mac", lambda url: mac[0])
+    path = str(tmpdir.join("index.json"))
+    remote_index = index.RemoteIndex(path)
+    assert len(remote_index.map_files()) == 2
+    assert len(remote_index.map_files_raw()) == 2
+    assert len(fetched) == 1  # second listing came from the cache
+    changed[0] = True
+    assert len(list(remote_index.list_files())) == 2
+    assert len(fetched) == 2
+    changed[0] = False
+
+    reloaded = index.RemoteIndex(path)
+    assert len(list(reloaded.list_files())) == 2
+    assert len(fetched) == 2  # verified by file count, not re-listed
+    reloaded.invalidate()
+    assert len(list(reloaded.list_files())) == 2
+    assert len(fetched) == 3
+
+    mac[0] = "e8:e0:b7:00:00:02"  # another card with as many files
+    swapped = index.RemoteIndex(path)
+    assert len(list(swapped.list_files())) == 2
+    assert len(fetched) == 4  # not taken for the first card's listing
+
+
+def test_file_list_name_filter_pushdown():
+    decoded = []
+    lines = _LISTING.split("\r\n") + ["/DCIM/100__TSB,IMG_0003.CR2,3,32,0,0"]
+    orig_decode_all = fattime.decode_all
+    name_filter = filters.NameFilter(lambda name: name.endswith(".JPG"))
+    size_filter = lambda f: f.size > 1000
+    try:
+        fattime.decode_all = lambda dates, times: (
+            decoded.extend(zip(dates, times)) or
+            orig_decode_all(dates, times))
+        files = list(command._split_file_list(lines, name_filter, size_filter))
+    finally:
+        fattime.decode_all = orig_decode_all
+    assert [f.filename for f in files] == ["IMG_0002.JPG"]
+    assert files[0].path == "/DCIM/100__TSB/IMG_0002.JPG"
+    assert files[0].datetime == fattime.decode(18489, 42183)
+    assert len(decoded) == 2  # the CR2 row was never decoded
+    raw = list(command._split_file_list_raw(lines, name_filter))
+    assert [f.size for f in raw] == [1000, 2000]
+
+
+def test_listing_path_join():
+    from pathlib import PurePosixPath
+    for directory in ["/DCIM/100__TSB", "/", "", "/DCIM/", "DCIM"]:
+        assert (command._join_path(directory, "X.JPG") ==
+                str(PurePosixPath(directory, "X.JPG")))
+
+
+def test_fat_time_bulk_codec():
+    mtimes = [os.stat(name).st_mtime for name in ("README.md", "setup.py")]
+    mtimes += [1451703845.5, 315532800.0, 1459000000.25]
+    encoded = [fattime.encode(m) for m in mtimes]
+    assert list(fattime.encode_all(mtimes)) == encoded
+    date_vals, time_vals = zip(*(fattime.split(e) for e in encoded))
+    decoded = [fattime.decode(d, t) for d, t in zip(date_vals, time_vals)]
+    assert fattime.decode_all(date_vals, time_vals) == decoded
+    assert (list(fattime.timestamps(date_vals, time_vals)) ==
+            [fattime.timestamp(d, t) for d, t in zip(date_vals, time_vals)] ==
+            [int(d.float_timestamp) for d in decoded])
+
+
+def test_fat_time_invalid_fields_clamped():
+    decoded = fattime.decode((36 << 9) | (2 << 5) | 31, 0)  # Feb. 31st
+    assert (decoded.year, decoded.month, decoded.day) == (2016, 2, 29)
+    decoded = fattime.decode(0, 0)  # month and day zero
+    assert (decoded.year, decoded.month, decoded.day) == (1980, 1, 1)
+
+
+def test_date_filter_pushdown_matches_datetime_compare():
+    start = arrow.get(2016, 3, 1).float_timestamp
+    mtimes = [start + n * 37 for n in range(500)]
+    rows = ["/DCIM,F{:d}.JPG,10,32,{:d},{:d}".format(
+            n, *fattime.split(fattime.encode(m))) for n, m in enumerate(mtimes)]
+    all_files = list(command._split_file_list(rows))
+    assert list(command._split_file_list(rows, batch_size=7)) == all_files
+    for earliest, latest in [(start + 1001, start + 9001),
+                             (start + 3000.5, None), (None, start + 77)]:
+        earliest = earliest and arrow.get(earliest)
+        latest = latest and arrow.get(latest)
+        date_filter = filters.DateFilter(earliest, latest)
+        pushed_down = list(command._split_file_list(rows, date_filter))
+        assert pushed_down == [f for f in all_files if date_filter(f)]
+        raw = list(command._split_file_list_raw(rows, date_filter))
+        assert [f.filename for f in raw] == [f.filename for f in pushed_down]
+
+
+def test_inotify_watcher_waits_for_close(tmpdir):
+    if not inotify.is_available():
+        return
+    local_dir = str(tmpdir)
+    jpegs = filters.NameFilter(lambda name: name.endswith(".JPG"))
+    watcher = sync.watch_local_files(jpegs, local_dir=local_dir)
+    new, all_files = next(watcher)
+    assert not new and not all_files
+    with open(os.path.join(local_dir, "IMG_0001.JPG"), "wb") as f:
+        f.write(b"half a photo")
+        f.flush()
+        new, _ = next(watcher)
+        assert not new  # still being written
+    tmpdir.join("notes.txt").write("not a JPEG")
+    new, all_files = next(watcher)
+    assert [f.filename for f in new] == ["IMG_0001.JPG"]
+    assert all_files == new
+    os.rename(os.path.join(local_dir, "IMG_0001.JPG"),
+              os.path.join(local_dir, "IMG_0002.JPG"))
+    new, all_files = next(watcher)
+    assert [f.filename for f in new] == ["IMG_0002.JPG"]
+    assert all_files == new
+    new, _ = next(watcher)
+    assert not new
+
+
+def test_inotify_watch_stops_promptly(tmpdir):
+    if not inotify.is_available():
+        return
+    tmpdir.join("IMG_0001.JPG").write_binary(b"x")
+    open_fds = len(os.listdir("/proc/self/fd"))
+    sync.watch_local_files(local_dir=str(tmpdir))  # never started
+    assert len(os.listdir("/proc/self/fd")) == open_fds
+
+    pipeline = sync.Pipeline(direction=sync.Direction.up,
+                             local_dir=str(tmpdir),
+                             scheduler=poll.PollScheduler(30, 30))
+    pipeline.start()
+    time.sleep(0.2)  # let the detector block on inotify
+    start = time.time()
+    pipeline.stop()
+    pipeline.join()
+    assert time.time() - start < 5
+    assert len(os.listdir("/proc/self/fd")) == open_fds
+
+
+def test_inotify_events_without_a_name_are_skipped(tmpdir, monkeypatch):
+    if not inotify.is_available():
+        return
+    tmpdir.join("IMG_0001.JPG").write_binary(b"x")
+    events = [(inotify.IN_IGNORED, ""),
+              (inotify.IN_CLOSE_WRITE, "IMG_0002.JPG")]
+    monkeypatch.setattr(inotify.Watcher, "read_events",
+                        lambda self, timeout=0: events)
+    watcher = sync.watch_local_files(local_dir=str(tmpdir))
+    next(watcher)
+    tmpdir.join("IMG_0002.JPG").write_binary(b"y")
+    new, all_files = next(watcher)
+    assert [f.filename for f in new] == ["IMG_0002.JPG"]
+    assert len(all_files) == 2
+    watcher.close()
+
+
+def test_poll_scheduler_backoff():
+    scheduler = poll.PollScheduler(0.1, 1.0, backoff=2)
+    for _ in range(5):
+        scheduler.record(False)
+    assert scheduler.interval == 1.0
+    scheduler.record(True)
+    assert scheduler.interval == 0.1
+    scheduler.record(False)
+    assert scheduler.interval == 0.2
+    assert (scheduler.polls, scheduler.changes) == (7, 1)
+
+
+def test_remote_watcher_scheduled(monkeypatch):
+    changes = iter([False, False, True, False])
+    listings = iter([["A"], ["A", "B"]])
+    monkeypatch.setattr(sync.command, "memory_changed",
+                        lambda url: next(changes))
+    monkeypatch.setattr(sync.command, "list_files",
+                        lambda *f, **kw: next(listings))
+    scheduler = poll.PollScheduler(0, 0)
+    watcher = sync.watch_remote_files(scheduler=scheduler)
+    assert next(watcher) == (set(), {"A"})
+    assert next(watcher) == (set(), {"A"})
+    assert next(watcher) == ({"B"}, {"A", "B"})
+    assert next(watcher) == (set(), {"A", "B"})
+    assert (scheduler.polls, scheduler.changes) == (3, 1)
+
+
+def test_unstarted_listings_send_no_requests(tmpdir):
+    with emulator.Emulator(str(tmpdir)) as card:
+        card.add_file("/DCIM/A.JPG", b"a")
+        listings = [command.list_files(remote_dir="/DCIM", url=card.url)
+                    for _ in range(cgi.DEFAULT_POOL_SIZE + 2)]
+        listings += [command.list_files_raw(remote_dir="/DCIM", url=card.url)]
+        assert not card.requests["command.cgi"]
+        assert [f.filename for f in listings[-1]] == ["A.JPG"]
+        assert card.requests["command.cgi"] == 1
+
+
+def test_remote_watchers_share_an_index(tmpdir):
+    from tfatool import index
+    remote_index = index.RemoteIndex()
+    with emulator.Emulator(str(tmpdir)) as card:
+        card.add_file("/DCIM/A.JPG", b"a")
+        watcher = sync.watch_remote_files(remote_dir="/DCIM", url=card.url,
+                                          index=remote_index)
+        other = sync.watch_remote_files(remote_dir="/DCIM", url=card.url,
+                                        index=remote_index)
+        next(watcher), next(other)
+        card.add_file("/DCIM/B.JPG", b"b")
+        # another user of the index reads the card's change flag first
+        assert "B.JPG" in remote_index.map_files_raw(remote_dir="/DCIM",
+                                                     url=card.url)
+        new, _ = next(watcher)
+        assert [f.filename for f in new] == ["B.JPG"]
+        new, _ = next(other)
+        assert [f.filename for f in new] == ["B.JPG"]
+        assert next(watcher)[0] == set()
+
+
+def test_emulator_listing_and_download(tmpdir):
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    with emulator.Emulator(str(card_dir)) as card:
+        card.add_file("/DCIM/100__TSB/IMG_0001.JPG", b"x" * 1000)
+        card.add_file("/DCIM/100__TSB/IMG_0002.JPG", b"y" * 2000)
+        assert command.memory_changed(url=card.url)
+        assert not command.memory_changed(url=card.url)
+        files = list(command.list_files(remote_dir="/DCIM/100__TSB",
+                                        url=card.url))
+        assert sorted(f.size for f in files) == [1000, 2000]
+        assert command.count_files(remote_dir="/DCIM/100__TSB",
+                                   url=card.url) == 2
+        report = sync.down_by_files(files, str(local_dir), url=card.url)
+        assert len(report.synced) == 2 and not report.failed
+        assert local_dir.join("IMG_0002.JPG").read_binary() == b"y" * 2000
+
+
+def test_emulator_upload(tmpdir):
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    local_file = local_dir.join("IMG_0003.JPG")
+    local_file.write_binary(b"z" * 5000)
+    os.utime(str(local_file), (1450000000, 1450000000))
+    with emulator.Emulator(str(card_dir)) as card:
+        sync.up_by_all(local_dir=str(local_dir), remote_dir="/DCIM",
+                       url=card.url)
+        uploaded = card_dir.join("DCIM", "IMG_0003.JPG")
+        assert uploaded.read_binary() == b"z" * 5000
+        assert abs(uploaded.mtime() - 1450000000) <= 2
+        assert command.memory_changed(url=card.url)
+        assert card.requests["upload.cgi"] == 5  # 4 setup params + POST
+
+
+def test_trace_spans(tmpdir):
+    assert trace.span("cgi.send") is trace.span("sync.write_file")  # no-op
+    tracer = trace.enable()
+    try:
+        with trace.span("sync.write_file", file="A.JPG") as span:
+            span.add(bytes=1000)
+            span.add(bytes=500)
+        with pytest.raises(ValueError):
+            with trace.span("cgi.send"):
+                raise ValueError()
+    finally:
+        assert trace.disable() is tracer
+    first, second = tracer.chrome_trace()["traceEvents"]
+    assert first["ph"] == "X" and first["cat"] == "sync"
+    assert first["args"] == {"file": "A.JPG", "bytes": 1500}
+    assert second["args"] == {"error": "ValueError"}
+    rows = {row[0]: row for row in tracer.summary()}
+    assert rows["sync.write_file"][1] == 1  # count
+    assert rows["sync.write_file"][5] == 1500 / 10**6  # MB
+    path = str(tmpdir.join("trace.json"))
+    tracer.save(path)
+    with open(path) as f:
+        assert len(json.load(f)["traceEvents"]) == 2
+
+
+def test_request_metrics(tmpdir):
+    cgi.metrics.reset()
+    with emulator.Emulator(str(tmpdir)) as card:
+        card.add_file("/DCIM/IMG_0001.JPG", b"x" * 100)
+        list(command.list_files(remote_dir="/DCIM", url=card.url))
+        command.memory_changed(url=card.url)
+        upload.set_upload_dir("/DCIM", url=card.url)
+        url = card.url
+    with pytest.raises(requests.RequestException):
+        command.memory_changed(url=url)  # the emulator has stopped
+    stats = cgi.metrics.snapshot()
+    listing = stats["command.cgi", "list_files"]
+    assert listing.requests == 1 and listing.statuses == {200: 1}
+    assert listing.bytes_in > 0 and sum(listing.latency_buckets) == 1
+    changed = stats["command.cgi", "memory_changed"]
+    assert (changed.requests, changed.errors) == (2, 1)
+    assert stats["upload.cgi", "directory"].requests == 1
+    text = cgi.metrics.to_prometheus()
+    assert ('tfatool_request_duration_seconds_bucket{entrypoint="command.cgi",'
+            'operation="list_files",le="+Inf"} 1') in text
+    assert ('tfatool_request_errors_total{entrypoint="command.cgi",'
+            'operation="memory_changed"} 1') in text
+    cgi.metrics.reset()
+    assert not cgi.metrics.snapshot()
+
+
+def test_session_pool_reuses_connections(tmpdir):
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    with emulator.Emulator(str(card_dir)) as card:
+        for i in range(8):
+            card.add_file("/DCIM/IMG_{:04d}.JPG".format(i), b"x" * 1000)
+        report = sync.down_by_all(remote_dir="/DCIM", local_dir=str(local_dir),
+                                  url=card.url, workers=2)
+        assert len(report.synced) == 8
+        # one listing, 8 downloads, at most 2 at a time
+        assert card.connections <= 3
+    session = cgi.pool.session(card.url)
+    assert cgi.pool.session(card.url + "DCIM/") is session
+    sessions = []
+    thread = threading.Thread(
+        target=lambda: sessions.append(cgi.pool.session(card.url)))
+    thread.start()
+    thread.join()
+    assert sessions[0] is not session  # one per thread...
+    adapter = session.get_adapter(card.url)
+    assert sessions[0].get_adapter(card.url) is adapter  # ...sharing a pool
+
+
+def test_cgi_session_alias():
+    default = cgi.pool.session(info.URL)
+    assert cgi.session.headers is default.headers
+    assert cgi.session.get_adapter(info.URL) is default.get_adapter(info.URL)
+    request = cgi.session.prepare_request(
+        requests.Request("GET", info.URL + "command.cgi"))
+    assert request.url == info.URL + "command.cgi"
+    with cgi.session as session:
+        assert session is default
+
+
+def _run_aio(coro):
+    async def run():
+        try:
+            return await coro
+        finally:
+            await aio.cgi.close_clients()
+    return asyncio.run(run())
+
+
+def test_aio_command_and_transfers(tmpdir):
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    with emulator.Emulator(str(card_dir), max_connections=2) as card:
+        for i in range(5):
+            card.add_file("/DCIM/IMG_{:04d}.JPG".format(i), b"x" * 10000)
+
+        async def transfers():
+            assert await aio.command.memory_changed(url=card.url)
+            assert await aio.command.count_files("/DCIM", url=card.url) == 5
+            files = await aio.command.list_files(
+                filters.NameFilter(lambda name: name != "IMG_0004.JPG"),
+                remote_dir="/DCIM", url=card.url)
+            report = await aio.sync.down_by_files(files, str(local_dir),
+                                                  url=card.url, workers=2)
+            assert len(report.synced) == 4 and not report.failed
+            local_dir.join("NEW.JPG").write_binary(b"y" * 3000)
+            await aio.upload.upload_file(str(local_dir.join("NEW.JPG")),
+                                         url=card.url, remote_dir="/UP")
+            assert card_dir.join("UP", "NEW.JPG").read_binary() == b"y" * 3000
+            await aio.upload.delete_file("/UP/NEW.JPG", url=card.url)
+            return report
+
+        _run_aio(transfers())
+    assert len(local_dir.listdir()) == 5
+    assert local_dir.join("IMG_0000.JPG").read_binary() == b"x" * 10000
+    assert not card_dir.join("UP", "NEW.JPG").check()
+
+
+def test_aio_cancellation_keeps_partial_files(tmpdir):
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    with emulator.Emulator(str(card_dir), bandwidth=200000) as card:
+        card.add_file("/DCIM/BIG.JPG", b"z" * 400000)
+
+        async def cancelled_download():
+            files = await aio.command.list_files(remote_dir="/DCIM",
+                                                 url=card.url)
+            task = asyncio.ensure_future(
+                aio.sync.down_by_files(files, str(local_dir), url=card.url))
+            await asyncio.sleep(0.5)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            part = local_dir.join("BIG.JPG" + sync.PART_SUFFIX)
+            assert 0 < part.size() < 400000
+            # ...and the next attempt resumes where it left off
+            report = await aio.sync.down_by_files(files, str(local_dir),
+                                                  url=card.url)
+            assert len(report.synced) == 1
+
+        _run_aio(cancelled_download())
+    assert local_dir.join("BIG.JPG").read_binary() == b"z" * 400000
+    assert card.requests["file"] == 2
+
+
+def test_aio_short_download_is_kept_as_part(tmpdir):
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    with emulator.Emulator(str(card_dir)) as card:
+        card.add_file("/DCIM/IMG.JPG", b"x" * 1000)
+
+        async def short_download():
+            files = await aio.command.list_files(remote_dir="/DCIM",
+                                                 url=card.url)
+            listed = [f._replace(size=2000) for f in files]
+            return await aio.sync.down_by_files(listed, str(local_dir),
+                                                url=card.url)
+
+        report = _run_aio(short_download())
+    assert [f.filename for f, _ in report.failed] == ["IMG.JPG"]
+    assert not local_dir.join("IMG.JPG").check()
+    assert local_dir.join("IMG.JPG" + sync.PART_SUFFIX).size() == 1000
+
+
+def test_aio_down_by_arrival(tmpdir):
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    with emulator.Emulator(str(card_dir)) as card:
+        card.add_file("/DCIM/OLD.JPG", b"o")
+
+        async def arrivals():
+            scheduler = poll.PollScheduler(0.01, 0.05)
+            watcher = aio.sync.down_by_arrival(
+                remote_dir="/DCIM", local_dir=str(local_dir), url=card.url,
+                scheduler=scheduler)
+            _, new = await watcher.__anext__()
+            assert not new
+            card.add_file("/DCIM/NEW.JPG", b"n" * 100)
+            while not new:
+                _, new = await watcher.__anext__()
+            await watcher.aclose()
+            return new
+
+        new = _run_aio(arrivals())
+    assert [f.filename for f in new] == ["NEW.JPG"]
+    assert local_dir.listdir() == [local_dir.join("NEW.JPG")]
+
+
+def test_aio_status_line_without_reason():
+    async def read(head):
+        reader = asyncio.StreamReader()
+        reader.feed_data(head)
+        return await aio.cgi.Client("http://card/")._read_head(reader)
+
+    assert _run_aio(read(b"HTTP/1.1 200\r\nContent-Length: 3\r\n\r\n")) \
+        == (200, {"content-length": "3"})
+    assert _run_aio(read(b"HTTP/1.1 404 Not Found\r\n\r\n"))[0] == 404
+    with pytest.raises(aio.cgi.RequestError):
+        _run_aio(read(b"HTTP/1.1\r\n\r\n"))
+
+
+def test_supervisor_fair_job_order():
+    rig = supervisor.Supervisor([("http://a/",), ("http://b/",),
+                                 ("http://c/",)])
+    a, b, c = rig.cards
+    a.pending.extend(["a1", "a2", "a3", "a4"])
+    b.pending.extend(["b1"])
+    c.pending.extend(["c1", "c2"])
+    order = []
+    for _ in range(3):
+        card, job = rig._next_job()
+        card.active += 1
+        order.append(job)
+    assert order == ["a1", "b1", "c1"]  # one each before anyone gets two
+    b.active -= 1  # b1 finished, but b has nothing left
+    card, job = rig._next_job()
+    assert job == "a2"
+    a.active += 1
+    c.active -= 1  # c1 finished: c now has the fewest downloads running
+    assert rig._next_job()[1] == "c2"
+
+
+def test_supervisor_leaves_queue_when_stopped():
+    rig = supervisor.Supervisor([("http://a/",)])
+    card, = rig.cards
+    card.pending.extend(["a1", "a2"])
+    rig.running.set()
+    assert rig._take(wait=False) == (card, "a1")
+    rig.stop()
+    assert rig._take() is None
+    assert list(card.pending) == ["a2"] and card.active == 1
+
+
+def test_supervisor_slow_card_does_not_hold_up_others(tmpdir):
+    fast = emulator.Emulator(str(tmpdir.mkdir("fast")))
+    slow = emulator.Emulator(str(tmpdir.mkdir("slow")), latency=1.0)
+    local_dir = tmpdir.mkdir("local")
+    with fast, slow:
+        rig = supervisor.Supervisor(
+            [(fast.url, "/DCIM", str(local_dir)),
+             (slow.url, "/DCIM", str(tmpdir.mkdir("local_slow")))],
+            scheduler=poll.PollScheduler(0.01, 0.05))
+        rig.start()
+        try:
+            _wait_until(lambda: rig.status()[0].state == "idle")
+            fast.add_file("/DCIM/NEW.JPG", b"n" * 100)
+            start = time.time()
+            _wait_until(lambda: rig.status()[0].synced == 1)
+            assert time.time() - start < 0.8  # no waiting on the slow card
+        finally:
+            rig.stop()
+            rig.join()
+    assert local_dir.join("NEW.JPG").size() == 100
+
+
+def test_supervisor_downloads_from_several_cards(tmpdir):
+    cards = [emulator.Emulator(str(tmpdir.mkdir("card{:d}".format(i))))
+             for i in range(2)]
+    local_dirs = [str(tmpdir.mkdir("local{:d}".format(i))) for i in range(2)]
+    for card in cards:
+        card.start()
+        card.add_file("/DCIM/OLD.JPG", b"o")
+    targets = [supervisor.Target(card.url, "/DCIM", local_dir)
+               for card, local_dir in zip(cards, local_dirs)]
+    rig = supervisor.Supervisor(targets, workers=2,
+                                scheduler=poll.PollScheduler(0.01, 0.05))
+    rig.start()
+    try:
+        _wait_until(lambda: all(s.state == "idle" for s in rig.status()))
+        for i, card in enumerate(cards):
+            for j in range(i + 2):
+                card.add_file("/DCIM/NEW_{:d}.JPG".format(j), b"n" * 1000)
+        _wait_until(lambda: [s.synced for s in rig.status()] == [2, 3])
+        cards[1].stop()
+        _wait_until(lambda: rig.status()[1].state == "offline")
+        assert rig.status()[0].state == "idle"
+    finally:
+        rig.stop()
+        rig.join()
+        cards[0].stop()
+    assert sorted(os.listdir(local_dirs[0])) == ["NEW_0.JPG", "NEW_1.JPG"]
+    assert len(os.listdir(local_dirs[1])) == 3
+
+
+def _wait_until(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_pipeline_detects_files_during_transfers(tmpdir):
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    done = []
+    with emulator.Emulator(str(card_dir), bandwidth=500000) as card:
+        card.add_file("/DCIM/OLD.JPG", b"o")
+        pipeline = sync.Pipeline(
+            remote_dir="/DCIM", local_dir=str(local_dir), url=card.url,
+            workers=1, scheduler=poll.PollScheduler(0.01, 0.05),
+            on_transfer=done.append)
+        with pipeline:
+            _wait_until(lambda: pipeline.scheduler.polls)
+            card.add_file("/DCIM/A.JPG", b"a" * 500000)  # takes ~1 s
+            _wait_until(lambda: pipeline.active == 1)
+            card.add_file("/DCIM/B.JPG", b"b" * 1000)
+            _wait_until(lambda: pipeline.detected == 2)
+            assert not done  # B was queued while A was still downloading
+            _wait_until(lambda: len(done) == 2)
+    assert [t.fileinfo.filename for t in done] == ["A.JPG", "B.JPG"]
+    assert all(t.copied and t.error is None for t in done)
+    assert (pipeline.synced, pipeline.nbytes) == (2, 501000)
+    assert sorted(os.listdir(str(local_dir))) == ["A.JPG", "B.JPG"]
+
+
+def test_pipeline_queue_applies_backpressure():
+    pipeline = sync.Pipeline(queue_size=2)
+    pipeline.running.set()
+    queued = threading.Thread(target=pipeline._queue, args=("abc",))
+    queued.start()
+    _wait_until(lambda: len(pipeline.pending) == 2)
+    queued.join(0.05)
+    assert queued.is_alive()  # "c" waits for room in the queue
+    assert pipeline._next_file() == "a"
+    queued.join(1)
+    assert list(pipeline.pending) == ["b", "c"]
+    pipeline.stop()
+    assert pipeline._next_file() is None
+
+
+def test_pipeline_uploads(tmpdir):
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    local_dir.join("OLD.JPG").write_binary(b"o")
+    done = []
+    with emulator.Emulator(str(card_dir)) as card:
+        pipeline = sync.Pipeline(
+            direction=sync.Direction.up, remote_dir="/DCIM",
+            local_dir=str(local_dir), url=card.url, workers=3,
+            scheduler=poll.PollScheduler(0.01, 0.05), on_transfer=done.append)
+        assert pipeline.workers == 1
+        with pipeline:
+            _wait_until(lambda: pipeline.scheduler.polls)
+            for name in ("A.JPG", "B.JPG"):
+                local_dir.join(name).write_binary(b"n" * 1000)
+            _wait_until(lambda: len(done) == 2)
+    assert sorted(t.fileinfo.filename for t in done) == ["A.JPG", "B.JPG"]
+    assert sorted(os.listdir(str(card_dir.join("DCIM")))) == ["A.JPG",
+                                                              "B.JPG"]
+
+
+def test_two_way_sync_does_not_echo(tmpdir):
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    done = []
+    with emulator.Emulator(str(card_dir)) as card:
+        card.add_file("/DCIM/OLD.JPG", b"o")
+        engine = sync.TwoWaySync(
+            remote_dir="/DCIM", local_dir=str(local_dir), url=card.url,
+            scheduler=poll.PollScheduler(0.01, 0.05), on_transfer=done.append)
+        with engine:
+            _wait_until(lambda: engine.down.scheduler.polls and
+                        engine.up.scheduler.polls)
+            card.add_file("/DCIM/REMOTE.JPG", b"r" * 1000)
+            local_dir.join("LOCAL.JPG").write_binary(b"l" * 2000)
+            _wait_until(lambda: len(done) == 2)
+            polls = engine.down.scheduler.polls, engine.up.scheduler.polls
+            _wait_until(lambda: engine.down.scheduler.polls > polls[0] + 3 and
+                        engine.up.scheduler.polls > polls[1] + 3)
+        assert card.requests["file"] == 1
+    assert sorted((t.direction, t.fileinfo.filename) for t in done) == [
+        (sync.Direction.down, "REMOTE.JPG"), (sync.Direction.up, "LOCAL.JPG")]
+    assert engine.down.detected == engine.up.detected == 1
+    assert len(engine.ledger) == 2
+    assert card_dir.join("DCIM", "LOCAL.JPG").size() == 2000
+    assert local_dir.join("REMOTE.JPG").size() == 1000
+
+
+def test_ledger_spots_echoes():
+    ledger = sync.Ledger()
+    a = info.SimpleFileInfo("/DCIM", "A.JPG", "/DCIM/A.JPG", 100, None)
+    partial_a = a._replace(size=10)
+    ledger.begin(a)
+    assert ledger.is_echo(partial_a)  # still transferring
+    ledger.end(a)
+    assert ledger.is_echo(a) and not ledger.is_echo(partial_a)
+    assert not ledger.is_echo(a._replace(size=200))  # edited since
+    ledger.begin(a)
+    ledger.end(a, ok=False)
+    assert not ledger.is_echo(a)
+
+
+def test_up_down_by_arrival_skips_its_own_downloads(tmpdir):
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    with emulator.Emulator(str(card_dir)) as card:
+        watcher = sync.up_down_by_arrival(
+            remote_dir="/DCIM", local_dir=str(local_dir), url=card.url)
+        arrivals = [next(watcher)]
+        card.add_file("/DCIM/REMOTE.JPG", b"r" * 1000)
+        arrivals.extend(next(watcher) for _ in range(8))
+        assert card.requests["upload.cgi"] == 0
+    names = [(d, f.filename) for d, files in arrivals for f in files]
+    assert names == [(sync.Direction.down, "REMOTE.JPG")]
+    assert local_dir.join("REMOTE.JPG").size() == 1000
+
+
+def test_walk_remote_lists_the_whole_tree(tmpdir):
+    with emulator.Emulator(str(tmpdir.mkdir("card"))) as card:
+        card.add_file("/DCIM/100__TSB/IMG_0001.JPG", b"a")
+        card.add_file("/DCIM/100__TSB/IMG_0001.RAW", b"b")
+        card.add_file("/DCIM/101__TSB/IMG_0001.JPG", b"c")
+        card.add_file("/DCIM/101__TSB/DEEP/IMG_0002.JPG", b"d")
+        card.add_file("/DCIM/TOP.JPG", b"e")
+        jpegs = filters.NameFilter(lambda name: name.endswith(".JPG"))
+        files = list(command.walk_remote(jpegs, remote_dir="/DCIM",
+                                         url=card.url, workers=2))
+        assert sorted(f.path for f in files) == [
+            "/DCIM/100__TSB/IMG_0001.JPG", "/DCIM/101__TSB/DEEP/IMG_0002.JPG",
+            "/DCIM/101__TSB/IMG_0001.JPG", "/DCIM/TOP.JPG"]
+        command_requests = card.requests["command.cgi"]
+    assert command_requests == 4  # one listing per directory
+
+
+def test_walk_remote_with_index_saves_once(tmpdir, monkeypatch):
+    from tfatool import index
+    saves = []
+    remote_index = index.RemoteIndex(str(tmpdir.join("index.json")))
+    real_save = remote_index.save
+    monkeypatch.setattr(remote_index, "save",
+                        lambda: saves.append(1) or real_save())
+    with emulator.Emulator(str(tmpdir.mkdir("card"))) as card:
+        for i in range(4):
+            card.add_file("/DCIM/{:d}__TSB/IMG.JPG".format(100 + i), b"a")
+        files = list(command.walk_remote(remote_dir="/DCIM", url=card.url,
+                                         index=remote_index))
+        assert len(files) == 4
+        assert len(saves) == 1
+        reloaded = index.RemoteIndex(str(tmpdir.join("index.json")))
+        assert len(reloaded._listings) == 5
+
+
+def test_down_by_all_recursive_mirrors_tree(tmpdir):
+    local_dir = tmpdir.mkdir("local")
+    with emulator.Emulator(str(tmpdir.mkdir("card"))) as card:
+        card.add_file("/DCIM/100__TSB/IMG_0001.JPG", b"a" * 10)
+        card.add_file("/DCIM/101__TSB/IMG_0001.JPG", b"b" * 20)
+        report = sync.down_by_all(remote_dir="/DCIM", local_dir=str(local_dir),
+                                  url=card.url, recursive=True)
+    assert len(report.synced) == 2
+    assert local_dir.join("100__TSB", "IMG_0001.JPG").size() == 10
+    assert local_dir.join("101__TSB", "IMG_0001.JPG").size() == 20
+
+
+def test_pipeline_recursive_picks_up_new_folders(tmpdir):
+    local_dir = tmpdir.mkdir("local")
+    done = []
+    with emulator.Emulator(str(tmpdir.mkdir("card"))) as card:
+        card.add_file("/DCIM/100__TSB/OLD.JPG", b"o")
+        pipeline = sync.Pipeline(
+            remote_dir="/DCIM", local_dir=str(local_dir), url=card.url,
+            recursive=True, scheduler=poll.PollScheduler(0.01, 0.05),
+            on_transfer=done.append)
+        with pipeline:
+            _wait_until(lambda: pipeline.scheduler.polls)
+            card.add_file("/DCIM/101__TSB/NEW.JPG", b"n" * 100)
+            _wait_until(lambda: done)
+    assert done[0].fileinfo.path == "/DCIM/101__TSB/NEW.JPG"
+    assert local_dir.join("101__TSB", "NEW.JPG").size() == 100
+    assert not local_dir.join("100__TSB").check()
+
+
+def test_journal_resume(tmpdir):
+    path = str(tmpdir.join("journal.sqlite"))
+    a = info.SimpleFileInfo("/DCIM", "A.JPG", "/DCIM/A.JPG", 100,
+                            arrow.get(1450000000))
+    b = a._replace(filename="B.JPG", path="/DCIM/B.JPG")
+    with journal.Journal(path) as log:
+        log._cards["http://card/"] = "e8:e0:b7:00:00:01"
+        assert log.resume("http://card/", sync.Direction.down, "/DCIM",
+                          {a}, "photos") == {a}  # first watch: all ignored
+    with journal.Journal(path) as log:
+        log._cards["http://card/"] = "e8:e0:b7:00:00:01"
+        assert log.resume("http://card/", sync.Direction.down, "/DCIM",
+                          {a, b}, "photos") == {a}  # b arrived meanwhile
+        assert log.resume("http://card/", sync.Direction.down, "/DCIM",
+                          {a, b}, "other") == {a, b}  # a new destination
+        log.record("e8:e0:b7:00:00:01", sync.Direction.down, b, "photos")
+        assert log.contains("e8:e0:b7:00:00:01", "download", b, "photos")
+        assert log.contains("e8:e0:b7:00:00:01", "download", b,
+                            os.path.abspath("photos"))
+        assert not log.contains("e8:e0:b7:00:00:01", "download", b, "tmp")
+        assert not log.contains("e8:e0:b7:00:00:01", "upload", b, "photos")
+        assert not log.contains("e8:e0:b7:00:00:01", "download",
+                                b._replace(size=101), "photos")  # edited
+        log.forget("e8:e0:b7:00:00:01")
+        assert not log.keys("e8:e0:b7:00:00:01", sync.Direction.down,
+                            "photos")
+
+
+def test_journal_without_local_dirs_starts_afresh(tmpdir):
+    import sqlite3
+    path = str(tmpdir.join("journal.sqlite"))
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE files (card, direction, path, size, fat_time, "
+               "status, finished)")
+    db.execute("INSERT INTO files VALUES ('c', 'download', '/DCIM/A.JPG', "
+               "1, 0, 'synced', 0)")
+    db.commit()
+    db.close()
+    with journal.Journal(path) as log:
+        assert not log.keys("c", sync.Direction.down, ".")
+        log.record("c", sync.Direction.down, info.SimpleFileInfo(
+                   "/DCIM", "A.JPG", "/DCIM/A.JPG", 1, None), ".")
+        assert len(log.keys("c", sync.Direction.down, ".")) == 1
+
+
+def test_pipeline_catches_up_from_journal(tmpdir):
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    log = journal.Journal(str(tmpdir.join("journal.sqlite")))
+
+    def run_pipeline(expected, new_name=None):
+        done = []
+        pipeline = sync.Pipeline(
+            remote_dir="/DCIM", local_dir=str(local_dir), url=card.url,
+            journal=log, scheduler=poll.PollScheduler(0.01, 0.05),
+            on_transfer=done.append)
+        with pipeline:
+            _wait_until(lambda: pipeline.scheduler.polls)
+            if new_name:
+                card.add_file("/DCIM/" + new_name, b"n" * 100)
+            _wait_until(lambda: len(done) == expected)
+        return [t.fileinfo.filename for t in done]
+
+    with emulator.Emulator(str(card_dir)) as card:
+        card.add_file("/DCIM/OLD.JPG", b"o")
+        assert run_pipeline(1, "NEW_1.JPG") == ["NEW_1.JPG"]
+        card.add_file("/DCIM/MISSED.JPG", b"m" * 10)  # while we're away
+        assert run_pipeline(1) == ["MISSED.JPG"]
+        assert run_pipeline(0) == []
+    log.close()
+    assert sorted(os.listdir(str(local_dir))) == ["MISSED.JPG", "NEW_1.JPG"]
+
+
+def test_down_by_files_skips_journaled_files(tmpdir):
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    with emulator.Emulator(str(card_dir), mac="e8:e0:b7:00:00:02") as card, \
+            journal.Journal(str(tmpdir.join("journal.sqlite"))) as log:
+        card.add_file("/DCIM/A.JPG", b"a" * 10)
+        card.add_file("/DCIM/B.JPG", b"b" * 10)
+        report = sync.down_by_all(remote_dir="/DCIM", local_dir=str(local_dir),
+                                  url=card.url, journal=log)
+        assert len(report.synced) == 2
+        assert log.card_id(card.url) == "e8:e0:b7:00:00:02"
+        local_dir.join("A.JPG").remove()
+        card.add_file("/DCIM/C.JPG", b"c" * 10)
+        report = sync.down_by_all(remote_dir="/DCIM", local_dir=str(local_dir),
+                                  url=card.url, journal=log)
+        assert sorted(f.filename for f in report.synced) == ["A.JPG",
+                                                             "C.JPG"]
+        assert [f.filename for f in report.skipped] == ["B.JPG"]
+        assert card.requests["file"] == 4
+        other_dir = tmpdir.mkdir("other")
+        report = sync.down_by_all(remote_dir="/DCIM", local_dir=str(other_dir),
+                                  url=card.url, journal=log)
+        assert len(report.synced) == 3 and not report.skipped
+    assert sorted(os.listdir(str(other_dir))) == ["A.JPG", "B.JPG", "C.JPG"]
+
+
+def test_sync_once_after_watch_downloads_ignored_files(tmpdir):
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    with emulator.Emulator(str(card_dir)) as card, \
+            journal.Journal(str(tmpdir.join("journal.sqlite"))) as log:
+        card.add_file("/DCIM/A.JPG", b"a" * 10)
+        card.add_file("/DCIM/B.JPG", b"b" * 10)
+        files = set(command.list_files(remote_dir="/DCIM", url=card.url))
+        # --sync-forever ignores what's already on the card...
+        assert log.resume(card.url, sync.Direction.down, "/DCIM",
+                          files, str(local_dir)) == files
+        # ...but --sync-once all still has to download it
+        report = sync.down_by_all(remote_dir="/DCIM", local_dir=str(local_dir),
+                                  url=card.url, journal=log)
+    assert sorted(f.filename for f in report.synced) == ["A.JPG", "B.JPG"]
+    assert not report.skipped
+    assert sorted(os.listdir(str(local_dir))) == ["A.JPG", "B.JPG"]
+
+
+def test_digest_blocks_ignore_chunking(tmpdir):
+    data = bytes(range(256)) * 40  # 10240 bytes
+    path = str(tmpdir.join("data"))
+    with open(path, "wb") as f:
+        f.write(data)
+    for algorithm in ("crc32", "blake2b"):
+        whole = checksum.file_digest(path, algorithm, block_size=4096)
+        chunked = checksum.Digest(algorithm, block_size=4096)
+        for n in range(0, len(data), 1000):
+            chunked.update(data[n:n + 1000])
+        assert chunked.hexdigest() == whole.hexdigest()
+        assert chunked.block_digests() == whole.block_digests()
+        assert len(whole.block_digests()) == 3  # the last block is short
+        assert whole.nbytes == len(data)
+    assert checksum.file_digest(path).hexdigest() == \
+        "{:08x}".format(zlib.crc32(data))
+    with pytest.raises(ValueError):
+        checksum.Digest("md4")
+
+
+def test_resumed_download_digest_covers_whole_file(tmpdir):
+    local_name = str(tmpdir.join("IMG_0001.JPG"))
+    data = b"0123456789" * 10
+    fileinfo = info.FileInfo("/DCIM", "IMG_0001.JPG", "/DCIM/IMG_0001.JPG",
+                             len(data), None, arrow.get(2016, 1, 2, 3, 4, 6))
+    part_name = local_name + sync.PART_SUFFIX
+    sync._resume_offset(part_name, fileinfo)
+    with open(part_name, "wb") as part:
+        part.write(data[:40])
+    digest = checksum.Digest(block_size=64)
+    response = _FakeResponse(206, data[40:], {"Content-Range": "bytes 40-99/100"})
+    sync._write_file_safely(local_name, fileinfo, response, 40, digest=digest)
+    assert digest.hexdigest() == "{:08x}".format(zlib.crc32(data))
+    assert len(digest.block_digests()) == 2
+
+    with pytest.raises(requests.RequestException):  # cut short
+        sync._write_file_safely(local_name, fileinfo,
+                                _FakeResponse(200, data[:60]))
+
+
+class _FakeRaw:
+    def __init__(self, content):
+        self._fp = io.BytesIO(content)
+        self.released = False
+
+    def release_conn(self):
+        self.released = True
+
+
+class _FakeRawResponse(_FakeResponse):
+    def __init__(self, status_code, content, headers=None):
+        super().__init__(status_code, content, headers)
+        self.raw = _FakeRaw(content)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_short_readinto_body_is_not_renamed(tmpdir):
+    local_name = str(tmpdir.join("IMG_0001.JPG"))
+    data = b"0123456789" * 10
+    fileinfo = info.FileInfo("/DCIM", "IMG_0001.JPG", "/DCIM/IMG_0001.JPG",
+                             len(data), None, arrow.get(2016, 1, 2, 3, 4, 6))
+    response = _FakeRawResponse(200, data[:60])
+    with pytest.raises(requests.RequestException):
+        sync._write_file_safely(local_name, fileinfo, response)
+    assert not os.path.exists(local_name)
+    assert response.closed and not response.raw.released
+
+    response = _FakeRawResponse(200, data)
+    sync._write_file_safely(local_name, fileinfo, response)
+    assert response.raw.released and not response.closed
+    with open(local_name, "rb") as local:
+        assert local.read() == data
+
+
+def test_read_range_skips_ahead_when_range_is_ignored(monkeypatch):
+    data = bytes(range(256)) * 10
+    reads = []
+
+    class _Body(io.BytesIO):
+        def read(self, n=-1):
+            reads.append(n)
+            return super().read(n)
+
+    class _Ignored(_FakeResponse):
+        raw = _Body(data)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            pass
+
+    monkeypatch.setattr(cgi, "send", lambda *a, **kw: _Ignored(200, data))
+    assert checksum._read_range("/DCIM/A.JPG", 2000, 100) == data[2000:2100]
+    del reads[:]
+    assert checksum._skip(_Body(data), 1000, chunk_size=256)
+    assert reads == [256, 256, 256, 232]  # streamed, not read in one go
+    assert not checksum._skip(_Body(data), 5000)
+
+
+def test_checksums_recorded_and_verified(tmpdir):
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    data = bytes(range(256)) * 4000
+    with emulator.Emulator(str(card_dir)) as card, \
+            journal.Journal(str(tmpdir.join("journal.sqlite")),
+                            checksum="blake2b") as log:
+        card.add_file("/DCIM/A.JPG", data)
+        card.add_file("/DCIM/B.JPG", data[::-1])
+        sync.down_by_all(remote_dir="/DCIM", local_dir=str(local_dir),
+                         url=card.url, journal=log)
+        records = log.checksums(log.card_id(card.url))
+        assert [r.remote_path for r in records] == ["/DCIM/A.JPG",
+                                                    "/DCIM/B.JPG"]
+        assert records[0].digest == checksum.file_digest(
+            str(local_dir.join("A.JPG")), "blake2b").hexdigest()
+        assert len(records[0].blocks) == 4  # 1,024,000 bytes in 256 KiB
+
+        card.requests.clear()
+        results = list(checksum.verify(log, card.url, local=False))
+        assert all(v.ok for v in results)
+        assert card.requests["file"] == 4  # first and last block of each
+
+        # same size, different content: only a checksum notices
+        with open(card.local_path("/DCIM/A.JPG"), "r+b") as remote:
+            remote.write(b"x" * 10)
+        local_dir.join("B.JPG").write_binary(data)
+        a, b = checksum.verify(log, card.url)
+        assert a.ok is False and "remote block 0" in a.problem
+        assert b.ok is False and "local blake2b" in b.problem
+        card.remove_file("/DCIM/B.JPG")
+        assert not checksum.check(b.record, card.url, local=False).ok
+
+
+def test_upload_checksums_verified_remotely(tmpdir):
+    digest = checksum.Digest()
+    with upload.MultipartFile("README.md", digest=digest) as body:
+        b"".join(body)
+    assert digest.hexdigest() == checksum.file_digest("README.md").hexdigest()
+
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    done = []
+    with emulator.Emulator(str(card_dir)) as card, \
+            journal.Journal(":memory:", checksum="crc32") as log:
+        pipeline = sync.Pipeline(
+            direction=sync.Direction.up, remote_dir="/DCIM",
+            local_dir=str(local_dir), url=card.url, journal=log,
+            scheduler=poll.PollScheduler(0.01, 0.05), on_transfer=done.append)
+        with pipeline:
+            _wait_until(lambda: pipeline.scheduler.polls)
+            local_dir.join("A.JPG").write_binary(b"a" * 300000)
+            _wait_until(lambda: len(done) == 1)
+        record, = log.checksums(log.card_id(card.url))
+        assert record.direction == "upload"
+        assert record.remote_path == "/DCIM/A.JPG"
+        assert checksum.check(record, card.url, local=False).ok
+
+        local_dir.join("B.JPG").write_binary(b"b" * 1000)
+        sync.up_by_all(local_dir=str(local_dir), remote_dir="/DCIM",
+                       url=card.url, journal=log)  # A.JPG is skipped
+        records = log.checksums(log.card_id(card.url))
+        assert [r.remote_path for r in records] == ["/DCIM/A.JPG",
+                                                    "/DCIM/B.JPG"]
+        assert all(checksum.check(r, card.url).ok for r in records)
+        assert len(log.keys(log.card_id(card.url), sync.Direction.up,
+                            str(local_dir))) == 2
+
+
+def test_checksum_samples_include_last_block():
+    assert checksum._sample_blocks(0, 1) == []
+    assert checksum._sample_blocks(1, 1) == [0]
+    assert checksum._sample_blocks(4, 1) == [0, 3]
+    assert checksum._sample_blocks(4, 3) in ([0, 1, 3], [0, 2, 3])
+    assert checksum._sample_blocks(4, 10) == [0, 1, 2, 3]
+
+
+def test_plan_down_uses_one_directory_scan(tmpdir, monkeypatch):
+    tmpdir.join("SAME.JPG").write_binary(b"s" * 10)
+    tmpdir.join("OTHER.JPG").write_binary(b"o" * 5)
+    tmpdir.join("NEW.JPG.part").write_binary(b"n")
+    for i in range(20):
+        tmpdir.join("OLD{:d}.JPG".format(i)).write_binary(b"x")
+    remote = [info.RawFileInfo("/DCIM", name, "/DCIM/" + name, 10)
+              for name in ("SAME.JPG", "OTHER.JPG", "NEW.JPG")]
+    stats = []
+    real_stat = os.stat
+    monkeypatch.setattr(os, "stat",
+                        lambda path, **kw: stats.append(path) or
+                        real_stat(path, **kw))
+    snapshot = sync.LocalSnapshot()
+    plan = sync.plan_down(remote, str(tmpdir), snapshot=snapshot)
+    assert [[f.filename for f in files] for files in plan] == [
+        ["NEW.JPG"], ["OTHER.JPG"], ["SAME.JPG"]]
+    # only the local files that are also on the card get stat'ed
+    assert sorted(os.path.basename(p) for p in stats) == ["OTHER.JPG",
+                                                          "SAME.JPG"]
+    tmpdir.join("NEW.JPG").write_binary(b"n" * 10)
+    snapshot.refresh(str(tmpdir.join("NEW.JPG")))
+    assert snapshot.get(str(tmpdir), "NEW.JPG").size == 10
+    tmpdir.join("SAME.JPG").remove()
+    snapshot.refresh(str(tmpdir.join("SAME.JPG")))
+    plan = sync.plan_down(remote, str(tmpdir), snapshot=snapshot)
+    assert [f.filename for f in plan.download] == ["SAME.JPG"]
+    assert [f.filename for f in plan.skip] == ["NEW.JPG"]
+
+
+def test_down_by_files_replaces_and_skips(tmpdir):
+    card_dir, local_dir = tmpdir.mkdir("card"), tmpdir.mkdir("local")
+    local_dir.join("SAME.JPG").write_binary(b"s" * 10)
+    local_dir.join("OTHER.JPG").write_binary(b"x")
+    with emulator.Emulator(str(card_dir)) as card:
+        for name in ("SAME.JPG", "OTHER.JPG", "NEW.JPG"):
+            card.add_file("/DCIM/" + name, name[0].encode() * 10)
+        files = list(command.list_files(remote_dir="/DCIM", url=card.url))
+        snapshot = sync.LocalSnapshot()
+        report = sync.down_by_files(files, str(local_dir), url=card.url,
+                                    snapshot=snapshot)
+        assert card.requests["file"] == 2
+    assert sorted(f.filename for f in report.synced) == ["NEW.JPG",
+                                                         "OTHER.JPG"]
+    assert [f.filename for f in report.skipped] == ["SAME.JPG"]
+    assert local_dir.join("OTHER.JPG").read_binary() == b"O" * 10
+    assert not sync.plan_down(files, str(local_dir), snapshot=snapshot).download
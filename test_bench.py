@@ -0,0 +1,56 @@
+"""Quick runs of the emulator benchmarks in `tfatool.bench`.
+
+For real numbers, run `flashair-util bench suite -o results.json`."""
+
+import json
+
+from tfatool import bench
+
+
+def test_listing_rates():
+    rates = bench.listing_rates(200)
+    assert set(rates) == {"parse", "parse raw", "list over HTTP"}
+    assert all(rate > 0 for rate in rates.values())
+
+
+def test_transfer_rates(monkeypatch):
+    monkeypatch.setitem(bench.SIZE_MIXES, "tiny", [(3, 1000), (1, 100000)])
+    results = bench.transfer_rates("tiny", workers=2)
+    assert results["files"] == 4
+    assert results["download MB/s"] > 0 and results["upload MB/s"] > 0
+    # one listing, then one GET per file
+    assert results["download requests/file"] == (1 + 4) / 4
+    # one listing and 3 upload.cgi setup calls, then FTIME + POST per file
+    assert results["upload requests/file"] == (4 + 2 * 4) / 4
+
+
+def test_watcher_idle_cpu():
+    results = bench.watcher_idle_cpu(0.3, min_poll=0.05, max_poll=0.1)
+    assert results["remote polls"] >= 2
+    assert results["local polls"] >= 2
+
+
+def test_time_to_first_byte():
+    results = bench.time_to_first_byte(samples=2, idle=0.1, size=1000,
+                                       min_poll=0.01, max_poll=0.05)
+    assert 0 < results["min s"] <= results["max s"] < 5
+
+
+def test_json_output(tmpdir):
+    out = str(tmpdir.join("bench.json"))
+    bench.main(["-o", out, "listing", "-n", "50", "--latency", "0.001"])
+    with open(out) as f:
+        record = json.load(f)
+    assert record["benchmark"] == "listing"
+    assert record["params"]["n_files"] == 50
+    assert record["params"]["latency"] == 0.001
+    assert record["results"]["listing rows/s"]["parse"] > 0
+
+
+def test_write_path_rates():
+    results = bench.write_path_rates(size=2 * 10**6, chunk_size=64 * 1024)
+    assert results["readinto MB/s"] > 0 and results["iter_content MB/s"] > 0
+    # a new bytes object per chunk vs. at most one reusable buffer
+    chunks = 2 * 10**6 / (64 * 1024)
+    assert results["iter_content allocations/GB"] >= chunks * 500
+    assert results["readinto allocations/GB"] <= 500
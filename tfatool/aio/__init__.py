@@ -0,0 +1,12 @@
+"""asyncio versions of `tfatool.command`, `tfatool.upload` and
+`tfatool.sync`, built on a small HTTP client from the standard library.
+
+>>> from tfatool import aio
+>>> async def main():
+...     files = await aio.command.list_files(remote_dir="/DCIM")
+...     async for _, new_files in aio.sync.down_by_arrival(local_dir="."):
+...         ...
+...     await aio.cgi.close_clients()
+"""
+
+from . import cgi, command, upload, sync
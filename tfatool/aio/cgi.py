@@ -0,0 +1,316 @@
+"""A small asyncio HTTP/1.1 client for talking to FlashAir.
+
+FlashAir's web server speaks plain HTTP/1.1, so the standard library's
+asyncio streams are all that's needed. `Client` keeps keep-alive
+connections to one card and serves at most `max_connections` requests
+at a time; other requests wait for a free connection."""
+
+import asyncio
+import logging
+import time
+import weakref
+
+from urllib.parse import quote, urlencode, urljoin, urlsplit
+
+from requests import RequestException
+
+from .. import cgi, trace
+from ..cgi import Entrypoint, DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT
+from ..info import URL
+
+
+logger = logging.getLogger(__name__)
+
+
+class RequestError(RequestException):
+    """Raised when FlashAir can't be reached or doesn't answer in time"""
+
+
+class Client:
+    """Sends requests to the card at `url`. `timeout` is a (connect, read)
+    pair of seconds, like `cgi.SessionPool`'s."""
+
+    def __init__(self, url=URL, max_connections=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT):
+        parts = urlsplit(url)
+        self.url = "{}://{}/".format(parts.scheme, parts.netloc)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.netloc = parts.netloc
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(max_connections)
+        self._idle = []
+
+    async def request(self, method, path, params=None, headers=None,
+                      body=None):
+        """Sends a request and returns a `Response` once its headers have
+        arrived. `body` is bytes or an iterable of bytes chunks with a
+        length (like `upload.MultipartFile`). The response holds one
+        of the client's connections until its body has been read or it's
+        released."""
+        target = quote(urljoin("/", path), safe="/%")
+        if params:
+            target += "?" + urlencode(params)
+        url = urljoin(self.url, target)
+        start = time.perf_counter()
+        await self._slots.acquire()
+        try:
+            with trace.span("aio.send", url=url) as span:
+                reader, writer, status, response_headers = await self._send(
+                    method, target, headers, body)
+                span.add(requests=1)
+                span.set(status=status)
+        except BaseException as e:
+            self._slots.release()
+            if not isinstance(e, asyncio.CancelledError):
+                self._observe(method, url, start, None, None, body)
+            raise
+        self._observe(method, url, start, status, response_headers, body)
+        return Response(self, reader, writer, method, status,
+                        response_headers, on_release=self._slots.release)
+
+    async def _send(self, method, target, headers, body):
+        head = ["{} {} HTTP/1.1".format(method, target),
+                "Host: {}".format(self.netloc),
+                "User-Agent: tfatool",
+                "Accept-Encoding: identity"]
+        for key, value in (headers or {}).items():
+            head.append("{}: {}".format(key, value))
+        if body is not None:
+            head.append("Content-Length: {:d}".format(len(body)))
+        head = ("\r\n".join(head) + "\r\n\r\n").encode("latin-1")
+        # a pooled connection may have been closed by the card meanwhile;
+        # that's only safe to retry if the body can be sent again
+        replayable = body is None or isinstance(body, bytes)
+        while True:
+            reused = bool(self._idle) and replayable
+            reader, writer = (self._idle.pop() if reused
+                              else await self._connect())
+            try:
+                writer.write(head)
+                if isinstance(body, bytes):
+                    writer.write(body)
+                elif body is not None:
+                    # chunks are read from disk on the default executor
+                    chunks = iter(body)
+                    chunk = await _next_chunk(chunks)
+                    while chunk is not None:
+                        writer.write(chunk)
+                        await self._wait(writer.drain())
+                        chunk = await _next_chunk(chunks)
+                await self._wait(writer.drain())
+                status, response_headers = await self._read_head(reader)
+            except (OSError, asyncio.IncompleteReadError, RequestError) as e:
+                writer.close()
+                if reused:
+                    continue
+                if isinstance(e, RequestError):
+                    raise
+                raise RequestError("{}: {}".format(self.url, e)) from e
+            except BaseException:
+                writer.close()
+                raise
+            return reader, writer, status, response_headers
+
+    async def _connect(self):
+        try:
+            return await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port),
+                self.timeout[0])
+        except asyncio.TimeoutError as e:
+            raise RequestError("Timed out connecting to {}".format(
+                               self.url)) from e
+        except OSError as e:
+            raise RequestError("{}: {}".format(self.url, e)) from e
+
+    async def _wait(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout[1])
+        except asyncio.TimeoutError as e:
+            raise RequestError("Timed out waiting for {}".format(
+                               self.url)) from e
+
+    async def _read_head(self, reader):
+        line = await self._wait(reader.readline())
+        if not line:
+            raise asyncio.IncompleteReadError(line, None)
+        # the reason phrase is optional: "HTTP/1.1 200" is a valid status line
+        fields = line.decode("latin-1").split(None, 2)
+        if len(fields) < 2 or not fields[1].isdigit():
+            raise RequestError("Bad status line {!r}".format(line))
+        status = fields[1]
+        headers = {}
+        while True:
+            line = await self._wait(reader.readline())
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        return int(status), headers
+
+    def _reuse(self, reader, writer):
+        self._idle.append((reader, writer))
+
+    def _observe(self, method, url, start, status, headers, body):
+        entrypoint, operation = cgi.request_labels(method, url)
+        bytes_in = int((headers or {}).get("content-length", 0))
+        cgi.metrics.observe(entrypoint, operation, time.perf_counter() - start,
+                            status, len(body) if body is not None else 0,
+                            bytes_in)
+
+    async def get(self, entrypoint: Entrypoint, **params):
+        """GETs a CGI `entrypoint`. Returns the status code and the
+        response body decoded as text."""
+        response = await self.request("GET", entrypoint.value, params)
+        return response.status, await response.text()
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+class Response:
+    """A response whose body is read on demand. Reading the whole body
+    (or calling `release`) returns the connection to its client."""
+
+    def __init__(self, client, reader, writer, method, status, headers,
+                 on_release=None):
+        self.status = status
+        self.headers = headers
+        self._client = client
+        self._reader = reader
+        self._writer = writer
+        self._on_release = on_release
+        self._chunked = headers.get("transfer-encoding", "") == "chunked"
+        self._remaining = None  # bytes left in the body or current chunk
+        self._done = False
+        if method == "HEAD" or status in (204, 304):
+            self._remaining = 0
+        elif not self._chunked and "content-length" in headers:
+            self._remaining = int(headers["content-length"])
+        if self._remaining == 0:
+            self._finish()
+
+    async def iter_chunks(self, chunk_size=64 * 1024):
+        """Yields the body in chunks of up to `chunk_size` bytes"""
+        try:
+            while not self._done:
+                chunk = await self._read_chunk(chunk_size)
+                if chunk:
+                    yield chunk
+        finally:
+            self.release()
+
+    async def iter_lines(self, chunk_size=64 * 1024, encoding="utf-8"):
+        """Yields the body as decoded lines, without line endings"""
+        pending = b""
+        async for chunk in self.iter_chunks(chunk_size):
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line.rstrip(b"\r").decode(encoding)
+        if pending:
+            yield pending.rstrip(b"\r").decode(encoding)
+
+    async def read(self):
+        chunks = []
+        async for chunk in self.iter_chunks():
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    async def text(self, encoding="utf-8"):
+        return (await self.read()).decode(encoding)
+
+    async def _read_chunk(self, size):
+        wait = self._client._wait
+        if self._chunked:
+            if not self._remaining:
+                line = await wait(self._reader.readline())
+                self._remaining = int(line.split(b";")[0], 16)
+                if self._remaining == 0:
+                    while (await wait(self._reader.readline())) not in (
+                            b"\r\n", b"\n", b""):
+                        pass  # trailers
+                    self._finish()
+                    return b""
+            chunk = await wait(self._reader.read(min(size, self._remaining)))
+            if not chunk:
+                raise RequestError("Connection closed mid-response")
+            self._remaining -= len(chunk)
+            if not self._remaining:
+                await wait(self._reader.readline())  # CRLF after the chunk
+            return chunk
+        if self._remaining is None:  # body ends when the connection does
+            chunk = await wait(self._reader.read(size))
+            if not chunk:
+                self._done = True
+                self.release()
+            return chunk
+        chunk = await wait(self._reader.read(min(size, self._remaining)))
+        if not chunk:
+            raise RequestError("Connection closed mid-response")
+        self._remaining -= len(chunk)
+        if not self._remaining:
+            self._finish()
+        return chunk
+
+    def _finish(self):
+        """The body has been read completely; the connection can be reused"""
+        self._done = True
+        if self.headers.get("connection", "").lower() != "close":
+            self._client._reuse(self._reader, self._writer)
+            self._writer = None
+        self.release()
+
+    def release(self):
+        """Gives up the response's connection. A connection whose body
+        hasn't been read completely is closed rather than reused."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._done = True
+        if self._on_release is not None:
+            on_release, self._on_release = self._on_release, None
+            on_release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+_clients = weakref.WeakKeyDictionary()  # event loop: {base URL: Client}
+
+
+def client(url=URL):
+    """Returns the running event loop's shared `Client` for the card at
+    `url`, creating it on first use. Close them with `close_clients`."""
+    loop = asyncio.get_running_loop()
+    clients = _clients.setdefault(loop, {})
+    parts = urlsplit(url)
+    base = "{}://{}/".format(parts.scheme, parts.netloc)
+    if base not in clients:
+        clients[base] = Client(base)
+    return clients[base]
+
+
+async def close_clients():
+    """Closes the shared clients of the running event loop"""
+    clients = _clients.pop(asyncio.get_running_loop(), {})
+    for each in clients.values():
+        await each.close()
+
+
+async def _next_chunk(chunks):
+    """Reads the next chunk of a request body on the loop's default
+    executor. Returns None once it's used up."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, next, chunks, None)
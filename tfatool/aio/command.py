@@ -0,0 +1,59 @@
+"""Async versions of the `tfatool.command` listing and status calls"""
+
+from .. import command, trace
+from ..cgi import Entrypoint
+from ..info import URL, DEFAULT_REMOTE_DIR, Operation
+from .cgi import client
+
+
+async def list_files(*filters, remote_dir=DEFAULT_REMOTE_DIR, url=URL):
+    """Like `command.list_files`, but returns a list. Rows are parsed
+    and filtered as the listing arrives."""
+    return await _list(command._split_file_list, filters, remote_dir, url)
+
+
+async def list_files_raw(*filters, remote_dir=DEFAULT_REMOTE_DIR, url=URL):
+    return await _list(command._split_file_list_raw, filters, remote_dir, url)
+
+
+async def map_files(*filters, remote_dir=DEFAULT_REMOTE_DIR, url=URL):
+    files = await list_files(*filters, remote_dir=remote_dir, url=url)
+    return {f.filename: f for f in files}
+
+
+async def map_files_raw(*filters, remote_dir=DEFAULT_REMOTE_DIR, url=URL):
+    files = await list_files_raw(*filters, remote_dir=remote_dir, url=url)
+    return {f.filename: f for f in files}
+
+
+async def count_files(remote_dir=DEFAULT_REMOTE_DIR, url=URL):
+    return int(await _get(Operation.count_files, url, DIR=remote_dir))
+
+
+async def memory_changed(url=URL):
+    """Returns True if memory has been written to, False otherwise"""
+    text = await _get(Operation.memory_changed, url)
+    try:
+        return int(text) == 1
+    except ValueError:
+        raise IOError("Likely no FlashAir connection, "
+                      "memory changed CGI command failed")
+
+
+async def _list(split_file_list, filters, remote_dir, url):
+    params = dict(op=int(Operation.list_files), DIR=remote_dir)
+    with trace.span("command.list_files"):
+        response = await client(url).request(
+            "GET", Entrypoint.command.value, params)
+        files = []
+        async with response:
+            async for line in response.iter_lines():
+                files.extend(split_file_list([line], *filters))
+    return files
+
+
+async def _get(operation: Operation, url=URL, **params):
+    params.update(op=int(operation))
+    with trace.span("command." + operation.name):
+        _, text = await client(url).get(Entrypoint.command, **params)
+    return text
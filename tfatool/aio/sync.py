@@ -0,0 +1,289 @@
+"""Async versions of the `tfatool.sync` transfers and watcher-generators.
+
+Transfers run concurrently, at most `workers` at a time. If the task
+running a batch is cancelled, the batch's transfers are cancelled and
+awaited before the cancellation propagates, so no transfer outlives
+its batch. Interrupted downloads leave resumable ".part" files, just
+like `tfatool.sync`'s. Disk I/O (stats, reads, writes, renames and
+directory scans) runs on the loop's default executor, so a slow disk
+doesn't stall the event loop."""
+
+import asyncio
+import logging
+import os
+import time
+
+from functools import partial
+from pathlib import Path, PurePosixPath
+
+from requests import RequestException
+
+from .. import sync, trace
+from ..info import URL, DEFAULT_REMOTE_DIR
+from ..sync import Direction, SyncReport, DEFAULT_WORKERS, PART_SUFFIX
+from ..sync import list_local_files
+from . import command, upload
+from .cgi import client
+
+
+logger = logging.getLogger(__name__)
+
+
+########################################
+# Sync ONCE in the DOWN (from FlashAir) direction
+
+async def down_by_all(*filters, remote_dir=DEFAULT_REMOTE_DIR, local_dir=".",
+                      url=URL, workers=DEFAULT_WORKERS, fsync_policy=None):
+    files = await command.list_files(*filters, remote_dir=remote_dir, url=url)
+    return await down_by_files(files, local_dir=local_dir, url=url,
+                               workers=workers, fsync_policy=fsync_policy)
+
+
+async def down_by_files(to_sync, local_dir=".", url=URL,
+                        workers=DEFAULT_WORKERS, fsync_policy=None):
+    """Downloads the given remote files to `local_dir`, up to `workers` at
+    a time. Returns a `sync.SyncReport`. Finished files are committed with
+    `fsync_policy`, by default a batching `sync.FsyncPolicy` that's
+    flushed before returning."""
+    start = time.time()
+    if fsync_policy is None:
+        fsync_policy = sync.FsyncPolicy()
+    try:
+        results = await _run_bounded(
+            [download_file(f, local_dir, url, fsync_policy) for f in to_sync],
+            workers)
+    finally:
+        await _blocking(fsync_policy.flush)
+    synced, skipped, failed = [], [], []
+    for fileinfo, result in zip(to_sync, results):
+        if isinstance(result, BaseException):
+            logger.error("Failed to sync {}: {}({})".format(
+                         fileinfo.filename, result.__class__.__name__, result))
+            failed.append((fileinfo, result))
+        else:
+            (synced if result else skipped).append(fileinfo)
+    nbytes = sum(f.size for f in synced)
+    report = SyncReport(synced, skipped, failed, nbytes, time.time() - start)
+    sync._notify_report(Direction.down, report)
+    return report
+
+
+async def download_file(fileinfo, local_dir=".", url=URL, fsync_policy=None):
+    """Copies a remote file to `local_dir` unless an identically sized
+    copy is already there. Returns True if the file was transferred.
+    Without an `fsync_policy`, the file is fsynced before it's renamed."""
+    local_name = str(Path(local_dir, fileinfo.filename))
+    try:
+        local_size = (await _blocking(os.stat, local_name)).st_size
+    except OSError:
+        pass
+    else:
+        if local_size == fileinfo.size:
+            logger.info("Skipping '{}': already exists locally".format(
+                        local_name))
+            return False
+        logger.warning("Removing {}: local size {} != remote size {}".format(
+                       local_name, local_size, fileinfo.size))
+        await _blocking(os.remove, local_name)
+    part_name = local_name + PART_SUFFIX
+    offset = await _blocking(sync._resume_offset, part_name, fileinfo)
+    if offset < fileinfo.size:
+        await _stream_to_file(part_name, fileinfo, offset, url)
+    await _blocking(sync._finish_part_file, part_name, local_name,
+                    fsync_policy)
+    return True
+
+
+async def _stream_to_file(part_name, fileinfo, offset, url):
+    """Appends the rest of a remote file to `part_name`, or rewrites it
+    if the card ignores the Range header. A body that ends short of
+    `fileinfo.size` raises an error and leaves the part to resume."""
+    headers = {"Range": "bytes={:d}-".format(offset)} if offset else None
+    response = await client(url).request("GET", fileinfo.path,
+                                         headers=headers)
+    async with response:
+        content_range = response.headers.get("content-range", "")
+        if response.status == 206 and content_range.startswith(
+                "bytes {:d}-".format(offset)):
+            mode, done = "ab", offset
+        elif response.status == 200:
+            mode, done = "wb", 0
+        else:
+            raise RequestException("Expected status code 200 or 206, "
+                                   "got {:d}".format(response.status))
+        with trace.span("sync.write_file", file=fileinfo.filename) as span:
+            outfile = await _blocking(open, part_name, mode)
+            try:
+                async for chunk in response.iter_chunks(5 * 10**5):
+                    await _blocking(outfile.write, chunk)
+                    done += len(chunk)
+                    span.add(bytes=len(chunk))
+            finally:
+                await _blocking(outfile.close)
+    if done != fileinfo.size:
+        raise RequestException("Got {:d} of {:d} bytes of {}".format(
+                               done, fileinfo.size, fileinfo.filename))
+
+
+######################################################
+# Sync ONCE in the UP direction (to FlashAir)
+
+async def up_by_all(*filters, local_dir=".", remote_dir=DEFAULT_REMOTE_DIR,
+                    url=URL):
+    files = await _blocking(partial(_local_file_list, *filters,
+                                    local_dir=local_dir))
+    await up_by_files(files, remote_dir=remote_dir, url=url)
+
+
+async def up_by_files(to_sync, remote_dir=DEFAULT_REMOTE_DIR,
+                      remote_files=None, url=URL):
+    """Uploads the given local files that aren't already on the card.
+    FlashAir has a single upload directory setting, so uploads
+    go one at a time."""
+    if remote_files is None:
+        remote_files = await command.map_files_raw(remote_dir=remote_dir,
+                                                   url=url)
+    async with upload.UploadSession(remote_dir, url=url) as session:
+        for local_file in to_sync:
+            remote_file = remote_files.get(local_file.filename)
+            if remote_file is not None:
+                if remote_file.size == local_file.size:
+                    logger.info("Skipping '{}' already exists on "
+                                "SD card".format(local_file.filename))
+                    continue
+                await session.delete(remote_file.path)
+            await _upload_file_safely(local_file, session)
+
+
+async def _upload_file_safely(fileinfo, session):
+    """Uploads a local file, removing the partial remote file if the
+    upload fails or is cancelled"""
+    logger.info("Uploading local file {} to {}".format(
+                fileinfo.path, session.remote_dir))
+    try:
+        await session.upload(fileinfo.path)
+    except BaseException as e:
+        logger.warning("{} interrupted writing {} -- "
+                       "cleaning up partial remote file".format(
+                       e.__class__.__name__, fileinfo.path))
+        remote_path = str(PurePosixPath(session.remote_dir, fileinfo.filename))
+        cleanup = asyncio.ensure_future(session.delete(remote_path))
+        try:
+            await asyncio.shield(cleanup)
+        except Exception:
+            pass
+        raise
+
+
+###########################################
+# Local and remote file watcher-generators
+
+async def watch_remote_files(*filters, remote_dir=".", url=URL,
+                             scheduler=None):
+    """Async generator of (new files, all files) set pairs for FlashAir's
+    `remote_dir`, like `sync.watch_remote_files`"""
+    await command.memory_changed(url=url)  # clear change status to start
+    old_files = new_files = set(await command.list_files(
+        *filters, remote_dir=remote_dir, url=url))
+    while True:
+        yield new_files - old_files, new_files
+        old_files = new_files
+        if scheduler:
+            await asyncio.sleep(scheduler.interval)
+        with trace.span("watch.remote_poll") as span:
+            changed = await command.memory_changed(url=url)
+            if changed:
+                new_files = set(await command.list_files(
+                    *filters, remote_dir=remote_dir, url=url))
+            span.set(changed=changed)
+        if scheduler:
+            scheduler.record(changed)
+
+
+async def watch_local_files(*filters, local_dir=".", scheduler=None):
+    """Async generator of (new files, all files) set pairs for
+    `local_dir`. The directory is rescanned on every iteration."""
+    scan = partial(_local_file_set, *filters, local_dir=local_dir)
+    old_files = new_files = await _blocking(scan)
+    while True:
+        yield new_files - old_files, new_files
+        old_files = new_files
+        if scheduler:
+            await asyncio.sleep(scheduler.interval)
+        with trace.span("watch.local_poll"):
+            new_files = await _blocking(scan)
+        if scheduler:
+            scheduler.record(new_files != old_files)
+
+
+async def down_by_arrival(*filters, local_dir=".",
+                          remote_dir=DEFAULT_REMOTE_DIR, url=URL,
+                          workers=DEFAULT_WORKERS, scheduler=None):
+    """Async generator of (Direction.down, {...}) tuples, like
+    `sync.down_by_arrival`. It yields AFTER each download."""
+    remote_monitor = watch_remote_files(*filters, remote_dir=remote_dir,
+                                        url=url, scheduler=scheduler)
+    try:
+        _, file_set = await remote_monitor.__anext__()
+        sync._notify_sync_ready(len(file_set), remote_dir, local_dir)
+        async for new_arrivals, file_set in remote_monitor:
+            if new_arrivals:
+                sync._notify_sync(Direction.down, new_arrivals)
+                await down_by_files(list(new_arrivals), local_dir, url=url,
+                                    workers=workers)
+                sync._notify_sync_ready(len(file_set), remote_dir, local_dir)
+            yield Direction.down, new_arrivals
+    finally:
+        await remote_monitor.aclose()
+
+
+async def up_by_arrival(*filters, local_dir=".", remote_dir=DEFAULT_REMOTE_DIR,
+                        url=URL, scheduler=None):
+    """Async generator of (Direction.up, {...}) tuples, like
+    `sync.up_by_arrival`. It yields BEFORE each upload."""
+    local_monitor = watch_local_files(*filters, local_dir=local_dir,
+                                      scheduler=scheduler)
+    try:
+        _, file_set = await local_monitor.__anext__()
+        sync._notify_sync_ready(len(file_set), local_dir, remote_dir)
+        async for new_arrivals, file_set in local_monitor:
+            yield Direction.up, new_arrivals
+            if new_arrivals:
+                sync._notify_sync(Direction.up, new_arrivals)
+                await up_by_files(new_arrivals, remote_dir, url=url)
+                sync._notify_sync_ready(len(file_set), local_dir, remote_dir)
+    finally:
+        await local_monitor.aclose()
+
+
+def _local_file_list(*filters, local_dir="."):
+    return list(list_local_files(*filters, local_dir=local_dir))
+
+
+def _local_file_set(*filters, local_dir="."):
+    return set(list_local_files(*filters, local_dir=local_dir))
+
+
+async def _blocking(func, *args):
+    """Calls `func(*args)` on the loop's default executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(func, *args))
+
+
+async def _run_bounded(coros, limit):
+    """Runs `coros` concurrently, at most `limit` at a time. Returns their
+    results in order, with exceptions in place of failed results."""
+    slots = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with slots:
+            return await coro
+
+    tasks = [asyncio.ensure_future(run(coro)) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks, return_exceptions=True)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
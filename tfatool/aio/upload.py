@@ -0,0 +1,110 @@
+"""Async versions of the `tfatool.upload` calls. Files are stat'ed,
+opened and read on the loop's default executor."""
+
+import asyncio
+import os
+
+from functools import partial
+
+from .. import fattime, trace
+from ..cgi import Entrypoint
+from ..info import DEFAULT_REMOTE_DIR, URL
+from ..info import WriteProtectMode, Upload, ResponseCode
+from ..upload import MultipartFile, UploadError, _str_encode_time
+from .cgi import client
+
+
+async def upload_file(local_path: str, url=URL, remote_dir=DEFAULT_REMOTE_DIR):
+    async with UploadSession(remote_dir, url=url) as session:
+        await session.upload(local_path)
+
+
+class UploadSession:
+    """Like `upload.UploadSession`, for use with `async with`"""
+
+    def __init__(self, remote_dir=DEFAULT_REMOTE_DIR, url=URL):
+        self.remote_dir = remote_dir
+        self.url = url
+        self.is_open = False
+        self.is_dirty = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        await set_write_protect(WriteProtectMode.on, url=self.url)
+        await set_upload_dir(self.remote_dir, url=self.url)
+        self.is_open = True
+
+    async def upload(self, local_path: str, progress=None):
+        with trace.span("upload.upload_file", file=local_path) as span:
+            if not self.is_open:
+                await self.open()
+            await set_creation_time(local_path, url=self.url)
+            self.is_dirty = True
+            nbytes = await post_file(local_path, url=self.url,
+                                     progress=progress)
+            span.add(bytes=nbytes)
+
+    async def delete(self, remote_file: str):
+        self.is_dirty = True
+        await delete_file(remote_file, url=self.url)
+
+    async def close(self):
+        if self.is_open:
+            self.is_open = False
+            await set_write_protect(WriteProtectMode.off, url=self.url)
+
+
+async def set_write_protect(mode: WriteProtectMode, url=URL):
+    await _get_success("Failed to set write protect", url,
+                       **{Upload.write_protect: mode.value})
+
+
+async def set_upload_dir(remote_dir: str, url=URL):
+    await _get_success("Failed to set upload directory", url,
+                       **{Upload.directory: remote_dir})
+
+
+async def set_creation_time(local_path: str, url=URL):
+    stat = await _blocking(os.stat, local_path)
+    fat_time = fattime.encode(stat.st_mtime)
+    await _get_success("Failed to set creation time", url,
+                       **{Upload.creation_time: _str_encode_time(fat_time)})
+
+
+async def post_file(local_path: str, url=URL, progress=None):
+    """POSTs a local file to upload.cgi, streaming it from disk.
+    Returns the size of the file."""
+    body = await _blocking(partial(MultipartFile, local_path,
+                                   progress=progress))
+    with body:
+        headers = {"Content-Type": body.content_type}
+        response = await client(url).request(
+            "POST", Entrypoint.upload.value, headers=headers, body=body)
+        text = await response.text()
+    if response.status != 200:
+        raise UploadError("Failed to post file", text)
+    return body.file_size
+
+
+async def delete_file(remote_file: str, url=URL):
+    status, text = await client(url).get(Entrypoint.upload,
+                                         **{Upload.delete.value: remote_file})
+    if status != 200:
+        raise UploadError("Failed to delete file", text)
+
+
+async def _blocking(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(func, *args))
+
+
+async def _get_success(error_msg, url, **params):
+    params = {key.value: value for key, value in params.items()}
+    _, text = await client(url).get(Entrypoint.upload, **params)
+    if text != ResponseCode.success:
+        raise UploadError(error_msg, text)
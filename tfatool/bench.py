@@ -0,0 +1,451 @@
+"""Rough performance measurements of tfatool.
+
+The "download" benchmark needs a real FlashAir card. The others run
+against `tfatool.emulator`, so they can be compared from run to run
+and from change to change (see `--output`).
+
+Run with `python -m tfatool.bench -h` or `flashair-util bench -h`
+for options."""
+
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+import arrow
+
+from . import command, fattime, sync, trace, _version
+from .emulator import Emulator
+from .info import DEFAULT_REMOTE_DIR
+from .poll import PollScheduler
+
+
+logger = logging.getLogger(__name__)
+
+
+def download_throughput(*filters, remote_dir=DEFAULT_REMOTE_DIR,
+                        worker_counts=(1, sync.DEFAULT_WORKERS)):
+    """Downloads the same set of remote files once per entry in
+    `worker_counts`, each time into a fresh temporary directory.
+    A worker count of 1 is the old one-file-at-a-time path.
+    Returns a list of (workers, `sync.SyncReport`) pairs."""
+    files = list(command.list_files(*filters, remote_dir=remote_dir))
+    results = []
+    for workers in worker_counts:
+        with tempfile.TemporaryDirectory() as local_dir:
+            report = sync.down_by_files(files, local_dir=local_dir,
+                                        workers=workers)
+        results.append((workers, report))
+    return results
+
+
+def _print_throughput(results):
+    serial_rate = None
+    for workers, report in results:
+        if workers == 1:
+            serial_rate = report.rate
+    for workers, report in results:
+        line = "{:>3d} workers: {:d} files, {:0.2f} MB in {:0.2f} s " \
+               "({:0.2f} MB/s)".format(
+               workers, len(report.synced), report.nbytes / 10**6,
+               report.duration, report.rate)
+        if serial_rate:
+            line += ", {:0.2f}x serial".format(report.rate / serial_rate)
+        if report.failed:
+            line += ", {:d} failed".format(len(report.failed))
+        print(line)
+
+
+# File size mixes for transfer benchmarks: lists of (count, size in bytes)
+SIZE_MIXES = {
+    "small": [(200, 16 * 1024)],
+    "jpeg": [(20, 3 * 10**6), (20, 5 * 10**6)],
+    "raw+jpeg": [(5, 25 * 10**6), (5, 5 * 10**6)],
+}
+
+_BENCH_DIR = "/DCIM/100__TSB"
+
+
+def listing_rates(n_files=2000, **card_options):
+    """Parses a synthetic op=100 listing of `n_files` rows in memory, then
+    lists the same files from an emulated card. Returns a dict of rows
+    per second for each method."""
+    mtime = time.time()
+    fat_date, fat_time = fattime.split(fattime.encode(mtime))
+    lines = ["{},IMG_{:05d}.JPG,{:d},32,{:d},{:d}".format(
+             _BENCH_DIR, i, 1000 + i, fat_date, fat_time)
+             for i in range(n_files)]
+    rates = {}
+    for name, parse in [("parse", command._split_file_list),
+                        ("parse raw", command._split_file_list_raw)]:
+        start = time.perf_counter()
+        assert len(list(parse(iter(lines)))) == n_files
+        rates[name] = n_files / (time.perf_counter() - start)
+    with tempfile.TemporaryDirectory() as card_dir:
+        with Emulator(card_dir, **card_options) as card:
+            for i in range(n_files):
+                card.add_file("{}/IMG_{:05d}.JPG".format(_BENCH_DIR, i),
+                              mtime=mtime)
+            start = time.perf_counter()
+            files = list(command.list_files(remote_dir=_BENCH_DIR,
+                                            url=card.url))
+            assert len(files) == n_files
+            rates["list over HTTP"] = n_files / (time.perf_counter() - start)
+    return rates
+
+
+def transfer_rates(mix="jpeg", workers=sync.DEFAULT_WORKERS, **card_options):
+    """Downloads a `SIZE_MIXES[mix]` set of files from an emulated card,
+    then uploads them back to another directory of the card. Returns
+    a dict of MB/s and HTTP requests per file for each direction."""
+    sizes = [size for count, size in SIZE_MIXES[mix] for _ in range(count)]
+    results = {"files": len(sizes), "MB": sum(sizes) / 10**6}
+    with tempfile.TemporaryDirectory() as card_dir, \
+            tempfile.TemporaryDirectory() as local_dir:
+        with Emulator(card_dir, **card_options) as card:
+            for i, size in enumerate(sizes):
+                card.add_file("{}/IMG_{:05d}.JPG".format(_BENCH_DIR, i),
+                              bytes(size))
+            card.requests.clear()
+            start = time.perf_counter()
+            report = sync.down_by_all(remote_dir=_BENCH_DIR,
+                                      local_dir=local_dir, url=card.url,
+                                      workers=workers)
+            duration = time.perf_counter() - start
+            assert not report.failed, report.failed
+            results["download MB/s"] = report.nbytes / 10**6 / duration
+            results["download requests/file"] = \
+                sum(card.requests.values()) / len(sizes)
+
+            card.requests.clear()
+            start = time.perf_counter()
+            sync.up_by_all(local_dir=local_dir, remote_dir="/UPLOAD",
+                           url=card.url)
+            duration = time.perf_counter() - start
+            results["upload MB/s"] = sum(sizes) / 10**6 / duration
+            results["upload requests/file"] = \
+                sum(card.requests.values()) / len(sizes)
+    return results
+
+
+def write_path_rates(size=200 * 10**6, chunk_size=sync.DEFAULT_CHUNK_SIZE,
+                     **card_options):
+    """Downloads one file of `size` bytes from an emulated card through
+    `response.iter_content` (the old write path) and by reading into a
+    reusable buffer (the new one). Returns a dict of MB/s and chunk
+    buffers allocated per GB for each path."""
+    results = {}
+    with tempfile.TemporaryDirectory() as card_dir, \
+            tempfile.TemporaryDirectory() as local_dir:
+        with Emulator(card_dir, **card_options) as card:
+            card.add_file("{}/IMG_00000.JPG".format(_BENCH_DIR), bytes(size))
+            fileinfo, = command.list_files(remote_dir=_BENCH_DIR,
+                                           url=card.url)
+            part_path = os.path.join(local_dir,
+                                     fileinfo.filename + sync.PART_SUFFIX)
+            for name, readinto in [("iter_content", False),
+                                   ("readinto", True)]:
+                tracer = trace.enable()
+                start = time.perf_counter()
+                try:
+                    with sync._get_file(fileinfo, url=card.url) as response:
+                        sync._write_file(part_path, fileinfo, response,
+                                         chunk_size=chunk_size,
+                                         readinto=readinto)
+                finally:
+                    trace.disable()
+                duration = time.perf_counter() - start
+                assert os.path.getsize(part_path) == size
+                os.remove(part_path)
+                if os.path.exists(sync._part_info_path(part_path)):
+                    os.remove(sync._part_info_path(part_path))
+                buffers = sum(e["args"].get("buffers", 0)
+                              for e in tracer.chrome_trace()["traceEvents"]
+                              if e["name"] == "sync.write_file")
+                results[name + " MB/s"] = size / 10**6 / duration
+                results[name + " allocations/GB"] = buffers / (size / 10**9)
+    return results
+
+
+def watcher_idle_cpu(seconds=5.0, min_poll=None, max_poll=None,
+                     **card_options):
+    """Runs the remote and the local watcher-generators for `seconds`
+    each while nothing changes. Returns a dict of the CPU time used per
+    second of wall time (in percent) and the number of polls issued.
+    The emulator runs in this process, so its CPU time counts too."""
+    scheduler_args = [arg for arg in (min_poll, max_poll) if arg is not None]
+    results = {}
+    with tempfile.TemporaryDirectory() as card_dir, \
+            tempfile.TemporaryDirectory() as local_dir:
+        with Emulator(card_dir, **card_options) as card:
+            card.add_file("{}/IMG_00000.JPG".format(_BENCH_DIR))
+            watchers = [
+                ("remote", lambda scheduler: sync.watch_remote_files(
+                    remote_dir=_BENCH_DIR, url=card.url,
+                    scheduler=scheduler)),
+                ("local", lambda scheduler: sync.watch_local_files(
+                    local_dir=local_dir, scheduler=scheduler)),
+            ]
+            for name, watch in watchers:
+                scheduler = PollScheduler(*scheduler_args)
+                watcher = watch(scheduler)
+                next(watcher)
+                wall, cpu = time.perf_counter(), time.process_time()
+                while time.perf_counter() - wall < seconds:
+                    next(watcher)
+                wall = time.perf_counter() - wall
+                cpu = time.process_time() - cpu
+                watcher.close()
+                results[name + " CPU %"] = 100 * cpu / wall
+                results[name + " polls"] = scheduler.polls
+    return results
+
+
+def time_to_first_byte(samples=3, idle=2.0, size=10**6, min_poll=None,
+                       max_poll=None, **card_options):
+    """Lets a `sync.Monitor` download from an emulated card sit idle for
+    `idle` seconds, then adds a file of `size` bytes to the card and times
+    how long it takes until the download shows up in the local directory.
+    Returns a dict with the mean, min and max of `samples` such delays."""
+    scheduler_args = [arg for arg in (min_poll, max_poll) if arg is not None]
+    delays = []
+    with tempfile.TemporaryDirectory() as card_dir, \
+            tempfile.TemporaryDirectory() as local_dir:
+        with Emulator(card_dir, **card_options) as card:
+            monitor = sync.Monitor(local_dir=local_dir, remote_dir=_BENCH_DIR,
+                                   url=card.url,
+                                   scheduler=PollScheduler(*scheduler_args))
+            monitor.sync_down()
+            try:
+                for i in range(samples):
+                    time.sleep(idle)
+                    name = "IMG_{:05d}.JPG".format(i)
+                    card.add_file("{}/{}".format(_BENCH_DIR, name),
+                                  bytes(size))
+                    start = time.perf_counter()
+                    delays.append(_wait_for_local(local_dir, name) - start)
+            finally:
+                monitor.stop()
+                monitor.join()
+    return {"mean s": sum(delays) / len(delays),
+            "min s": min(delays), "max s": max(delays)}
+
+
+def _wait_for_local(local_dir, name, timeout=60):
+    """Returns the time at which a download of `name` started
+    writing into `local_dir`"""
+    paths = [os.path.join(local_dir, name + sync.PART_SUFFIX),
+             os.path.join(local_dir, name)]
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if any(os.path.exists(path) for path in paths):
+            return time.perf_counter()
+        time.sleep(0.002)
+    raise TimeoutError("{} never arrived in {}".format(name, local_dir))
+
+
+def _print_results(results):
+    for name, value in results.items():
+        if isinstance(value, dict):
+            print("{}:".format(name))
+            for key, val in value.items():
+                print("  {:<28s} {:>14,.2f}".format(key, val))
+        else:
+            print("{:<30s} {:>14,.2f}".format(name, value))
+
+
+def write_json(path, benchmark, params, results):
+    """Writes benchmark `results` to `path` along with the parameters
+    and tfatool version used, so separate runs can be compared"""
+    record = {
+        "benchmark": benchmark,
+        "version": _version.__version__,
+        "time": arrow.now().isoformat(),
+        "params": params,
+        "results": results,
+    }
+    with open(path, "w") as outfile:
+        json.dump(record, outfile, indent=2)
+
+
+def fat_time_rates(n=100000):
+    """Decodes `n` random FAT date/time pairs with arrow row by row
+    (the old way), with `fattime.decode` row by row and with the bulk
+    `fattime.timestamps`, and encodes `n` mtimes row by row with arrow,
+    with `fattime.encode` and with the bulk `fattime.encode_all`.
+    Returns a list of (method, values per second) pairs."""
+    now = time.time()
+    month = 30 * 24 * 3600  # about what a card holds between dumps
+    mtimes = [random.uniform(now - month, now) for _ in range(n)]
+    encoded = [fattime.encode(m) for m in mtimes]
+    date_vals, time_vals = zip(*(fattime.split(e) for e in encoded))
+    pairs = list(zip(date_vals, time_vals))
+    methods = [
+        ("decode: arrow per row",
+         lambda: [_arrow_decode(d, t) for d, t in pairs]),
+        ("decode: fattime.decode per row",
+         lambda: [fattime.decode(d, t) for d, t in pairs]),
+        ("decode: fattime.timestamp per row",
+         lambda: [fattime.timestamp(d, t) for d, t in pairs]),
+        ("decode: fattime.timestamps bulk",
+         lambda: fattime.timestamps(date_vals, time_vals)),
+        ("encode: arrow per row",
+         lambda: [_arrow_encode(m) for m in mtimes]),
+        ("encode: fattime.encode per row",
+         lambda: [fattime.encode(m) for m in mtimes]),
+        ("encode: fattime.encode_all bulk",
+         lambda: fattime.encode_all(mtimes)),
+    ]
+    rates = []
+    for name, method in methods:
+        start = time.perf_counter()
+        method()
+        rates.append((name, n / (time.perf_counter() - start)))
+    return rates
+
+
+def _arrow_decode(date_val, time_val):
+    """The per-row arrow decoding tfatool used before `fattime`"""
+    year, month, day, hour, minute, second = fattime.decode_fields(
+        date_val, time_val)
+    return arrow.get(year, month, day, hour, minute, second, tzinfo="local")
+
+
+def _arrow_encode(mtime):
+    """The per-row arrow encoding tfatool used before `fattime`"""
+    dt = arrow.get(mtime).to("local")
+    date_val = ((dt.year - 1980) << 9) | (dt.month << 5) | dt.day
+    secs = dt.second + dt.microsecond / 10**6
+    time_val = (dt.hour << 11) | (dt.minute << 5) | int(secs / 2)
+    return (date_val << 16) | time_val
+
+
+def _print_rates(rates):
+    for name, rate in rates:
+        print("{:<36s} {:>12,.0f} values/s".format(name, rate))
+
+
+parser = ArgumentParser(description="Measure tfatool performance")
+parser.add_argument("-o", "--output", metavar="JSON",
+                    help="also write the results to this JSON file")
+subparsers = parser.add_subparsers(dest="benchmark")
+subparsers.required = True
+
+download = subparsers.add_parser(
+    "download", help="compare download throughput of different worker "
+                     "counts on a real FlashAir card")
+download.add_argument("-r", "--remote-dir", default=DEFAULT_REMOTE_DIR)
+download.add_argument("-w", "--workers", type=int, nargs="+",
+                      default=[1, sync.DEFAULT_WORKERS],
+                      help="worker counts to compare (default: 1 {})".format(
+                           sync.DEFAULT_WORKERS))
+
+fat = subparsers.add_parser(
+    "fattime", help="FAT timestamp codec vs. per-row arrow conversion")
+fat.add_argument("-n", "--count", type=int, default=100000)
+
+card = ArgumentParser(add_help=False)
+card_args = card.add_argument_group("Emulated card")
+card_args.add_argument("--latency", type=float, default=0.0,
+                       help="seconds added to every response")
+card_args.add_argument("--bandwidth", type=float, default=None,
+                       help="transfer cap in bytes/s per connection")
+card_args.add_argument("--max-connections", type=int, default=None,
+                       help="requests served at once")
+
+listing = subparsers.add_parser(
+    "listing", parents=[card], help="op=100 listing parse rate")
+listing.add_argument("-n", "--n-files", type=int, default=2000)
+
+transfer = subparsers.add_parser(
+    "transfer", parents=[card], help="download and upload MB/s and "
+                                     "requests per file")
+transfer.add_argument("-m", "--mix", nargs="+", choices=sorted(SIZE_MIXES),
+                      default=sorted(SIZE_MIXES), help="file size mixes")
+transfer.add_argument("-w", "--workers", type=int,
+                      default=sync.DEFAULT_WORKERS)
+
+write = subparsers.add_parser(
+    "write", parents=[card], help="download write path MB/s and "
+                                  "allocations per GB")
+write.add_argument("-s", "--size", type=int, default=200 * 10**6,
+                   help="file size in bytes")
+write.add_argument("-c", "--chunk-size", type=int,
+                   default=sync.DEFAULT_CHUNK_SIZE)
+
+polling = ArgumentParser(add_help=False)
+polling.add_argument("--min-poll", type=float, default=None)
+polling.add_argument("--max-poll", type=float, default=None)
+
+idle = subparsers.add_parser(
+    "idle", parents=[card, polling], help="CPU use of idle watchers")
+idle.add_argument("-s", "--seconds", type=float, default=5.0)
+
+ttfb = subparsers.add_parser(
+    "ttfb", parents=[card, polling],
+    help="time from a new file appearing to its download starting")
+ttfb.add_argument("-n", "--samples", type=int, default=3)
+ttfb.add_argument("-i", "--idle", type=float, default=2.0,
+                  help="seconds to wait before each new file")
+
+suite = subparsers.add_parser(
+    "suite", parents=[card, polling],
+    help="listing, transfer, write, idle and ttfb with default "
+         "settings")
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    card_options = dict(latency=getattr(args, "latency", 0.0),
+                        bandwidth=getattr(args, "bandwidth", None),
+                        max_connections=getattr(args, "max_connections", None))
+    poll_options = dict(min_poll=getattr(args, "min_poll", None),
+                        max_poll=getattr(args, "max_poll", None))
+    if args.benchmark == "download":
+        results = download_throughput(remote_dir=args.remote_dir,
+                                      worker_counts=args.workers)
+        _print_throughput(results)
+        results = {"{:d} workers".format(workers): dict(
+                   report._asdict(), synced=len(report.synced),
+                   skipped=len(report.skipped), failed=len(report.failed),
+                   rate=report.rate) for workers, report in results}
+    elif args.benchmark == "fattime":
+        rates = fat_time_rates(args.count)
+        _print_rates(rates)
+        results = dict(rates)
+    else:
+        results = {}
+        if args.benchmark in ("listing", "suite"):
+            results["listing rows/s"] = listing_rates(
+                getattr(args, "n_files", 2000), **card_options)
+        if args.benchmark in ("transfer", "suite"):
+            for mix in getattr(args, "mix", sorted(SIZE_MIXES)):
+                results["transfer " + mix] = transfer_rates(
+                    mix, getattr(args, "workers", sync.DEFAULT_WORKERS),
+                    **card_options)
+        if args.benchmark in ("write", "suite"):
+            results["write path"] = write_path_rates(
+                getattr(args, "size", 200 * 10**6),
+                getattr(args, "chunk_size", sync.DEFAULT_CHUNK_SIZE),
+                **card_options)
+        if args.benchmark in ("idle", "suite"):
+            results["idle watchers"] = watcher_idle_cpu(
+                getattr(args, "seconds", 5.0), **poll_options, **card_options)
+        if args.benchmark in ("ttfb", "suite"):
+            results["time to first byte"] = time_to_first_byte(
+                getattr(args, "samples", 3), getattr(args, "idle", 2.0),
+                **poll_options, **card_options)
+        _print_results(results)
+    if args.output:
+        params = {key: value for key, value in vars(args).items()
+                  if key not in ("benchmark", "output")}
+        write_json(args.output, args.benchmark, params, results)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -1,13 +1,16 @@
 import logging
+import threading
+import time
 import requests
+from collections import Counter, namedtuple
 from functools import partial
 from enum import Enum
-from urllib.parse import urljoin
-from .info import URL
+from urllib.parse import urljoin, urlsplit, parse_qsl
+from . import trace
+from .info import URL, Operation, Upload
 
 
 logger = logging.getLogger(__name__)
-session = requests.session()
 
 
 class Entrypoint(str, Enum):
@@ -17,6 +20,114 @@ class Entrypoint(str, Enum):
     thumbnail = "thumbnail.cgi"
 
 
+###################################
+# HTTP sessions, one set per card
+
+# FlashAir's web server handles only a few connections at a time
+DEFAULT_POOL_SIZE = 4
+
+# (connect, read) timeouts in seconds; a card that wanders out of WiFi range
+# would otherwise hang a request forever
+DEFAULT_TIMEOUT = (5, 30)
+
+
+class SessionPool:
+    """Hands out `requests.Session` objects per card (base URL) and thread.
+
+    Sessions aren't thread-safe, so each thread gets its own. The sessions
+    of one card share a single connection pool that keeps up to
+    `pool_size` idle connections, though, so `Monitor` threads and
+    parallel transfers reuse each other's keep-alive connections. The pool
+    never blocks: a request that finds no idle connection opens a new one,
+    so a connection that's never handed back can't hang later requests. With `keep_alive=False`,
+    each request gets a fresh connection. `timeout` applies to every
+    request that doesn't set its own."""
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, keep_alive=True,
+                 timeout=DEFAULT_TIMEOUT):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self._adapters = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def session(self, url=URL):
+        """Returns this thread's session for the card at `url`"""
+        base = _base_url(url)
+        sessions = self._local.__dict__.setdefault("sessions", {})
+        session = sessions.get(base)
+        if session is None:
+            session = sessions[base] = requests.Session()
+            session.mount(base, self._adapter(base))
+            if not self.keep_alive:
+                session.headers["Connection"] = "close"
+        return session
+
+    def _adapter(self, base):
+        with self._lock:
+            adapter = self._adapters.get(base)
+            if adapter is None:
+                adapter = self._adapters[base] = requests.adapters.HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size)
+            return adapter
+
+    def send(self, prepped_request, **send_kwargs):
+        send_kwargs.setdefault("timeout", self.timeout)
+        session = self.session(prepped_request.url)
+        return session.send(prepped_request, **send_kwargs)
+
+    def close(self):
+        """Closes all pooled connections. The pool can still be used."""
+        with self._lock:
+            adapters, self._adapters = self._adapters, {}
+        for adapter in adapters.values():
+            adapter.close()
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _base_url(url):
+    parts = urlsplit(url)
+    return "{}://{}/".format(parts.scheme, parts.netloc)
+
+
+pool = SessionPool()
+
+
+class _PoolSession:
+    """Stands in for the module-global `requests.Session` that `pool`
+    replaced: attributes are those of this thread's `pool` session for
+    the default card `URL`.
+
+    Unlike the old global session, settings made through it (e.g.
+    `cgi.session.headers = ...`) only apply to the calling thread's
+    session, so set them in each thread that sends requests.
+    `with cgi.session:` closes the calling thread's session on exit,
+    like it closed the global one."""
+
+    def __getattr__(self, name):
+        return getattr(pool.session(URL), name)
+
+    def __setattr__(self, name, value):
+        setattr(pool.session(URL), name, value)
+
+    def __enter__(self):
+        return pool.session(URL).__enter__()
+
+    def __exit__(self, *exc_info):
+        return pool.session(URL).__exit__(*exc_info)
+
+
+# For code written against the old `cgi.session`
+session = _PoolSession()
+
+
 # The requests.PreparedRequest object creation is separated out
 # to ease unit testing of CGI functions
 # If we just use requests.get and requests.post functions,
@@ -27,20 +138,41 @@ def request(method, entrypoint: Entrypoint, url=URL,
     prepared_req = prep_request(method, entrypoint, url=url,
                                 req_kwargs=req_kwargs, **params)
     send_kwargs = send_kwargs or {}
-    return send(prepared_request, **send_kwargs)
+    return send(prepared_req, **send_kwargs)
 
 
 def prep_request(method, entrypoint, url=URL, req_kwargs=None, **params):
     resource = urljoin(url, entrypoint)
     req_kwargs = req_kwargs or {}
     request = requests.Request(method, resource, params=params, **req_kwargs)
-    prepped = session.prepare_request(request)
+    prepped = pool.session(url).prepare_request(request)
+    logger.debug("Request: {}".format(prepped.url))
+    return prepped
+
+
+def prep_file_get(remote_path, url=URL, headers=None):
+    """Prepares a plain GET of a file on the card"""
+    resource = urljoin(url, remote_path)
+    request = requests.Request("GET", resource, headers=headers)
+    prepped = pool.session(url).prepare_request(request)
     logger.debug("Request: {}".format(prepped.url))
     return prepped
 
 
 def send(prepped_request, **send_kwargs):
-    response = session.send(prepped_request, **send_kwargs)
+    start = time.perf_counter()
+    with trace.span("cgi.send", url=prepped_request.url) as span:
+        try:
+            response = pool.send(prepped_request, **send_kwargs)
+        except requests.RequestException:
+            metrics.observe_request(prepped_request, None,
+                                    time.perf_counter() - start)
+            raise
+        span.add(requests=1)
+        span.set(status=response.status_code)
+    metrics.observe_request(prepped_request, response,
+                            time.perf_counter() - start,
+                            streamed=send_kwargs.get("stream", False))
     logger.debug("Response: {}".format(response))
     return response
 
@@ -50,3 +182,195 @@ get = partial(request, "GET")
 prep_post = partial(prep_request, "POST")
 post = partial(request, "POST")
 
+
+
+###########################################
+# Request metrics per entrypoint/operation
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+RequestStats = namedtuple(
+    "RequestStats", "requests errors statuses bytes_out bytes_in "
+                    "latency_sum latency_buckets")
+
+
+class Metrics:
+    """Counts requests sent to FlashAir per (entrypoint, operation) pair.
+    Operations are `info.Operation` names for command.cgi, `info.Upload`
+    names (or "post_file") for upload.cgi and empty for other requests.
+    File downloads are counted under the "file" entrypoint.
+
+    Latency is measured until the response headers arrive, or until the
+    whole body arrives for requests that aren't streamed. `errors` counts
+    requests that failed without a response (timeouts, refused connections,
+    etc.); the status codes of all other responses are in `statuses`."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def observe(self, entrypoint, operation, latency, status=None,
+                bytes_out=0, bytes_in=0):
+        """Records one request. A `status` of None counts as an error."""
+        bucket = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if latency <= bound:
+                bucket = i
+                break
+        key = (entrypoint, operation)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = _MutableStats(len(self.buckets))
+            stats.requests += 1
+            if status is None:
+                stats.errors += 1
+            else:
+                stats.statuses[status] += 1
+            stats.bytes_out += bytes_out
+            stats.bytes_in += bytes_in
+            stats.latency_sum += latency
+            stats.latency_buckets[bucket] += 1
+
+    def observe_request(self, prepped_request, response, latency,
+                        streamed=False):
+        """Records a `requests.PreparedRequest` and its response
+        (None if the request failed). The size of a `streamed` response
+        is taken from its Content-Length header."""
+        entrypoint, operation = _request_labels(prepped_request)
+        status, bytes_in = None, 0
+        if response is not None:
+            status = response.status_code
+            if streamed:
+                bytes_in = int(response.headers.get("Content-Length", 0))
+            else:
+                bytes_in = len(response.content or b"")
+        self.observe(entrypoint, operation, latency, status,
+                     _body_size(prepped_request.body), bytes_in)
+
+    def snapshot(self):
+        """Returns a dict of (entrypoint, operation): `RequestStats`"""
+        with self._lock:
+            return {key: stats.freeze() for key, stats in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def to_prometheus(self, prefix="tfatool"):
+        """Returns the metrics in Prometheus' text exposition format"""
+        snapshot = sorted(self.snapshot().items())
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append("# HELP {}_{} {}".format(prefix, name, help_text))
+            lines.append("# TYPE {}_{} {}".format(prefix, name, kind))
+
+        def sample(name, labels, value):
+            label_text = ",".join('{}="{}"'.format(key, _escape(val))
+                                  for key, val in labels)
+            lines.append("{}_{}{{{}}} {}".format(prefix, name, label_text,
+                                                 _format_value(value)))
+
+        metric("requests_total", "counter",
+               "FlashAir responses by status code")
+        for (entrypoint, operation), stats in snapshot:
+            labels = [("entrypoint", entrypoint), ("operation", operation)]
+            for status, count in sorted(stats.statuses.items()):
+                sample("requests_total", labels + [("status", status)], count)
+        for name, field, help_text in [
+                ("request_errors_total", "errors",
+                 "FlashAir requests that got no response"),
+                ("sent_bytes_total", "bytes_out", "request body bytes sent"),
+                ("received_bytes_total", "bytes_in",
+                 "response body bytes received")]:
+            metric(name, "counter", help_text)
+            for (entrypoint, operation), stats in snapshot:
+                labels = [("entrypoint", entrypoint), ("operation", operation)]
+                sample(name, labels, getattr(stats, field))
+        metric("request_duration_seconds", "histogram",
+               "FlashAir request latency")
+        for (entrypoint, operation), stats in snapshot:
+            labels = [("entrypoint", entrypoint), ("operation", operation)]
+            cumulative = 0
+            bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, stats.latency_buckets):
+                cumulative += count
+                sample("request_duration_seconds_bucket",
+                       labels + [("le", bound)], cumulative)
+            sample("request_duration_seconds_sum", labels, stats.latency_sum)
+            sample("request_duration_seconds_count", labels, stats.requests)
+        return "\n".join(lines) + "\n"
+
+
+class _MutableStats:
+    def __init__(self, n_buckets):
+        self.requests = self.errors = 0
+        self.statuses = Counter()
+        self.bytes_out = self.bytes_in = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * (n_buckets + 1)  # last one is +Inf
+
+    def freeze(self):
+        return RequestStats(self.requests, self.errors, dict(self.statuses),
+                            self.bytes_out, self.bytes_in, self.latency_sum,
+                            tuple(self.latency_buckets))
+
+
+_ENTRYPOINTS = {entrypoint.value for entrypoint in Entrypoint}
+_UPLOAD_PARAMS = {param.value: param.name for param in Upload}
+
+
+def _request_labels(prepped_request):
+    return request_labels(prepped_request.method, prepped_request.url)
+
+
+def request_labels(method, url):
+    """Returns the `Metrics` (entrypoint, operation) labels of a request.
+    Plain file downloads are all labeled ("file", "")."""
+    url = urlsplit(url)
+    entrypoint = url.path.rpartition("/")[2]
+    if entrypoint not in _ENTRYPOINTS:
+        return "file", ""
+    params = dict(parse_qsl(url.query))
+    operation = ""
+    if entrypoint == Entrypoint.command and "op" in params:
+        try:
+            operation = Operation(int(params["op"])).name
+        except ValueError:
+            operation = params["op"]
+    elif entrypoint == Entrypoint.upload:
+        if method == "POST":
+            operation = "post_file"
+        else:
+            names = [_UPLOAD_PARAMS[key] for key in params
+                     if key in _UPLOAD_PARAMS]
+            operation = ",".join(sorted(names))
+    return entrypoint, operation
+
+
+def _body_size(body):
+    if body is None:
+        return 0
+    try:
+        return len(body)
+    except TypeError:
+        return 0  # a generator or some such
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+metrics = Metrics()
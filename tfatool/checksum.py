@@ -0,0 +1,230 @@
+"""Checksums of files, computed as they're transferred.
+
+A `Digest` is fed each chunk of a download or upload as it goes by, so
+files aren't read a second time to be hashed. Besides the digest of the
+whole file, it keeps one for every `block_size` bytes, so the copy on the
+card can be checked later by reading a few blocks with range requests
+instead of downloading all of it again.
+
+Checksums are kept by a `journal.Journal` created with `checksum=`:
+
+>>> journal = Journal(DEFAULT_JOURNAL_PATH, checksum="crc32")
+>>> sync.down_by_all(remote_dir="/DCIM", journal=journal)
+>>> [v for v in checksum.verify(journal) if not v.ok]
+[]
+"""
+
+import hashlib
+import logging
+import random
+import zlib
+
+from collections import namedtuple
+
+from . import cgi
+from .info import URL
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_ALGORITHM = "crc32"
+
+# A remote check reads at least one block, so blocks are kept small
+# enough to fetch in a fraction of a second over FlashAir's WiFi
+DEFAULT_BLOCK_SIZE = 256 * 1024
+
+
+class _CRC32:
+    """`zlib.crc32` behind the `hashlib` interface"""
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return "{:08x}".format(self.value)
+
+
+ALGORITHMS = {
+    "crc32": _CRC32,
+    "blake2b": lambda: hashlib.blake2b(digest_size=16),
+}
+if xxhash is not None:
+    ALGORITHMS["xxh64"] = xxhash.xxh64
+
+
+ChecksumRecord = namedtuple(
+    "ChecksumRecord", "direction local_path remote_path size algorithm "
+                      "digest block_size blocks")
+
+Verification = namedtuple("Verification", "record ok problem")
+
+
+class Digest:
+    """Hashes a file that's fed to it in chunks of any size, both as a
+    whole and in blocks of `block_size` bytes"""
+
+    def __init__(self, algorithm=DEFAULT_ALGORITHM,
+                 block_size=DEFAULT_BLOCK_SIZE):
+        if algorithm not in ALGORITHMS:
+            raise ValueError("Unknown checksum algorithm {!r} (choose from "
+                             "{})".format(algorithm, ", ".join(ALGORITHMS)))
+        self.algorithm = algorithm
+        self.block_size = block_size
+        self.reset()
+
+    def reset(self):
+        """Starts over, e.g. when a download is restarted from scratch"""
+        self.nbytes = 0
+        self.blocks = []
+        self._whole = ALGORITHMS[self.algorithm]()
+        self._block = ALGORITHMS[self.algorithm]()
+
+    def update(self, data):
+        self._whole.update(data)
+        view = memoryview(data)
+        while view:
+            room = self.block_size - self.nbytes % self.block_size
+            self._block.update(view[:room])
+            self.nbytes += min(room, len(view))
+            view = view[room:]
+            if self.nbytes % self.block_size == 0:
+                self.blocks.append(self._block.hexdigest())
+                self._block = ALGORITHMS[self.algorithm]()
+
+    def update_from_file(self, path, length, chunk_size=1024 * 1024):
+        """Feeds the first `length` bytes of the file at `path`,
+        e.g. the part of a download written before it was resumed"""
+        with open(path, "rb") as infile:
+            while length > 0:
+                chunk = infile.read(min(chunk_size, length))
+                if not chunk:
+                    raise EOFError("{} is shorter than {:d} bytes".format(
+                                   path, length))
+                self.update(chunk)
+                length -= len(chunk)
+
+    def hexdigest(self):
+        return self._whole.hexdigest()
+
+    def block_digests(self):
+        """Returns the digest of each block; the last may be short"""
+        if self.nbytes % self.block_size:
+            return self.blocks + [self._block.hexdigest()]
+        return list(self.blocks)
+
+
+def file_digest(path, algorithm=DEFAULT_ALGORITHM,
+                block_size=DEFAULT_BLOCK_SIZE):
+    """Returns a `Digest` of the whole file at `path`"""
+    digest = Digest(algorithm, block_size)
+    with open(path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest
+
+
+def verify(journal, url=URL, local=True, remote=True, samples=2):
+    """Checks each file `journal` holds checksums for on the card at
+    `url`. Yields a `Verification` per file. See `check`."""
+    card = journal.card_id(url)
+    for record in journal.checksums(card):
+        yield check(record, url, local, remote, samples)
+
+
+def check(record, url=URL, local=True, remote=True, samples=2):
+    """Checks a file against its `ChecksumRecord`. With `local`, the
+    local copy is hashed again. With `remote`, `samples` of the blocks of
+    the copy on the card are fetched with range requests and compared;
+    the first and last blocks are always among them. Returns a
+    `Verification` whose `problem` says what didn't match."""
+    problem = None
+    try:
+        if local:
+            problem = _check_local(record)
+        if remote and problem is None:
+            problem = _check_remote(record, url, samples)
+    except Exception as e:
+        problem = "{}({})".format(e.__class__.__name__, e)
+    if problem is not None:
+        logger.warning("{} failed verification: {}".format(
+                       record.local_path, problem))
+    return Verification(record, problem is None, problem)
+
+
+def _check_local(record):
+    digest = file_digest(record.local_path, record.algorithm,
+                         record.block_size)
+    if digest.nbytes != record.size:
+        return "local size {:d} != {:d}".format(digest.nbytes, record.size)
+    if digest.hexdigest() != record.digest:
+        return "local {} {} != {}".format(record.algorithm,
+                                          digest.hexdigest(), record.digest)
+
+
+def _check_remote(record, url, samples):
+    for block in _sample_blocks(len(record.blocks), samples):
+        start = block * record.block_size
+        length = min(record.block_size, record.size - start)
+        data = _read_range(record.remote_path, start, length, url)
+        if data is None:
+            return "remote file is shorter than {:d} bytes".format(
+                   start + length)
+        digest = Digest(record.algorithm, record.block_size)
+        digest.update(data)
+        if digest.hexdigest() != record.blocks[block]:
+            return "remote block {:d} (bytes {:d}-{:d}) differs".format(
+                   block, start, start + length - 1)
+
+
+def _sample_blocks(n_blocks, samples):
+    """Picks `samples` block numbers: the first and the last (even if
+    `samples` is 1, since a truncated copy differs at the end), then
+    random ones in between"""
+    ends = sorted({0, n_blocks - 1}) if n_blocks else []
+    middle = range(1, n_blocks - 1)
+    extra = random.sample(middle, min(len(middle), max(samples - 2, 0)))
+    return sorted(ends + extra)
+
+
+def _read_range(remote_path, start, length, url=URL):
+    """Returns `length` bytes of a remote file from byte `start`, or
+    None if the file ends first"""
+    headers = {"Range": "bytes={:d}-{:d}".format(start, start + length - 1)}
+    request = cgi.prep_file_get(remote_path, url=url, headers=headers)
+    with cgi.send(request, stream=True) as response:
+        if response.status_code == 416:
+            return None
+        content_range = response.headers.get("Content-Range", "")
+        if response.status_code == 206 and \
+                content_range.startswith("bytes {:d}-".format(start)):
+            data = response.raw.read(length)
+        elif response.status_code == 200:
+            # the range was ignored: read up to it, a block at a time
+            if not _skip(response.raw, start):
+                return None
+            data = response.raw.read(length)
+        else:
+            response.raise_for_status()
+            raise ValueError("Unexpected response {:d} to a range "
+                             "request".format(response.status_code))
+    return data if len(data) == length else None
+
+
+def _skip(body, nbytes, chunk_size=DEFAULT_BLOCK_SIZE):
+    """Reads and discards `nbytes` of `body`. Returns False if it ends
+    first."""
+    while nbytes > 0:
+        chunk = body.read(min(chunk_size, nbytes))
+        if not chunk:
+            return False
+        nbytes -= len(chunk)
+    return True
@@ -1,9 +1,10 @@
 import logging
-import arrow
 
-from pathlib import PurePosixPath
 from collections import namedtuple
-from . import cgi
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from . import cgi, fattime, trace
+from .filters import split_filters
 from .info import URL, DEFAULT_REMOTE_DIR
 from .info import WifiMode, WifiModeOnBoot, ModeValue, Operation
 from .info import FileInfo, RawFileInfo
@@ -12,6 +13,14 @@ from .info import FileInfo, RawFileInfo
 logger = logging.getLogger(__name__)
 
 
+# Directories of a tree are listed concurrently, but FlashAir's
+# web server only copes with a few connections at once
+DEFAULT_LIST_WORKERS = 3
+
+# Listing rows whose datetimes are decoded together
+DEFAULT_DECODE_BATCH = 1024
+
+
 ##################
 # command.cgi API
 
@@ -22,9 +31,53 @@ def map_files(*filters, remote_dir=DEFAULT_REMOTE_DIR, url=URL):
 
 
 def list_files(*filters, remote_dir=DEFAULT_REMOTE_DIR, url=URL):
-    response = _get(Operation.list_files, url, DIR=remote_dir)
-    files = _split_file_list(response.text)
-    return (f for f in files if all(filt(f) for filt in filters))
+    lines = _iter_lines(Operation.list_files, url, DIR=remote_dir)
+    return _split_file_list(lines, *filters)
+
+
+def walk_remote(*filters, remote_dir=DEFAULT_REMOTE_DIR, url=URL,
+                workers=DEFAULT_LIST_WORKERS, index=None):
+    """Generates a `FileInfo` for every file in `remote_dir` and all of its
+    subdirectories. Subdirectories are found by the directory bit of each
+    listing row and listed up to `workers` at a time. Files are generated
+    as soon as their directory has been listed, so they come in no
+    particular order. With an `index.RemoteIndex`, its cached listings are
+    used as they are; revalidate it first. New listings are saved to the
+    index once, after the walk."""
+    if index is None:
+        list_dir = list_files
+    else:
+        list_dir = partial(index.list_files, revalidate=False, save=False)
+    try:
+        yield from _walk(filters, list_dir, remote_dir, url, workers)
+    finally:
+        if index is not None:
+            index.save()
+
+
+def _walk(filters, list_dir, remote_dir, url, workers):
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_list_dir, list_dir, remote_dir, url)}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for entry in future.result():
+                        if entry.attribute.directly:
+                            subdir = _join_path(entry.directory or "/",
+                                                entry.filename)
+                            pending.add(pool.submit(_list_dir, list_dir,
+                                                    subdir, url))
+                        elif all(filt(entry) for filt in filters):
+                            yield entry
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _list_dir(list_dir, remote_dir, url):
+    with trace.span("command.walk_dir", dir=remote_dir):
+        return list(list_dir(remote_dir=remote_dir, url=url))
 
 
 def map_files_raw(*filters, remote_dir=DEFAULT_REMOTE_DIR, url=URL):
@@ -33,9 +86,8 @@ def map_files_raw(*filters, remote_dir=DEFAULT_REMOTE_DIR, url=URL):
 
 
 def list_files_raw(*filters, remote_dir=DEFAULT_REMOTE_DIR, url=URL):
-    response = _get(Operation.list_files, url, DIR=remote_dir)
-    files = _split_file_list_raw(response.text)
-    return (f for f in files if all(filt(f) for filt in filters))
+    lines = _iter_lines(Operation.list_files, url, DIR=remote_dir)
+    return _split_file_list_raw(lines, *filters)
 
 
 def count_files(remote_dir=DEFAULT_REMOTE_DIR, url=URL):
@@ -89,52 +141,90 @@ def get_wifi_mode(url=URL) -> WifiMode:
 #####################
 # API implementation
 
-def _split_file_list(text):
-    lines = text.split("\r\n")
+def _split_file_list(lines, *filters, batch_size=DEFAULT_DECODE_BATCH):
+    """Parses op=100 listing `lines` into `FileInfo` tuples. Rows are
+    decoded lazily: `NameFilter` filters run on the bare filename and
+    `DateFilter` filters on the raw FAT date and time integers,
+    so rejected rows never get their attributes or datetime decoded.
+    The datetimes of the rows left are decoded with `fattime.decode_all`,
+    up to `batch_size` rows at a time."""
+    name_predicates, fat_predicates, filters = split_filters(filters)
+    rows, date_vals, time_vals = [], [], []
     for line in lines:
         groups = line.split(",")
-        if len(groups) == 6:
-            directory, filename, *remaining = groups
-            remaining = map(int, remaining)
-            size, attr_val, date_val, time_val = remaining
-            timeinfo = _decode_time(date_val, time_val)
-            attribute = _decode_attribute(attr_val)
-            path = str(PurePosixPath(directory, filename))
-            yield FileInfo(directory, filename, path,
-                           size, attribute, timeinfo)
-
-
-def _split_file_list_raw(text):
-    lines = text.split("\r\n")
+        if len(groups) != 6:
+            continue
+        directory, filename, size, attr_val, date_val, time_val = groups
+        if not all(pred(filename) for pred in name_predicates):
+            continue
+        date_val, time_val = int(date_val), int(time_val)
+        if not all(pred(date_val, time_val) for pred in fat_predicates):
+            continue
+        rows.append((directory, filename, size, attr_val))
+        date_vals.append(date_val)
+        time_vals.append(time_val)
+        if len(rows) >= batch_size:
+            yield from _decode_rows(rows, date_vals, time_vals, filters)
+            rows, date_vals, time_vals = [], [], []
+    yield from _decode_rows(rows, date_vals, time_vals, filters)
+
+
+def _decode_rows(rows, date_vals, time_vals, filters):
+    """Returns the `FileInfo` of each parsed row that passes `filters`"""
+    datetimes = fattime.decode_all(date_vals, time_vals)
+    files = [FileInfo(directory, filename, _join_path(directory, filename),
+                      int(size), _decode_attribute(int(attr_val)), timeinfo)
+             for (directory, filename, size, attr_val), timeinfo
+             in zip(rows, datetimes)]
+    if filters:
+        files = [f for f in files if all(filt(f) for filt in filters)]
+    return files
+
+
+def _split_file_list_raw(lines, *filters):
+    name_predicates, fat_predicates, filters = split_filters(filters)
     for line in lines:
         groups = line.split(",")
-        if len(groups) == 6:
-            directory, filename, size, *_ = groups
-            path = str(PurePosixPath(directory, filename))
-            yield RawFileInfo(directory, filename, path, int(size))
-
-
-def _decode_time(date_val: int, time_val: int):
-    year = (date_val >> 9) + 1980  # 0-val is the year 1980
-    month = (date_val & (0b1111 << 5)) >> 5
-    day = date_val & 0b11111
-    hour = time_val >> 11
-    minute = ((time_val >> 5) & 0b111111)
-    second = (time_val & 0b11111) * 2
+        if len(groups) != 6:
+            continue
+        directory, filename, size, _, date_val, time_val = groups
+        if not all(pred(filename) for pred in name_predicates):
+            continue
+        if fat_predicates:
+            date_val, time_val = int(date_val), int(time_val)
+            if not all(pred(date_val, time_val) for pred in fat_predicates):
+                continue
+        path = _join_path(directory, filename)
+        fileinfo = RawFileInfo(directory, filename, path, int(size))
+        if all(filt(fileinfo) for filt in filters):
+            yield fileinfo
+
+
+def _iter_lines(operation, url=URL, chunk_size=64 * 1024, **params):
+    """Decodes the response to a command line by line without holding
+    the whole body in memory. The request is only sent once the first
+    line is asked for, so a generator that's never iterated doesn't tie
+    up a pooled connection."""
+    response = _get_streaming(operation, url, **params)
+    encoding = response.encoding or "utf-8"
     try:
-        decoded = arrow.get(year, month, day, hour,
-                            minute, second, tzinfo="local")
-    except ValueError:
-        year = max(1980, year)  # FAT32 doesn't go higher
-        month = min(max(1, month), 12)
-        day = max(1, day)
-        decoded = arrow.get(year, month, day, hour, minute, second)
-    return decoded
+        for line in response.iter_lines(chunk_size=chunk_size):
+            yield line.decode(encoding)
+    finally:
+        response.close()
+
+
+def _join_path(directory, filename):
+    """A cheap `str(PurePosixPath(directory, filename))` for listing rows"""
+    if not directory:
+        return filename
+    return directory.rstrip("/") + "/" + filename
 
 
 AttrInfo = namedtuple(
     "AttrInfo", "archive directly volume system_file hidden_file read_only")
 
+@lru_cache(maxsize=64)
 def _decode_attribute(attr_val: int):
     bit_positions = reversed(range(6))
     bit_flags = [bool(attr_val & (1 << bit)) for bit in bit_positions]
@@ -147,7 +237,15 @@ def _decode_attribute(attr_val: int):
 def _get(operation: Operation, url=URL, **params):
     """HTTP GET of the FlashAir command.cgi entrypoint"""
     prepped_request = _prep_get(operation, url=url, **params)
-    return cgi.send(prepped_request)
+    with trace.span("command." + operation.name):
+        return cgi.send(prepped_request)
+
+
+def _get_streaming(operation: Operation, url=URL, **params):
+    """Like `_get`, but the response body is read as it's consumed"""
+    prepped_request = _prep_get(operation, url=url, **params)
+    with trace.span("command." + operation.name):
+        return cgi.send(prepped_request, stream=True)
 
 
 def _prep_get(operation: Operation, url=URL, **params):
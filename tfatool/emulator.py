@@ -0,0 +1,458 @@
+"""A local stand-in for a FlashAir card.
+
+Serves command.cgi, upload.cgi, thumbnail.cgi and plain file downloads
+from a local directory tree, which plays the part of the SD card.
+Latency, bandwidth, connection limits and random failures can be injected
+to approximate the card's embedded web server.
+
+>>> with Emulator("path/to/card") as card:
+...     command.list_files(remote_dir="/DCIM", url=card.url)
+
+or from the command line: `python -m tfatool.emulator path/to/card`
+"""
+
+import logging
+import os
+import random
+import socket
+import socketserver
+import threading
+import time
+
+from argparse import ArgumentParser
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from . import fattime
+from .info import Operation, Upload, ResponseCode
+
+
+logger = logging.getLogger(__name__)
+
+
+_DIRECTORY_ATTR = 0x10
+_ARCHIVE_ATTR = 0x20
+
+
+class Emulator:
+    """Emulates a FlashAir card whose SD card contents are the files in
+    `root`. `latency` seconds are added to every response, transfers are
+    capped at `bandwidth` bytes/s per connection, at most
+    `max_connections` requests are served at once (others wait) and
+    a `failure_rate` fraction of requests fail with a 500 error, or
+    are cut off halfway for file downloads.
+
+    `requests` counts the requests served per entrypoint ("file" for plain
+    file downloads) and `connections` the TCP connections accepted.
+    `add_file` and `remove_file` change the card's contents and set its
+    memory-changed flag, as the camera would. Give each emulated card its
+    own `mac` to tell them apart."""
+
+    def __init__(self, root, host="127.0.0.1", port=0, latency=0.0,
+                 bandwidth=None, max_connections=None, failure_rate=0.0,
+                 seed=None, mac="e8:e0:b7:00:00:01"):
+        self.root = os.path.abspath(root)
+        self.mac = mac
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.requests = Counter()
+        self.connections = 0
+        self.memory_changed = False
+        self.upload_dir = "/"
+        self.upload_time = None
+        self.write_protect = False
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._slots = None
+        if max_connections:
+            self._slots = threading.BoundedSemaphore(max_connections)
+        self._server = _Server((host, port), _Handler)
+        self._server.emulator = self
+        self._thread = None
+        self._connections = set()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{:d}/".format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)  # drop keep-alives
+            except OSError:
+                pass
+        if self._thread:
+            self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def add_file(self, remote_path, data=b"", mtime=None):
+        """Writes a file onto the emulated card, like a camera would"""
+        local_path = self.local_path(remote_path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, "wb") as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(local_path, (mtime, mtime))
+        self.memory_changed = True
+        return local_path
+
+    def remove_file(self, remote_path):
+        os.remove(self.local_path(remote_path))
+        self.memory_changed = True
+
+    def local_path(self, remote_path):
+        """Maps a path on the card to a path under `root`"""
+        relative = os.path.normpath("/" + remote_path.strip("/")).lstrip("/")
+        return os.path.join(self.root, relative)
+
+    def _count(self, kind):
+        with self._lock:
+            self.requests[kind] += 1
+
+    def _should_fail(self):
+        return self.failure_rate and self._random.random() < self.failure_rate
+
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FlashAir-emulator"
+    # headers and body go out in separate writes; without this, Nagle's
+    # algorithm and delayed ACKs add ~40 ms to small responses
+    disable_nagle_algorithm = True
+
+    @property
+    def card(self):
+        return self.server.emulator
+
+    def setup(self):
+        super().setup()
+        with self.card._lock:
+            self.card._connections.add(self.connection)
+            self.card.connections += 1
+
+    def finish(self):
+        with self.card._lock:
+            self.card._connections.discard(self.connection)
+        super().finish()
+
+    def log_message(self, fmt, *args):
+        logger.debug(fmt % args)
+
+    def do_GET(self):
+        self._limited(self._get)
+
+    def do_POST(self):
+        self._limited(self._post)
+
+    def _limited(self, method):
+        """Serves a request once one of the `max_connections` slots is
+        free. Idle keep-alive connections don't hold a slot."""
+        slots = self.card._slots
+        if slots:
+            slots.acquire()
+        try:
+            method()
+        finally:
+            if slots:
+                slots.release()
+
+    def _get(self):
+        path, _, query = self.path.partition("?")
+        path = unquote(path)
+        if self.card.latency:
+            time.sleep(self.card.latency)
+        if path == "/command.cgi":
+            self.card._count("command.cgi")
+            self._command(parse_qs(query))
+        elif path == "/upload.cgi":
+            self.card._count("upload.cgi")
+            self._upload_params(parse_qs(query))
+        elif path == "/thumbnail.cgi":
+            self.card._count("thumbnail.cgi")
+            self._thumbnail(unquote(query))
+        else:
+            self.card._count("file")
+            self._file(path)
+
+    def _post(self):
+        path = urlsplit(self.path).path
+        if self.card.latency:
+            time.sleep(self.card.latency)
+        if path != "/upload.cgi":
+            self._drain_body()
+            return self._send(404, b"Not found")
+        self.card._count("upload.cgi")
+        self._post_file()
+
+    ###############
+    # command.cgi
+
+    def _command(self, params):
+        if self.card._should_fail():
+            return self._send(500, b"Injected failure")
+        try:
+            op = Operation(int(params["op"][0]))
+        except (KeyError, ValueError):
+            return self._send(400, b"Bad op")
+        remote_dir = params.get("DIR", ["/"])[0]
+        if op == Operation.list_files:
+            rows = ["WLANSD_FILELIST"]
+            rows.extend(self._list_rows(remote_dir))
+            return self._send_text("\r\n".join(rows) + "\r\n")
+        elif op == Operation.count_files:
+            return self._send_text(str(len(self._list_rows(remote_dir))))
+        elif op == Operation.memory_changed:
+            changed, self.card.memory_changed = self.card.memory_changed, False
+            return self._send_text("1" if changed else "0")
+        answers = {
+            Operation.get_ssid: "flashair_emulator",
+            Operation.get_password: "12345678",
+            Operation.get_mac: self.card.mac,
+            Operation.get_browser_lang: "en-US",
+            Operation.get_fw_version: "F24A6W3AW1.00.03",
+            Operation.get_ctrl_image: "/DCIM/100__TSB/FA000001.JPG",
+            Operation.get_wifi_mode: "0",
+        }
+        self._send_text(answers[op])
+
+    def _list_rows(self, remote_dir):
+        local_dir = self.card.local_path(remote_dir)
+        try:
+            entries = sorted(os.scandir(local_dir), key=lambda e: e.name)
+        except OSError:
+            return []
+        directory = "/" + remote_dir.strip("/") if remote_dir.strip("/") else ""
+        rows = []
+        for entry in entries:
+            stat = entry.stat()
+            is_dir = entry.is_dir()
+            attr = _DIRECTORY_ATTR if is_dir else _ARCHIVE_ATTR
+            size = 0 if is_dir else stat.st_size
+            date_val, time_val = fattime.split(fattime.encode(stat.st_mtime))
+            rows.append("{},{},{:d},{:d},{:d},{:d}".format(
+                directory, entry.name, size, attr, date_val, time_val))
+        return rows
+
+    ##############
+    # upload.cgi
+
+    def _upload_params(self, params):
+        if self.card._should_fail():
+            return self._send(500, b"Injected failure")
+        card = self.card
+        result = ResponseCode.success
+        if Upload.write_protect.value in params:
+            mode = params[Upload.write_protect.value][0]
+            card.write_protect = mode.upper() == "ON"
+        if Upload.directory.value in params:
+            card.upload_dir = params[Upload.directory.value][0]
+        if Upload.creation_time.value in params:
+            try:
+                card.upload_time = int(params[Upload.creation_time.value][0],
+                                       16)
+            except ValueError:
+                result = ResponseCode.error
+        if Upload.delete.value in params:
+            try:
+                card.remove_file(params[Upload.delete.value][0])
+            except OSError:
+                result = ResponseCode.error
+        self._send_text(result.value)
+
+    def _post_file(self):
+        """Stores a multipart/form-data upload holding a single file"""
+        card = self.card
+        remaining = int(self.headers.get("Content-Length", 0))
+        content_type = self.headers.get("Content-Type", "")
+        _, _, boundary = content_type.partition("boundary=")
+        boundary = boundary.strip('"').encode("ascii")
+        head = b""
+        while b"\r\n\r\n" not in head and remaining > 0:
+            line = self.rfile.readline(min(remaining, 64 * 1024))
+            if not line:
+                break
+            remaining -= len(line)
+            head += line
+        tail = b"\r\n--" + boundary + b"--\r\n"
+        filename = _part_filename(head)
+        if not boundary or filename is None:
+            self._drain_body(remaining)
+            return self._send(400, b"Expected a multipart file upload")
+        remote_path = card.upload_dir.rstrip("/") + "/" + filename
+        local_path = card.local_path(remote_path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        fail = card._should_fail()
+        with open(local_path, "wb") as outfile:
+            self._copy(self.rfile, outfile, remaining - len(tail))
+        self._drain_body(len(tail))
+        if fail:
+            os.remove(local_path)
+            return self._send(500, b"Injected failure")
+        if card.upload_time is not None:
+            date_val, time_val = fattime.split(card.upload_time)
+            mtime = fattime.timestamp(date_val, time_val)
+            os.utime(local_path, (mtime, mtime))
+        card.memory_changed = True
+        self._send(200, b"<html><body>Success</body></html>", "text/html")
+
+    #####################################
+    # file downloads and thumbnail.cgi
+
+    def _file(self, remote_path):
+        local_path = self.card.local_path(remote_path)
+        if not os.path.isfile(local_path):
+            return self._send(404, b"Not found")
+        size = os.path.getsize(local_path)
+        start, end = 0, size - 1
+        status = 200
+        byte_range = self.headers.get("Range", "")
+        if byte_range.startswith("bytes="):
+            first, _, last = byte_range[6:].partition("-")
+            try:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            except ValueError:
+                return self._send(416, b"Bad range")
+            if start > end:
+                return self._send(416, b"Bad range")
+            status = 206
+        length = end - start + 1
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        if status == 206:
+            self.send_header("Content-Range", "bytes {:d}-{:d}/{:d}".format(
+                             start, end, size))
+        self.end_headers()
+        if self.card._should_fail():
+            length //= 2  # send half the file, then hang up
+            self.close_connection = True
+        with open(local_path, "rb") as infile:
+            infile.seek(start)
+            self._copy(infile, self.wfile, length)
+
+    def _thumbnail(self, remote_path):
+        """FlashAir serves the EXIF thumbnail; the emulator serves the
+        JPEG itself"""
+        if not remote_path.lower().endswith((".jpg", ".jpeg")):
+            return self._send(404, b"Not a JPEG")
+        local_path = self.card.local_path(remote_path)
+        if not os.path.isfile(local_path):
+            return self._send(404, b"Not found")
+        with open(local_path, "rb") as infile:
+            self._send(200, infile.read(), "image/jpeg")
+
+    ###########
+    # helpers
+
+    def _copy(self, infile, outfile, length, chunk_size=64 * 1024):
+        bandwidth = self.card.bandwidth
+        start = time.time()
+        copied = 0
+        while copied < length:
+            chunk = infile.read(min(chunk_size, length - copied))
+            if not chunk:
+                break
+            outfile.write(chunk)
+            copied += len(chunk)
+            if bandwidth:
+                ahead = copied / bandwidth - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def _drain_body(self, remaining=None):
+        if remaining is None:
+            remaining = int(self.headers.get("Content-Length", 0))
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 64 * 1024))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+
+    def _send_text(self, text):
+        self._send(200, text.encode("utf-8"))
+
+    def _send(self, status, body, content_type="text/plain"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self._copy(_BytesReader(body), self.wfile, len(body))
+
+
+class _BytesReader:
+    def __init__(self, data):
+        self._data = memoryview(data)
+
+    def read(self, size):
+        chunk, self._data = self._data[:size], self._data[size:]
+        return chunk
+
+
+def _part_filename(head):
+    for line in head.split(b"\r\n"):
+        if line.lower().startswith(b"content-disposition:"):
+            _, _, filename = line.partition(b'filename="')
+            if filename:
+                name = filename.rsplit(b'"', 1)[0].decode("utf-8")
+                return os.path.basename(name.replace("%22", '"'))
+    return None
+
+
+parser = ArgumentParser(description="Serve a directory as a FlashAir card")
+parser.add_argument("root", help="directory that plays the SD card")
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("-p", "--port", type=int, default=8080)
+parser.add_argument("--latency", type=float, default=0.0,
+                    help="seconds added to every response")
+parser.add_argument("--bandwidth", type=float, default=None,
+                    help="transfer cap in bytes/s per connection")
+parser.add_argument("--max-connections", type=int, default=None,
+                    help="requests served at once; others wait")
+parser.add_argument("--failure-rate", type=float, default=0.0,
+                    help="fraction of requests that fail")
+parser.add_argument("--seed", type=int, default=None)
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    card = Emulator(args.root, host=args.host, port=args.port,
+                    latency=args.latency, bandwidth=args.bandwidth,
+                    max_connections=args.max_connections,
+                    failure_rate=args.failure_rate, seed=args.seed)
+    print("Emulating FlashAir at {} with {}".format(card.url, card.root))
+    try:
+        card._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        card._server.server_close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
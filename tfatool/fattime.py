@@ -0,0 +1,192 @@
+"""Encoding and decoding of FAT32 date/time values.
+
+FlashAir reports file times as a 16-bit FAT date (years since 1980, month,
+day) and a 16-bit FAT time (hour, minute, seconds / 2), both in the card's
+local time. Upload FTIME values pack the same two fields into 32 bits.
+
+Single values are handled by `decode`, `timestamp` and `encode`. Whole
+columns of values can be converted at once with `decode_all`, `timestamps`
+and `encode_all`; the latter two use NumPy when it's installed.
+
+Decoded times carry the fixed UTC offset the local time zone had at that
+moment, which is looked up once per distinct (date, hour).
+"""
+
+import calendar
+import math
+import time
+
+from datetime import timedelta, timezone
+from functools import lru_cache
+
+import arrow
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def decode_fields(date_val: int, time_val: int):
+    """Splits FAT date and time values into
+    (year, month, day, hour, minute, second)"""
+    year = (date_val >> 9) + 1980  # 0-val is the year 1980
+    month = (date_val >> 5) & 0b1111
+    day = date_val & 0b11111
+    hour = time_val >> 11
+    minute = (time_val >> 5) & 0b111111
+    second = (time_val & 0b11111) * 2
+    return year, month, day, hour, minute, second
+
+
+def decode(date_val: int, time_val: int):
+    """Decodes FAT date and time values to a local `arrow.Arrow`"""
+    fields = decode_fields(date_val, time_val)
+    tzinfo = _zone(date_val, fields[3])
+    try:
+        return arrow.Arrow(*fields, tzinfo=tzinfo)
+    except ValueError:
+        return arrow.Arrow(*_clamp(*fields), tzinfo=tzinfo)
+
+
+def timestamp(date_val: int, time_val: int):
+    """Decodes FAT date and time values to POSIX seconds"""
+    hour = time_val >> 11
+    minute = (time_val >> 5) & 0b111111
+    second = (time_val & 0b11111) * 2
+    return _hour_start(date_val, hour) + minute * 60 + second
+
+
+def encode(mtime: float):
+    """Encodes POSIX seconds as a 32-bit FAT date/time in local time"""
+    t = time.localtime(mtime)
+    date_val = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    secs = t.tm_sec + (mtime - math.floor(mtime))
+    time_val = (t.tm_hour << 11) | (t.tm_min << 5) | math.floor(secs / 2)
+    return (date_val << 16) | time_val
+
+
+def split(fat_time: int):
+    """Splits a 32-bit FAT date/time into (date_val, time_val)"""
+    return fat_time >> 16, fat_time & 0xFFFF
+
+
+##################################
+# Bulk conversion of many values
+
+def decode_all(date_vals, time_vals):
+    """Decodes sequences of FAT date and time values to a list of local
+    `arrow.Arrow` objects. Repeated values (files written within the same
+    two seconds) share a single `Arrow`, which is immutable."""
+    decoded = {}
+    arrows = []
+    for date_val, time_val in zip(date_vals, time_vals):
+        key = (date_val << 16) | time_val
+        value = decoded.get(key)
+        if value is None:
+            value = decoded[key] = decode(date_val, time_val)
+        arrows.append(value)
+    return arrows
+
+
+def timestamps(date_vals, time_vals):
+    """Decodes sequences of FAT date and time values to POSIX seconds.
+    Returns a NumPy int64 array if NumPy is available, otherwise a list.
+    Local time offsets are looked up once per distinct (date, hour)."""
+    if np is None:
+        return [timestamp(d, t) for d, t in zip(date_vals, time_vals)]
+    date_vals = np.asarray(date_vals, dtype=np.int64)
+    time_vals = np.asarray(time_vals, dtype=np.int64)
+    hours = time_vals >> 11
+    minutes = (time_vals >> 5) & 0b111111
+    seconds = (time_vals & 0b11111) * 2
+    keys, inverse = np.unique((date_vals << 5) | hours, return_inverse=True)
+    starts = np.fromiter((_hour_start(int(k) >> 5, int(k) & 0b11111)
+                          for k in keys), dtype=np.int64, count=len(keys))
+    return starts[inverse.reshape(-1)] + minutes * 60 + seconds
+
+
+def datetimes64(date_vals, time_vals):
+    """Decodes sequences of FAT date and time values to a NumPy
+    `datetime64[s]` array of UTC instants (requires NumPy)"""
+    if np is None:
+        raise ImportError("datetimes64 requires NumPy")
+    return timestamps(date_vals, time_vals).astype("datetime64[s]")
+
+
+def encode_all(mtimes):
+    """Encodes a sequence of POSIX seconds as 32-bit FAT date/times.
+    Returns a NumPy int64 array if NumPy is available, otherwise a list.
+    Local time offsets are looked up once per distinct quarter hour,
+    since UTC offset changes always fall on a quarter hour."""
+    if np is None:
+        return [encode(m) for m in mtimes]
+    mtimes = np.asarray(mtimes, dtype=np.float64)
+    whole = np.floor(mtimes).astype(np.int64)
+    quarter_keys, inverse = np.unique(whole // 900, return_inverse=True)
+    offsets = np.fromiter((_utc_offset(int(k) * 900) for k in quarter_keys),
+                          dtype=np.int64, count=len(quarter_keys))
+    local = whole + offsets[inverse.reshape(-1)]
+    days, secs = np.divmod(local, 86400)
+    year, month, day = _civil_from_days(days)
+    hour, secs = np.divmod(secs, 3600)
+    minute, secs = np.divmod(secs, 60)
+    half_secs = np.floor((secs + (mtimes - whole)) / 2).astype(np.int64)
+    date_val = ((year - 1980) << 9) | (month << 5) | day
+    time_val = (hour << 11) | (minute << 5) | half_secs
+    return (date_val << 16) | time_val
+
+
+#####################
+# Helpers
+
+@lru_cache(maxsize=4096)
+def _hour_start(date_val: int, hour: int):
+    """POSIX seconds at the start of a local hour on a FAT date"""
+    year, month, day, *_ = decode_fields(date_val, 0)
+    year, month, day, hour, _, _ = _clamp(year, month, day, hour, 0, 0)
+    wall_clock = calendar.timegm((year, month, day, hour, 0, 0))
+    # an ambiguous hour (when clocks go back) resolves to its first occurrence
+    guess = wall_clock - _utc_offset(wall_clock)
+    return wall_clock - _utc_offset(guess)
+
+
+@lru_cache(maxsize=4096)
+def _zone(date_val: int, hour: int):
+    """The fixed-offset time zone of a local hour on a FAT date"""
+    year, month, day, *_ = decode_fields(date_val, 0)
+    year, month, day, hour, _, _ = _clamp(year, month, day, hour, 0, 0)
+    wall_clock = calendar.timegm((year, month, day, hour, 0, 0))
+    offset = wall_clock - _hour_start(date_val, hour)
+    return timezone(timedelta(seconds=offset))
+
+
+@lru_cache(maxsize=4096)
+def _utc_offset(seconds: int):
+    """Local UTC offset in seconds at a POSIX time"""
+    return time.localtime(seconds).tm_gmtoff
+
+
+def _clamp(year, month, day, hour, minute, second):
+    """Forces out-of-range FAT fields into a valid date and time"""
+    year = max(1980, year)  # FAT32 doesn't go lower
+    month = min(max(1, month), 12)
+    day = min(max(1, day), calendar.monthrange(year, month)[1])
+    return (year, month, day, min(hour, 23), min(minute, 59),
+            min(second, 59))
+
+
+def _civil_from_days(days):
+    """Vectorized conversion of days since 1970-01-01 to (year, month, day)
+    (H. Hinnant's `civil_from_days` algorithm)"""
+    days = days + 719468
+    era = np.floor_divide(days, 146097)
+    doe = days - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    year = yoe + era * 400
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = np.where(mp < 10, mp + 3, mp - 9)
+    year = np.where(month <= 2, year + 1, year)
+    return year, month, day
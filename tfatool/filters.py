@@ -0,0 +1,88 @@
+"""File filters that listing functions know how to apply early.
+
+Any callable taking a file info namedtuple works as a filter. The types
+here also work that way, but `tfatool.command` recognizes them and
+applies them to a FlashAir listing before the rest of each row is decoded.
+"""
+
+import math
+
+from . import fattime
+
+
+class NameFilter:
+    """Filters files on their name alone:
+
+    >>> jpegs = NameFilter(lambda name: name.lower().endswith(".jpg"))
+    >>> command.list_files(jpegs)
+    """
+
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def __call__(self, fileinfo):
+        return self.predicate(fileinfo.filename)
+
+
+class DateFilter:
+    """Filters files created strictly after `earliest` and/or strictly
+    before `latest` (arrow or `datetime.datetime` objects).
+
+    The bounds are also compiled to 32-bit FAT date/time values once, so
+    FlashAir listings are filtered with integer comparisons on the raw
+    date and time columns, before any datetime object is built:
+
+    >>> this_year = DateFilter(earliest=arrow.get(2016, 1, 1))
+    >>> command.list_files(this_year)
+
+    FAT times are local wall-clock times, so files from the hour repeated
+    when clocks go back may be ordered differently than by `datetime`.
+    """
+
+    def __init__(self, earliest=None, latest=None):
+        self.earliest = earliest
+        self.latest = latest
+        self.fat_earliest = self.fat_latest = None
+        if earliest is not None:
+            # FAT times have 2 s resolution: round `earliest` down
+            self.fat_earliest = fattime.encode(_timestamp(earliest))
+        if latest is not None:
+            # ...and `latest` up, so that both bounds stay exclusive
+            self.fat_latest = fattime.encode(
+                math.ceil(_timestamp(latest) / 2) * 2)
+
+    def __call__(self, fileinfo):
+        if self.earliest is not None and not fileinfo.datetime > self.earliest:
+            return False
+        if self.latest is not None and not fileinfo.datetime < self.latest:
+            return False
+        return True
+
+    def match_fat(self, date_val: int, time_val: int):
+        """Applies the filter to raw FAT date and time values"""
+        fat_time = (date_val << 16) | time_val
+        if self.fat_earliest is not None and fat_time <= self.fat_earliest:
+            return False
+        if self.fat_latest is not None and fat_time >= self.fat_latest:
+            return False
+        return True
+
+
+def split_filters(filters):
+    """Separates `NameFilter` predicates and `DateFilter` FAT value
+    predicates from the other filters"""
+    name_predicates, fat_predicates, others = [], [], []
+    for filt in filters:
+        if isinstance(filt, NameFilter):
+            name_predicates.append(filt.predicate)
+        elif isinstance(filt, DateFilter):
+            fat_predicates.append(filt.match_fat)
+        else:
+            others.append(filt)
+    return name_predicates, fat_predicates, others
+
+
+def _timestamp(datetime):
+    if hasattr(datetime, "float_timestamp"):
+        return datetime.float_timestamp  # arrow
+    return datetime.timestamp()
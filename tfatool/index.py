@@ -0,0 +1,203 @@
+import json
+import logging
+import os
+import threading
+
+from . import command
+from .info import URL, DEFAULT_REMOTE_DIR, Operation, RawFileInfo
+
+
+logger = logging.getLogger(__name__)
+
+
+_cache_home = os.environ.get("XDG_CACHE_HOME",
+                             os.path.join(os.path.expanduser("~"), ".cache"))
+DEFAULT_INDEX_PATH = os.path.join(_cache_home, "tfatool", "index.json")
+
+
+class RemoteIndex:
+    """Caches FlashAir directory listings per (url, remote_dir).
+
+    Before a cached listing is used, the card is asked whether its memory
+    has changed (op=102), which is far cheaper than a full listing (op=100).
+    A write invalidates every listing cached for that card. Listings are
+    also invalidated by tfatool itself whenever it uploads or deletes files.
+
+    The card clears its change flag when it's read, so only the first
+    of several users of an index would see a change. Instead, each
+    invalidation bumps the card's `generation`, and a user (such as a
+    watcher) compares it with the generation it saw last.
+
+    With a `path`, listings are saved there and reloaded on the next run,
+    along with the MAC address of the card they came from. Because the
+    card's change flag may have been reset since then (e.g. by a power
+    cycle), each reloaded listing is checked once before it's trusted: the
+    card at its URL must have the same MAC address (op=106), so another
+    card at the same address isn't mistaken for it, and the same number
+    of files (op=101).
+
+    The index has the same listing API as `tfatool.command`:
+
+    >>> index = RemoteIndex(DEFAULT_INDEX_PATH)
+    >>> files = index.list_files(remote_dir="/DCIM")
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._listings = {}  # (url, remote_dir) -> raw op=100 text
+        self._owners = {}  # (url, remote_dir) -> MAC address of the card
+        self._macs = {}  # url -> MAC address of the card there now
+        self._parsed = {}  # (url, remote_dir) -> list of FileInfo
+        self._unverified = set()  # keys loaded from disk, not yet checked
+        self._generations = {}  # url -> number of invalidations
+        self._lock = threading.RLock()
+        if path:
+            self.load()
+
+    def map_files(self, *filters, remote_dir=DEFAULT_REMOTE_DIR, url=URL,
+                  revalidate=True):
+        files = self.list_files(*filters, remote_dir=remote_dir, url=url,
+                                revalidate=revalidate)
+        return {f.filename: f for f in files}
+
+    def list_files(self, *filters, remote_dir=DEFAULT_REMOTE_DIR, url=URL,
+                   revalidate=True, save=True):
+        """Lists `remote_dir` like `command.list_files`. With `save` off,
+        a new listing isn't written to disk until the next `save()`."""
+        files = self._files(remote_dir, url, revalidate, save)
+        return (f for f in files if all(filt(f) for filt in filters))
+
+    def map_files_raw(self, *filters, remote_dir=DEFAULT_REMOTE_DIR, url=URL,
+                      revalidate=True):
+        files = self.list_files_raw(*filters, remote_dir=remote_dir, url=url,
+                                    revalidate=revalidate)
+        return {f.filename: f for f in files}
+
+    def list_files_raw(self, *filters, remote_dir=DEFAULT_REMOTE_DIR,
+                       url=URL, revalidate=True, save=True):
+        files = self._files(remote_dir, url, revalidate, save)
+        files = (RawFileInfo(*f[:4]) for f in files)
+        return (f for f in files if all(filt(f) for filt in filters))
+
+    def revalidate(self, url=URL):
+        """Asks FlashAir at `url` whether its memory has been written to.
+        If it has, all listings cached for `url` are dropped.
+        Returns True if the memory changed."""
+        changed = command.memory_changed(url)
+        if changed:
+            logger.debug("Memory changed on {}; invalidating index".format(url))
+            self.invalidate(url)
+        return changed
+
+    def generation(self, url=URL):
+        """Counts the times listings of FlashAir at `url` have been
+        invalidated, whether after a `revalidate` or a write by tfatool"""
+        with self._lock:
+            return self._generations.get(url, 0)
+
+    def invalidate(self, url=URL, remote_dir=None):
+        """Drops cached listings of `remote_dir` (or of every directory)
+        on FlashAir at `url`"""
+        with self._lock:
+            self._generations[url] = self._generations.get(url, 0) + 1
+            keys = [key for key in self._listings if key[0] == url and
+                    (remote_dir is None or key[1] == remote_dir)]
+            for key in keys:
+                del self._listings[key]
+                self._owners.pop(key, None)
+                self._parsed.pop(key, None)
+                self._unverified.discard(key)
+            if keys:
+                self.save()
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+            self._owners.clear()
+            self._parsed.clear()
+            self._unverified.clear()
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.path) as index_file:
+                entries = json.load(index_file)
+        except (OSError, ValueError) as e:
+            logger.debug("No usable index at {}: {}".format(self.path, e))
+            return
+        with self._lock:
+            for entry in entries:
+                if len(entry) != 4:
+                    continue  # saved without a MAC address: can't verify
+                url, remote_dir, text, mac = entry
+                key = url, remote_dir
+                self._listings[key] = text
+                self._owners[key] = mac
+                self._unverified.add(key)
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            entries = [key + (text, self._owners.get(key))
+                       for key, text in self._listings.items()]
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = "{}.{:d}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, "w") as index_file:
+            json.dump(entries, index_file)
+        os.replace(tmp_path, self.path)
+
+    def _files(self, remote_dir, url, revalidate, save=True):
+        # The card is only asked things outside the lock, so that
+        # directories can be listed concurrently (see `walk_remote`)
+        key = url, remote_dir
+        if revalidate:
+            self.revalidate(url)
+        with self._lock:
+            verify = key in self._unverified
+            self._unverified.discard(key)
+            text = self._listings.get(key)
+        if verify and text is not None and not self._verify(key, text):
+            text = None
+        if text is None:
+            text = command._get(Operation.list_files, url,
+                                DIR=remote_dir).text
+            mac = self._mac(url) if self.path else None
+            with self._lock:
+                self._listings[key] = text
+                self._owners[key] = mac
+                self._parsed.pop(key, None)
+            if save:
+                self.save()
+        with self._lock:
+            if key not in self._parsed:
+                self._parsed[key] = list(
+                    command._split_file_list(text.split("\r\n")))
+            return self._parsed[key]
+
+    def _mac(self, url):
+        """Returns the MAC address of the card at `url`, asking it once"""
+        if url not in self._macs:
+            self._macs[url] = command.get_mac(url).strip().lower()
+        return self._macs[url]
+
+    def _verify(self, key, text):
+        """Checks a listing loaded from disk against the identity and file
+        count of the card at its URL, dropping it if it's stale.
+        Returns True if it can be used."""
+        url, remote_dir = key
+        files = list(command._split_file_list(text.split("\r\n")))
+        with self._lock:
+            owner = self._owners.get(key)
+        if (owner is None or self._mac(url) != owner or
+                command.count_files(remote_dir=remote_dir,
+                                    url=url) != len(files)):
+            logger.debug("Stale index entry for {} on {}".format(
+                         remote_dir, url))
+            with self._lock:
+                self._listings.pop(key, None)
+                self._owners.pop(key, None)
+            return False
+        with self._lock:
+            self._parsed[key] = files
+        return True
@@ -0,0 +1,134 @@
+"""Minimal ctypes binding to Linux's inotify file event API"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0o2000000)
+
+_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+_libc = None
+
+
+def is_available():
+    """True if inotify can be used on this system"""
+    return _load_libc() is not None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None and sys.platform.startswith("linux"):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                               use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                               ctypes.c_uint32]
+        except (OSError, AttributeError):
+            return None
+        _libc = libc
+    return _libc
+
+
+class Watcher:
+    """Watches the entries of one directory. `read_events` returns
+    a list of (mask, name) pairs, where `mask` is a combination of the
+    IN_* flags and `name` is relative to the directory. `wake` cuts
+    a `read_events` wait short from another thread."""
+
+    def __init__(self, path, mask=IN_CLOSE_WRITE | IN_MOVED_TO |
+                 IN_MOVED_FROM | IN_DELETE):
+        libc = _load_libc()
+        if libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.path = path
+        self.fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            _raise_errno(path)
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            os.close(self.fd)
+            _raise_errno(path)
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+
+    def fileno(self):
+        return self.fd
+
+    def read_events(self, timeout=0):
+        """Returns pending events, waiting up to `timeout` seconds
+        for the first one to arrive"""
+        readable, _, _ = select.select([self.fd, self._wake_r], [], [],
+                                       timeout)
+        if self._wake_r in readable:
+            _drain(self._wake_r)
+        if self.fd not in readable:
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            events.extend(_parse_events(data))
+        return events
+
+    def wake(self):
+        try:
+            os.write(self._wake_w, b"\0")
+        except (BlockingIOError, OSError):
+            pass  # already woken, or closed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _drain(fd):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def _parse_events(data):
+    offset = 0
+    while offset < len(data):
+        _, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+        offset += _EVENT_HEADER.size
+        name = data[offset:offset + length].rstrip(b"\0")
+        offset += length
+        yield mask, os.fsdecode(name)
+
+
+def _raise_errno(path):
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err), path)
@@ -0,0 +1,250 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from . import checksum, command, fattime
+from .info import URL
+
+
+logger = logging.getLogger(__name__)
+
+
+_data_home = os.environ.get("XDG_DATA_HOME",
+                            os.path.join(os.path.expanduser("~"), ".local",
+                                         "share"))
+DEFAULT_JOURNAL_PATH = os.path.join(_data_home, "tfatool", "journal.sqlite")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    card TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    local_dir TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    fat_time INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    finished REAL NOT NULL,
+    PRIMARY KEY (card, direction, local_dir, path, size, fat_time)
+);
+CREATE TABLE IF NOT EXISTS watches (
+    card TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    local_dir TEXT NOT NULL,
+    root TEXT NOT NULL,
+    started REAL NOT NULL,
+    PRIMARY KEY (card, direction, local_dir, root)
+);
+CREATE TABLE IF NOT EXISTS checksums (
+    card TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    local_path TEXT NOT NULL,
+    remote_path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    block_size INTEGER NOT NULL,
+    blocks TEXT NOT NULL,
+    finished REAL NOT NULL,
+    PRIMARY KEY (card, remote_path)
+);
+"""
+
+SYNCED = "synced"  # transferred, or found identical on the other side
+IGNORED = "ignored"  # already there when the directory was first watched
+
+
+class Journal:
+    """Remembers which files have been synced with which FlashAir card, so
+    a restarted sync only has to deal with what's new since the last run.
+
+    Files are identified by the card's MAC address (`command.get_mac`),
+    the direction of the transfer, the local directory synced with (as
+    an absolute path), the file's path (remote for downloads, local for
+    uploads), its size and its FAT timestamp. A file edited since it was
+    synced doesn't match its old entry, and syncing into another local
+    directory starts afresh.
+
+    The journal is an SQLite database, committed after each transfer:
+
+    >>> journal = Journal(DEFAULT_JOURNAL_PATH)
+    >>> sync.down_by_all(remote_dir="/DCIM", journal=journal)
+
+    `sync.down_by_files` downloads journaled files again if they've been
+    deleted locally. A watcher doesn't: files that were there when it last
+    ran count as dealt with. `forget` a card to start over.
+
+    With a `checksum` algorithm (see `checksum.ALGORITHMS`), each file
+    is hashed while it's transferred and its checksums are recorded too,
+    for `checksum.verify`.
+    """
+
+    def __init__(self, path=DEFAULT_JOURNAL_PATH, checksum=None):
+        self.path = path
+        self.checksum = checksum
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._upgrade()
+        self._db.executescript(_SCHEMA)
+        self._cards = {}  # url -> MAC address
+        self._lock = threading.Lock()
+
+    def _upgrade(self):
+        """Drops the files and watches of a journal written before they
+        were kept per local directory; they can't be told apart"""
+        columns = [row[1] for row in
+                   self._db.execute("PRAGMA table_info(files)")]
+        if columns and "local_dir" not in columns:
+            logger.info("Starting {} afresh: it has no local "
+                        "directories".format(self.path))
+            with self._db:
+                self._db.execute("DROP TABLE files")
+                self._db.execute("DROP TABLE IF EXISTS watches")
+
+    def card_id(self, url=URL):
+        """Returns the MAC address of the card at `url`, asking it once"""
+        if url not in self._cards:
+            self._cards[url] = command.get_mac(url).strip().lower()
+        return self._cards[url]
+
+    def resume(self, url, direction, root, files, local_dir):
+        """Returns the subset of `files`, found in `root` when a watcher
+        syncing with `local_dir` starts, that it can leave alone: those
+        synced by an earlier run. The first time `root` is watched, that's
+        all of them, as it would be without a journal."""
+        card = self.card_id(url)
+        if not self.has_watched(card, direction, root, local_dir):
+            self.start_watch(card, direction, root, files, local_dir)
+            return set(files)
+        done = self.keys(card, direction, local_dir)
+        old_files = {f for f in files if file_key(f) in done}
+        logger.info("Catching up on {:d} files that arrived in {} since the "
+                    "last run".format(len(files) - len(old_files), root))
+        return old_files
+
+    def digest(self):
+        """Returns a new `checksum.Digest` to feed a transfer, or None if
+        the journal doesn't keep checksums"""
+        if self.checksum is None:
+            return None
+        return checksum.Digest(self.checksum)
+
+    def record(self, card, direction, fileinfo, local_dir, status=SYNCED):
+        self.record_all(card, direction, [fileinfo], local_dir, status)
+
+    def record_all(self, card, direction, files, local_dir, status=SYNCED):
+        now = time.time()
+        head = card, _value(direction), _local_key(local_dir)
+        rows = [head + file_key(f) + (status, now) for f in files]
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO files VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def keys(self, card, direction, local_dir, status=None):
+        """Returns the set of `file_key`s recorded for `card` in
+        `direction` with `local_dir`, only those with `status` if given"""
+        query = ("SELECT path, size, fat_time FROM files "
+                 "WHERE card = ? AND direction = ? AND local_dir = ?")
+        params = (card, _value(direction), _local_key(local_dir))
+        if status is not None:
+            query += " AND status = ?"
+            params += (status,)
+        with self._lock:
+            return set(self._db.execute(query, params))
+
+    def contains(self, card, direction, fileinfo, local_dir):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM files WHERE card = ? AND direction = ? AND "
+                "local_dir = ? AND path = ? AND size = ? AND fat_time = ?",
+                (card, _value(direction), _local_key(local_dir)) +
+                file_key(fileinfo)).fetchone()
+        return row is not None
+
+    def record_checksum(self, card, direction, local_path, remote_path,
+                        digest):
+        """Records the `checksum.Digest` of a file transferred between
+        `local_path` and `remote_path`"""
+        row = (card, _value(direction), local_path, remote_path,
+               digest.nbytes, digest.algorithm, digest.hexdigest(),
+               digest.block_size, " ".join(digest.block_digests()),
+               time.time())
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO checksums VALUES "
+                             "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+
+    def checksums(self, card):
+        """Returns a `checksum.ChecksumRecord` for each file transferred
+        with `card` while checksums were kept"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT direction, local_path, remote_path, size, algorithm, "
+                "digest, block_size, blocks FROM checksums WHERE card = ? "
+                "ORDER BY remote_path", (card,)).fetchall()
+        return [checksum.ChecksumRecord(*row[:-1], blocks=row[-1].split())
+                for row in rows]
+
+    def has_watched(self, card, direction, root, local_dir):
+        """Returns True if `root` has been watched in `direction` with
+        `local_dir` before"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM watches WHERE card = ? AND direction = ? AND "
+                "local_dir = ? AND root = ?",
+                (card, _value(direction), _local_key(local_dir),
+                 root)).fetchone()
+        return row is not None
+
+    def start_watch(self, card, direction, root, existing_files, local_dir):
+        """Records that `root` is being watched with `local_dir` for the
+        first time. `existing_files` are recorded as ignored."""
+        self.record_all(card, direction, existing_files, local_dir, IGNORED)
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO watches VALUES (?, ?, ?, ?, ?)",
+                (card, _value(direction), _local_key(local_dir), root,
+                 time.time()))
+
+    def forget(self, card=None):
+        """Drops everything recorded for `card` (or for every card)"""
+        where, params = "", ()
+        if card is not None:
+            where, params = " WHERE card = ?", (card,)
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM files" + where, params)
+            self._db.execute("DELETE FROM watches" + where, params)
+            self._db.execute("DELETE FROM checksums" + where, params)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def file_key(fileinfo):
+    """Returns the (path, size, FAT timestamp) that identifies a file in
+    the journal. Files without a datetime get a timestamp of 0."""
+    datetime = getattr(fileinfo, "datetime", None)
+    fat_time = 0
+    if datetime is not None:
+        fat_time = fattime.encode(datetime.float_timestamp)
+    return fileinfo.path, fileinfo.size, fat_time
+
+
+def _local_key(local_dir):
+    return os.path.abspath(local_dir)
+
+
+def _value(direction):
+    """Accepts `sync.Direction` members as well as their string values"""
+    return getattr(direction, "value", direction)
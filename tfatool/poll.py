@@ -0,0 +1,68 @@
+import threading
+
+
+DEFAULT_MIN_INTERVAL = 0.3
+DEFAULT_MAX_INTERVAL = 5.0
+
+
+class PollScheduler:
+    """Paces the polls of the file watcher-generators in `tfatool.sync`.
+
+    After a poll that found a change, the next poll comes `min_interval`
+    seconds later. Each poll that finds nothing multiplies the interval by
+    `backoff`, up to `max_interval`. An idle card is polled rarely, but a
+    burst of new photos is picked up quickly.
+
+    `polls` and `changes` count the polls issued and the ones that
+    detected a change. `wake` cuts the current wait short, e.g. to stop a
+    watcher thread. A watcher that waits some other way (e.g. on inotify)
+    registers a callback with `add_wake_callback` to be woken too.
+    """
+
+    def __init__(self, min_interval=DEFAULT_MIN_INTERVAL,
+                 max_interval=DEFAULT_MAX_INTERVAL, backoff=1.5):
+        assert 0 <= min_interval <= max_interval, "Bad poll intervals"
+        assert backoff >= 1, "Backoff must not shrink the interval"
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.polls = 0
+        self.changes = 0
+        self._wake = threading.Event()
+        self._wake_callbacks = []
+
+    def record(self, changed):
+        """Records the outcome of a poll and adjusts the interval"""
+        self.polls += 1
+        if changed:
+            self.changes += 1
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff,
+                                self.max_interval)
+
+    def wait(self):
+        """Sleeps until the next poll is due (or `wake` is called)"""
+        self._wake.wait(self.interval)
+        self._wake.clear()
+
+    def wake(self):
+        self._wake.set()
+        for callback in list(self._wake_callbacks):
+            callback()
+
+    def add_wake_callback(self, callback):
+        self._wake_callbacks.append(callback)
+
+    def remove_wake_callback(self, callback):
+        self._wake_callbacks.remove(callback)
+
+    def reset(self):
+        self.interval = self.min_interval
+        self.polls = self.changes = 0
+
+    def __repr__(self):
+        return ("PollScheduler(interval={:0.2f}, polls={:d}, "
+                "changes={:d})".format(self.interval, self.polls,
+                                       self.changes))
@@ -0,0 +1,225 @@
+"""Downloads new files from several FlashAir cards in one process.
+
+>>> rig = Supervisor([Target("http://cam1/", "/DCIM/100__TSB", "cam1"),
+...                   Target("http://cam2/", "/DCIM/100__TSB", "cam2")])
+>>> rig.start()
+>>> rig.status()  # one CardStatus per target
+>>> rig.stop()
+
+Each card is polled by its own thread, paced by its own
+`poll.PollScheduler`, so a card that's slow to answer (or gone) doesn't
+hold up noticing new files on the others. New files go into a queue per
+card and are downloaded by a shared pool of worker threads. Workers always take
+the next file from the card with the fewest downloads in progress,
+so a card with hundreds of new files can't starve the others.
+"""
+
+import logging
+import os
+import time
+
+from collections import deque, namedtuple
+
+from . import sync
+from .info import URL, DEFAULT_REMOTE_DIR
+from .poll import PollScheduler
+from .work import WorkQueue
+
+
+logger = logging.getLogger(__name__)
+
+
+Target = namedtuple("Target", "url remote_dir local_dir")
+Target.__new__.__defaults__ = (URL, DEFAULT_REMOTE_DIR, ".")
+
+CardStatus = namedtuple(
+    "CardStatus", "target state pending active synced failed nbytes "
+                  "last_poll last_error")
+
+
+class Supervisor(WorkQueue):
+    """Watches each `Target` for new files and downloads them with up to
+    `workers` downloads at a time across all cards. Filters and the
+    optional `index.RemoteIndex` apply to every target. Each card is
+    polled on a schedule of its own with the intervals of `scheduler`.
+    With a `journal.Journal`, each card catches up on files that arrived
+    since the previous run. Downloads are committed to disk with
+    `fsync_policy`, a batching `sync.FsyncPolicy` by default."""
+
+    def __init__(self, targets, *filters, workers=sync.DEFAULT_WORKERS,
+                 scheduler=None, index=None, journal=None, fsync_policy=None):
+        super().__init__()
+        self.filters = filters
+        self.workers = workers
+        self.scheduler = scheduler or PollScheduler()
+        self.cards = [_Card(Target(*target), PollScheduler(
+                            self.scheduler.min_interval,
+                            self.scheduler.max_interval,
+                            self.scheduler.backoff))
+                      for target in targets]
+        self.index = index
+        self.journal = journal
+        self.fsync_policy = fsync_policy or sync.FsyncPolicy()
+        self._next_card = 0
+
+    def status(self):
+        """Returns a `CardStatus` for each target"""
+        with self._work:
+            return [card.status() for card in self.cards]
+
+    def _thread_targets(self):
+        for i, card in enumerate(self.cards):
+            yield "tfatool-poll-{:d}".format(i), self._poll_loop, (card,)
+        for i in range(self.workers):
+            yield "tfatool-worker-{:d}".format(i), self._work_loop, ()
+
+    def _schedulers(self):
+        return [card.scheduler for card in self.cards]
+
+    ##############
+    # Polling
+
+    def _poll_loop(self, card):
+        while self.running.is_set():
+            card.scheduler.record(self._poll(card))
+            card.scheduler.wait()
+
+    def _poll(self, card):
+        """Checks one card for new files and queues them. Returns True if
+        any were found. Errors mark the card offline until it answers.
+
+        Like `sync.Monitor`, files already on a card when it's first polled
+        are ignored. Files that appear while a card is offline are picked
+        up when it's back."""
+        try:
+            if card.watcher is None:
+                card.watcher = sync.watch_remote_files(
+                    *self.filters, remote_dir=card.target.remote_dir,
+                    url=card.target.url, index=self.index)
+                _, all_files = next(card.watcher)
+                known = card.known
+                if known is None and self.journal is not None:
+                    known = self.journal.resume(
+                        card.target.url, sync.Direction.down,
+                        card.target.remote_dir, all_files,
+                        card.target.local_dir)
+                elif known is None:
+                    known = all_files
+                new_files = all_files - known
+            else:
+                new_files, all_files = next(card.watcher)
+        except Exception as e:
+            logger.warning("Polling {} failed: {}({})".format(
+                           card.target.url, e.__class__.__name__, e))
+            with self._work:
+                card.watcher = None
+                card.last_error = e
+                card.online = False
+                card.last_poll = time.time()
+            return False
+        with self._work:
+            card.online = True
+            card.known = all_files
+            card.last_poll = time.time()
+            card.pending.extend(sorted(new_files,
+                                       key=lambda f: f.datetime))
+            if new_files:
+                self._work.notify_all()
+        return bool(new_files)
+
+    ##############
+    # Downloading
+
+    def _work_loop(self):
+        with sync._flushing(self.fsync_policy):
+            while True:
+                job = self._take(wait=False)
+                if job is None:
+                    # catch up on fsyncs while there's nothing to do
+                    self.fsync_policy.flush()
+                    job = self._take()
+                if job is None:
+                    return
+                card, fileinfo = job
+                digest = None
+                if self.journal is not None:
+                    digest = self.journal.digest()
+                try:
+                    copied = sync._sync_remote_file(
+                        card.target.local_dir, fileinfo, card.target.url,
+                        digest, self.fsync_policy)
+                    if self.journal is not None:
+                        self._record(card, fileinfo,
+                                     digest if copied else None)
+                except Exception as e:
+                    logger.error("Failed to sync {} from {}: {}({})".format(
+                                 fileinfo.filename, card.target.url,
+                                 e.__class__.__name__, e))
+                    with self._work:
+                        card.failed += 1
+                        card.last_error = e
+                else:
+                    with self._work:
+                        if copied:
+                            card.synced += 1
+                            card.nbytes += fileinfo.size
+                finally:
+                    with self._work:
+                        card.active -= 1
+                        self._work.notify_all()
+
+    def _record(self, card, fileinfo, digest=None):
+        card_id = self.journal.card_id(card.target.url)
+        self.journal.record(card_id, sync.Direction.down, fileinfo,
+                            card.target.local_dir)
+        if digest is not None:
+            local_path = os.path.join(card.target.local_dir,
+                                      fileinfo.filename)
+            self.journal.record_checksum(card_id, sync.Direction.down,
+                                         local_path, fileinfo.path, digest)
+
+    def _pop(self):
+        job = self._next_job()
+        if job is not None:
+            job[0].active += 1
+        return job
+
+    def _next_job(self):
+        """Picks a queued file from the card with the fewest downloads
+        in progress, breaking ties in round-robin order"""
+        n_cards = len(self.cards)
+        order = [self.cards[(self._next_card + i) % n_cards]
+                 for i in range(n_cards)]
+        waiting = [card for card in order if card.pending]
+        if not waiting:
+            return None
+        card = min(waiting, key=lambda c: c.active)
+        self._next_card = (self.cards.index(card) + 1) % n_cards
+        return card, card.pending.popleft()
+
+
+class _Card:
+    def __init__(self, target, scheduler):
+        self.target = target
+        self.scheduler = scheduler
+        self.watcher = None
+        self.known = None  # files seen in the last successful poll
+        self.online = None  # not polled yet
+        self.pending = deque()
+        self.active = 0
+        self.synced = self.failed = self.nbytes = 0
+        self.last_poll = None
+        self.last_error = None
+
+    def status(self):
+        if self.online is None:
+            state = "starting"
+        elif not self.online:
+            state = "offline"
+        elif self.pending or self.active:
+            state = "syncing"
+        else:
+            state = "idle"
+        return CardStatus(self.target, state, len(self.pending), self.active,
+                          self.synced, self.failed, self.nbytes,
+                          self.last_poll, self.last_error)
@@ -1,18 +1,25 @@
+import json
 import logging
 import os
 import threading
 import time
 
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import Enum
 from functools import partial
-from pathlib import Path
-from urllib.parse import urljoin
+from pathlib import Path, PurePosixPath
 
 import arrow
 import requests
 import tqdm
 
-from . import command, upload
+from . import cgi, command, fattime, inotify, trace, upload
+from .filters import split_filters
+from .journal import SYNCED, file_key
+from .poll import PollScheduler
+from .work import WorkQueue
 from .info import URL, DEFAULT_REMOTE_DIR
 from .info import RawFileInfo, SimpleFileInfo
 
@@ -28,11 +35,58 @@ else:
     scandir = scandir.scandir
 
 
+# FlashAir's embedded HTTP server falls over with more than a few
+# simultaneous connections, so parallel downloads are kept modest by default
+DEFAULT_WORKERS = 3
+
+# Downloads in progress are written to "<name>.part" and described by a
+# "<name>.part.json" sidecar so they can be resumed after an interruption
+PART_SUFFIX = ".part"
+PART_INFO_SUFFIX = ".part.json"
+
+# A `Pipeline` stops polling for new files while this many are waiting
+# to be transferred
+DEFAULT_QUEUE_SIZE = 32
+
+# Downloads are read straight from the socket into a reusable buffer of
+# this many bytes per thread, then written to disk
+DEFAULT_CHUNK_SIZE = 512 * 1024
+
+# Download progress bars are updated at most this often (seconds)
+PROGRESS_INTERVAL = 0.25
+
+# With the default "batch" `FsyncPolicy`, finished downloads are flushed
+# to disk once this many have piled up, or this many seconds after the
+# first of them
+DEFAULT_FSYNC_FILES = 32
+DEFAULT_FSYNC_SECONDS = 2.0
+
+
 class Direction(str, Enum):
     up = "upload"  # upload direction
     down = "download"  # download direction
 
 
+SyncPlan = namedtuple("SyncPlan", "download replace skip")
+
+
+class SyncReport(namedtuple("SyncReport",
+                            "synced skipped failed nbytes duration")):
+    """Aggregate result of a batch of transfers. `synced` and `skipped` are
+    lists of file infos, `failed` is a list of (file info, exception) pairs
+    and `nbytes` counts only the bytes actually transferred"""
+
+    @property
+    def rate(self):
+        """Throughput of the batch in MB/s"""
+        if not self.duration:
+            return 0.0
+        return self.nbytes / (self.duration * 10**6)
+
+
+Transfer = namedtuple("Transfer", "direction fileinfo copied error duration")
+
+
 #####################################
 # Synchronizing newly created files
 
@@ -41,108 +95,461 @@ class Monitor:
     in separate threads"""
 
     def __init__(self, *filters, local_dir=".",
-                 remote_dir=DEFAULT_REMOTE_DIR):
+                 remote_dir=DEFAULT_REMOTE_DIR, url=URL, index=None,
+                 scheduler=None, workers=DEFAULT_WORKERS, on_transfer=None,
+                 journal=None, fsync_policy=None):
         self._filters = filters
-        self._local_dir = local_dir
-        self._remote_dir = remote_dir
-        self.running = threading.Event()
-        self.thread = None
-
-    def _run(self, method):
-        assert self.thread is None
-        self.running.set()
-        self.thread = threading.Thread(target=self._run_sync, args=(method,))
-        self.thread.start()
-
-    def _run_sync(self, method):
-        files = method(*self._filters, local_dir=self._local_dir,
-                       remote_dir=self._remote_dir)
-        while self.running.is_set():
-            _, new = next(files)
-            if not new:
-                time.sleep(0.3)
+        self._options = dict(local_dir=local_dir, remote_dir=remote_dir,
+                             url=url, index=index, workers=workers,
+                             on_transfer=on_transfer, journal=journal,
+                             fsync_policy=fsync_policy)
+        self.scheduler = scheduler or PollScheduler()
+        self.engine = None  # the running `Pipeline` or `TwoWaySync`
+
+    def _start(self, engine):
+        assert self.engine is None
+        self.engine = engine
+        engine.start()
 
     def sync_both(self):
-        self._run(up_down_by_arrival)
+        self._start(TwoWaySync(*self._filters, scheduler=self.scheduler,
+                               **self._options))
 
     def sync_up(self):
-        self._run(up_by_arrival)
+        self._start(Pipeline(*self._filters, direction=Direction.up,
+                             scheduler=self.scheduler, **self._options))
 
     def sync_down(self):
-        self._run(down_by_arrival)
+        self._start(Pipeline(*self._filters, direction=Direction.down,
+                             scheduler=self.scheduler, **self._options))
+
+    def stop(self):
+        if self.engine:
+            self.engine.stop()
+
+    def join(self):
+        if self.engine:
+            self.engine.join()
+        self.engine = None
+
+
+class Pipeline(WorkQueue):
+    """Transfers new files in one direction while watching for more.
+
+    A detector thread polls for new files (paced by `scheduler`) and
+    queues them. `workers` transfer threads drain the queue, oldest file
+    first. Once `queue_size` files are waiting, the detector stops polling
+    until a transfer finishes. FlashAir has a single upload directory
+    setting, so uploads always use one transfer thread.
+
+    `on_transfer` is called from a transfer thread with a `Transfer`
+    after each file has been transferred, skipped or has failed.
+    Files that match an entry of `ledger` aren't queued. A `recursive`
+    download pipeline mirrors the whole tree below `remote_dir`.
+
+    Files already there when the pipeline starts are left alone. With a
+    `journal.Journal`, files that arrived since the previous run with the
+    same journal are transferred first, and each transfer is recorded.
+    Downloads are committed to disk with `fsync_policy`, a batching
+    `FsyncPolicy` by default, which is flushed whenever the queue is empty.
+    """
+
+    def __init__(self, *filters, direction=Direction.down, local_dir=".",
+                 remote_dir=DEFAULT_REMOTE_DIR, url=URL, index=None,
+                 workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE,
+                 scheduler=None, on_transfer=None, ledger=None,
+                 recursive=False, journal=None, fsync_policy=None):
+        assert queue_size > 0, "The queue must hold at least one file"
+        assert not recursive or direction == Direction.down, \
+            "Only downloads can be recursive"
+        super().__init__()
+        self.filters = filters
+        self.direction = Direction(direction)
+        self.local_dir = local_dir
+        self.remote_dir = remote_dir
+        self.url = url
+        self.index = index
+        self.workers = workers if self.direction is Direction.down else 1
+        self.queue_size = queue_size
+        self.scheduler = scheduler or PollScheduler()
+        self.on_transfer = on_transfer
+        self.ledger = ledger
+        self.recursive = recursive
+        self.journal = journal
+        self.fsync_policy = fsync_policy or FsyncPolicy()
+        self.pending = deque()
+        self.active = 0
+        self.detected = self.synced = self.skipped = self.failed = 0
+        self.nbytes = 0
+
+    def _thread_targets(self):
+        transfer_loop = (self._download_loop
+                         if self.direction is Direction.down
+                         else self._upload_loop)
+        yield "tfatool-detect", self._detect_loop, ()
+        for i in range(self.workers):
+            yield "tfatool-transfer-{:d}".format(i), transfer_loop, ()
+
+    def _schedulers(self):
+        return [self.scheduler]
+
+    ##############
+    # Detection
+
+    def _watch(self):
+        if self.direction is Direction.down:
+            return watch_remote_files(
+                *self.filters, remote_dir=self.remote_dir, url=self.url,
+                index=self.index, scheduler=self.scheduler,
+                recursive=self.recursive)
+        return watch_local_files(*self.filters, local_dir=self.local_dir,
+                                 scheduler=self.scheduler)
+
+    def _detect_loop(self):
+        """Queues new files until stopped. If polling fails, the watcher
+        is restarted and files that appeared meanwhile are still queued."""
+        known = None  # files seen in the last successful poll
+        from_dir, to_dir = self.local_dir, self.remote_dir
+        if self.direction is Direction.down:
+            from_dir, to_dir = to_dir, from_dir
+        while self.running.is_set():
+            try:
+                watcher = self._watch()
+                _, all_files = next(watcher)
+                if known is None:
+                    known = self._resume(all_files)
+                    _notify_sync_ready(len(known), from_dir, to_dir)
+                new_files = all_files - known
+                while self.running.is_set():
+                    known = all_files
+                    if new_files:
+                        _notify_sync(self.direction, new_files)
+                        self._queue(sorted(new_files,
+                                           key=lambda f: f.datetime))
+                    new_files, all_files = next(watcher)
+            except Exception as e:
+                logger.warning("Watching for new files failed: {}({})".format(
+                               e.__class__.__name__, e))
+                self.scheduler.record(False)
+                self.scheduler.wait()
+
+    def _resume(self, all_files):
+        """Returns the files found on startup that needn't be transferred"""
+        if self.journal is None:
+            return all_files
+        if self.direction is Direction.down:
+            root = self.remote_dir
+        else:
+            root = os.path.abspath(self.local_dir)
+        return self.journal.resume(self.url, self.direction, root, all_files,
+                                   self.local_dir)
+
+    def _queue(self, files):
+        """Queues `files`, waiting while the queue is full"""
+        for fileinfo in files:
+            if self.ledger is not None and self.ledger.is_echo(fileinfo):
+                logger.info("Skipping '{}': it was just transferred the "
+                            "other way".format(fileinfo.filename))
+                continue
+            with self._work:
+                while (len(self.pending) >= self.queue_size and
+                       self.running.is_set()):
+                    self._work.wait()
+                if not self.running.is_set():
+                    return
+                self.pending.append(fileinfo)
+                self.detected += 1
+                self._work.notify_all()
+
+    ##############
+    # Transfers
+
+    def _pop(self):
+        if not self.pending:
+            return None
+        self.active += 1
+        return self.pending.popleft()
+
+    def _next_file(self, wait=True):
+        """Takes the next queued file, like `WorkQueue._take`"""
+        fileinfo = self._take(wait)
+        if fileinfo is not None and self.ledger is not None:
+            self.ledger.begin(fileinfo)
+        return fileinfo
+
+    def _download_loop(self):
+        with _flushing(self.fsync_policy):
+            fileinfo = self._next_file()
+            while fileinfo is not None:
+                self._transfer(fileinfo, self._download, fileinfo)
+                fileinfo = self._next_file(wait=False)
+                if fileinfo is None:
+                    # catch up while there's nothing to do
+                    self.fsync_policy.flush()
+                    fileinfo = self._next_file()
+
+    def _download(self, fileinfo, digest=None):
+        remote_root = self.remote_dir if self.recursive else None
+        local_dir = _mirror_dir(self.local_dir, fileinfo, remote_root)
+        return _sync_remote_file(local_dir, fileinfo, self.url, digest,
+                                 self.fsync_policy)
+
+    def _upload_loop(self):
+        """Uploads queued files, opening one upload session for each run
+        of files that arrive while earlier ones are being uploaded"""
+        fileinfo = self._next_file()
+        while fileinfo is not None:
+            try:
+                remote_files = (self.index or command).map_files_raw(
+                    remote_dir=self.remote_dir, url=self.url)
+                session = upload.UploadSession(self.remote_dir, url=self.url)
+            except Exception as e:
+                self._finished(fileinfo, False, e, 0)
+                fileinfo = self._next_file()
+                continue
+            try:
+                with session:
+                    while fileinfo is not None:
+                        self._transfer(fileinfo, _sync_local_file, fileinfo,
+                                       remote_files, session)
+                        fileinfo = self._next_file(wait=False)
+            except Exception as e:
+                logger.error("Failed to close upload session: {}({})".format(
+                             e.__class__.__name__, e))
+            finally:
+                if self.index is not None and session.is_dirty:
+                    self.index.invalidate(session.url, self.remote_dir)
+            fileinfo = self._next_file()
+
+    def _transfer(self, fileinfo, sync_file, *args):
+        start = time.time()
+        digest = self.journal.digest() if self.journal is not None else None
+        try:
+            copied = sync_file(*args, digest=digest)
+        except Exception as e:
+            logger.error("Failed to sync {}: {}({})".format(
+                         fileinfo.filename, e.__class__.__name__, e))
+            self._finished(fileinfo, False, e, time.time() - start)
+        else:
+            self._finished(fileinfo, copied, None, time.time() - start,
+                           digest if copied else None)
+
+    def _finished(self, fileinfo, copied, error, duration, digest=None):
+        with self._work:
+            self.active -= 1
+            if error is not None:
+                self.failed += 1
+            elif copied:
+                self.synced += 1
+                self.nbytes += fileinfo.size
+            else:
+                self.skipped += 1
+        if self.ledger is not None:
+            self.ledger.end(fileinfo, error is None)
+        if self.journal is not None and error is None:
+            try:
+                self._record(fileinfo, digest)
+            except Exception as e:
+                logger.error("Failed to journal {}: {}({})".format(
+                             fileinfo.filename, e.__class__.__name__, e))
+        if self.on_transfer is not None:
+            transfer = Transfer(self.direction, fileinfo, copied, error,
+                                duration)
+            try:
+                self.on_transfer(transfer)
+            except Exception as e:
+                logger.error("Transfer callback failed: {}({})".format(
+                             e.__class__.__name__, e))
+
+    def _record(self, fileinfo, digest=None):
+        """Journals a synced file along with its copy on the other side,
+        so that a restarted `TwoWaySync` doesn't send the copy back.
+        The `digest` of a transferred file is journaled too."""
+        card = self.journal.card_id(self.url)
+        self.journal.record(card, self.direction, fileinfo, self.local_dir)
+        if self.direction is Direction.down:
+            remote_root = self.remote_dir if self.recursive else None
+            local_dir = _mirror_dir(self.local_dir, fileinfo, remote_root)
+            stat = _stat_finished(os.path.join(local_dir, fileinfo.filename))
+            copy = _local_file_info(local_dir, fileinfo.filename, stat)
+            self.journal.record(card, Direction.up, copy, self.local_dir)
+            local_path, remote_path = copy.path, fileinfo.path
+        else:
+            remote_path = str(PurePosixPath(self.remote_dir,
+                                            fileinfo.filename))
+            copy = fileinfo._replace(directory=self.remote_dir,
+                                     path=remote_path)
+            self.journal.record(card, Direction.down, copy, self.local_dir)
+            local_path = fileinfo.path
+        if digest is not None:
+            self.journal.record_checksum(card, self.direction, local_path,
+                                         remote_path, digest)
+
+
+class TwoWaySync:
+    """Uploads new local files and downloads new remote files at the
+    same time, with a `Pipeline` for each direction. Each direction polls
+    on its own schedule, so a slow card doesn't hold up noticing new
+    local files. A shared `Ledger` keeps files from bouncing back to the
+    side they came from."""
+
+    def __init__(self, *filters, local_dir=".", remote_dir=DEFAULT_REMOTE_DIR,
+                 url=URL, index=None, workers=DEFAULT_WORKERS,
+                 queue_size=DEFAULT_QUEUE_SIZE, scheduler=None,
+                 on_transfer=None, ledger=None, journal=None,
+                 fsync_policy=None):
+        self.ledger = ledger if ledger is not None else Ledger()
+        scheduler = scheduler or PollScheduler()
+        local_scheduler = PollScheduler(scheduler.min_interval,
+                                        scheduler.max_interval,
+                                        scheduler.backoff)
+        options = dict(local_dir=local_dir, remote_dir=remote_dir, url=url,
+                       index=index, queue_size=queue_size,
+                       on_transfer=on_transfer, ledger=self.ledger,
+                       journal=journal)
+        self.down = Pipeline(*filters, direction=Direction.down,
+                             workers=workers, scheduler=scheduler,
+                             fsync_policy=fsync_policy, **options)
+        self.up = Pipeline(*filters, direction=Direction.up,
+                           scheduler=local_scheduler, **options)
+
+    def start(self):
+        self.down.start()
+        self.up.start()
 
     def stop(self):
-        self.running.clear()
+        self.down.stop()
+        self.up.stop()
 
     def join(self):
-        if self.thread:
-            self.thread.join()
-        self.thread = None
+        self.down.join()
+        self.up.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        self.join()
+
+
+class Ledger:
+    """Remembers the name and size of each file transferred in either
+    direction. A file matching an entry, or one whose transfer is still in
+    progress, is our own copy showing up on the other side."""
+
+    def __init__(self):
+        self._sizes = {}
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def begin(self, fileinfo):
+        with self._lock:
+            self._active.add(fileinfo.filename)
+            self._sizes[fileinfo.filename] = fileinfo.size
+
+    def end(self, fileinfo, ok=True):
+        with self._lock:
+            self._active.discard(fileinfo.filename)
+            if not ok:
+                self._sizes.pop(fileinfo.filename, None)
+
+    def is_echo(self, fileinfo):
+        with self._lock:
+            return (fileinfo.filename in self._active or
+                    self._sizes.get(fileinfo.filename) == fileinfo.size)
+
+    def __len__(self):
+        return len(self._sizes)
 
 
 def up_down_by_arrival(*filters, local_dir=".",
-                       remote_dir=DEFAULT_REMOTE_DIR):
+                       remote_dir=DEFAULT_REMOTE_DIR, url=URL, index=None,
+                       scheduler=None):
     """Monitors a local directory and a remote FlashAir directory and
     generates sets of new files to be uploaded or downloaded.
     Sets to upload are generated in a tuple
     like (Direction.up, {...}), while download sets to download
     are generated in a tuple like (Direction.down, {...}). The generator yields
-    before each upload or download actually takes place."""
+    before each upload or download actually takes place.
+
+    Local and remote directories are polled in lockstep; `TwoWaySync`
+    watches both independently and transfers in both directions at once."""
     local_monitor = watch_local_files(*filters, local_dir=local_dir)
-    remote_monitor = watch_remote_files(*filters, remote_dir=remote_dir)
+    remote_monitor = watch_remote_files(*filters, remote_dir=remote_dir,
+                                        url=url, index=index,
+                                        scheduler=scheduler)
     _, lfile_set = next(local_monitor)
     _, rfile_set = next(remote_monitor)
     _notify_sync_ready(len(lfile_set), local_dir, remote_dir)
     _notify_sync_ready(len(rfile_set), remote_dir, local_dir)
-    processed = set()
+    ledger = Ledger()
     for new_local, new_remote in zip(local_monitor, remote_monitor):
         new_local, local_set = new_local
-        local_arrivals = {f for f in new_local if f.filename not in processed}
+        local_arrivals = {f for f in new_local if not ledger.is_echo(f)}
         yield Direction.up, local_arrivals
         if local_arrivals:
-            new_names.update(f.filename for f in local_arrivals)
+            for f in local_arrivals:
+                ledger.begin(f)
             _notify_sync(Direction.up, local_arrivals)
-            up_by_files(local_arrivals, remote_dir)
+            try:
+                up_by_files(local_arrivals, remote_dir, url=url, index=index)
+            except BaseException:
+                for f in local_arrivals:
+                    ledger.end(f, ok=False)
+                raise
+            for f in local_arrivals:
+                ledger.end(f)
             _notify_sync_ready(len(local_set), local_dir, remote_dir)
         new_remote, remote_set = new_remote
-        remote_arrivals = {f for f in new_remote if f.filename not in processed}
+        remote_arrivals = {f for f in new_remote if not ledger.is_echo(f)}
         yield Direction.down, remote_arrivals
         if remote_arrivals:
-            new_names.update(f.filename for f in remote_arrivals)
+            for f in remote_arrivals:
+                ledger.begin(f)
             _notify_sync(Direction.down, remote_arrivals)
-            yield Direction.down, remote_arrivals
-            down_by_files(remote_arrivals, local_dir)
+            report = down_by_files(remote_arrivals, local_dir, url=url)
+            for f in remote_arrivals:
+                ledger.end(f)
+            for f, _ in report.failed:
+                ledger.end(f, ok=False)
             _notify_sync_ready(len(remote_set), remote_dir, local_dir)
 
 
-def up_by_arrival(*filters, local_dir=".", remote_dir=DEFAULT_REMOTE_DIR):
+def up_by_arrival(*filters, local_dir=".", remote_dir=DEFAULT_REMOTE_DIR,
+                  url=URL, index=None, scheduler=None):
     """Monitors a local directory and
     generates sets of new files to be uploaded to FlashAir.
     Sets to upload are generated in a tuple like (Direction.up, {...}).
     The generator yields before each upload actually takes place."""
-    local_monitor = watch_local_files(*filters, local_dir=local_dir)
+    local_monitor = watch_local_files(*filters, local_dir=local_dir,
+                                      scheduler=scheduler)
     _, file_set = next(local_monitor)
     _notify_sync_ready(len(file_set), local_dir, remote_dir)
     for new_arrivals, file_set in local_monitor:
         yield Direction.up, new_arrivals  # where new_arrivals is possibly empty
         if new_arrivals:
             _notify_sync(Direction.up, new_arrivals)
-            up_by_files(new_arrivals, remote_dir)
+            up_by_files(new_arrivals, remote_dir, url=url, index=index)
             _notify_sync_ready(len(file_set), local_dir, remote_dir)
 
 
-def down_by_arrival(*filters, local_dir=".", remote_dir=DEFAULT_REMOTE_DIR):
+def down_by_arrival(*filters, local_dir=".", remote_dir=DEFAULT_REMOTE_DIR,
+                    url=URL, index=None, scheduler=None):
     """Monitors a remote FlashAir directory and generates sets of
     new files to be downloaded from FlashAir.
     Sets to download are generated in a tuple like (Direction.down, {...}).
     The generator yields AFTER each download actually takes place."""
-    remote_monitor = watch_remote_files(*filters, remote_dir=remote_dir)
+    remote_monitor = watch_remote_files(*filters, remote_dir=remote_dir,
+                                        url=url, index=index,
+                                        scheduler=scheduler)
     _, file_set = next(remote_monitor)
     _notify_sync_ready(len(file_set), remote_dir, local_dir)
     for new_arrivals, file_set in remote_monitor:
         if new_arrivals:
             _notify_sync(Direction.down, new_arrivals)
-            down_by_files(new_arrivals, local_dir)
+            down_by_files(new_arrivals, local_dir, url=url)
             _notify_sync_ready(len(file_set), remote_dir, local_dir)
         yield Direction.down, new_arrivals
 
@@ -150,98 +557,552 @@ def down_by_arrival(*filters, local_dir=".", remote_dir=DEFAULT_REMOTE_DIR):
 ###################################################
 # Sync ONCE in the DOWN (from FlashAir) direction
 
-def down_by_all(*filters, remote_dir=DEFAULT_REMOTE_DIR, local_dir=".", **_):
-    files = command.list_files(*filters, remote_dir=remote_dir)
-    down_by_files(files, local_dir=local_dir)
-
-
-def down_by_files(to_sync, local_dir="."):
-    """Sync a given list of files from `command.list_files` to `local_dir` dir"""
-    for f in to_sync:
-        _sync_remote_file(local_dir, f)
-
-
-def down_by_time(*filters, remote_dir=DEFAULT_REMOTE_DIR, local_dir=".", count=1):
+def down_by_all(*filters, remote_dir=DEFAULT_REMOTE_DIR, local_dir=".",
+                url=URL, workers=DEFAULT_WORKERS, index=None, recursive=False,
+                journal=None, fsync_policy=None, **_):
+    files = list_remote_files(*filters, remote_dir=remote_dir, url=url,
+                              index=index, recursive=recursive)
+    return down_by_files(files, local_dir=local_dir, url=url, workers=workers,
+                         remote_root=remote_dir if recursive else None,
+                         journal=journal, fsync_policy=fsync_policy)
+
+
+def down_by_files(to_sync, local_dir=".", url=URL, workers=DEFAULT_WORKERS,
+                  remote_root=None, journal=None, snapshot=None,
+                  fsync_policy=None):
+    """Sync a given list of files from `command.list_files` to `local_dir` dir
+    with up to `workers` simultaneous downloads. A failed download doesn't
+    stop the others; failures are collected in the returned `SyncReport`.
+    With a `remote_root`, files are saved in subdirectories of `local_dir`
+    that mirror their remote directories below `remote_root`.
+    With a `journal.Journal`, files it lists as synced into `local_dir`
+    are skipped if they're still there, without comparing sizes, and each
+    file synced is recorded (along with its checksums, if the journal
+    keeps them).
+
+    What to download is planned up front with `plan_down`. Pass a
+    `LocalSnapshot` to reuse one across batches; it's kept up to date.
+    Finished files are committed with `fsync_policy`, by default a
+    batching `FsyncPolicy` that's flushed before returning."""
+    start = time.time()
+    if fsync_policy is None:
+        fsync_policy = FsyncPolicy()
+    synced, skipped, failed = [], [], []
+    if snapshot is None:
+        snapshot = LocalSnapshot()
+    if journal is not None:
+        card = journal.card_id(url)
+        done = journal.keys(card, Direction.down, local_dir, SYNCED)
+        to_sync = list(to_sync)
+        skipped = [f for f in to_sync if file_key(f) in done and
+                   snapshot.exists(_mirror_dir(local_dir, f, remote_root),
+                                   f.filename)]
+        journaled = set(skipped)
+        to_sync = [f for f in to_sync if f not in journaled]
+    plan = plan_down(to_sync, local_dir, remote_root, snapshot)
+    if plan.skip:
+        logger.info("Skipping {:d} files that already exist locally".format(
+                    len(plan.skip)))
+        skipped.extend(plan.skip)
+        if journal is not None:
+            journal.record_all(card, Direction.down, plan.skip, local_dir)
+    jobs = [(f, False) for f in plan.download]
+    jobs.extend((f, True) for f in plan.replace)
+    digests = [journal.digest() if journal is not None else None
+               for _ in jobs]
+    local_names = []
+    with _flushing(fsync_policy), \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_download_remote_file,
+                               _mirror_dir(local_dir, f, remote_root), f, url,
+                               replace, digest, fsync_policy): (f, digest)
+                   for (f, replace), digest in zip(jobs, digests)}
+        try:
+            for future in as_completed(futures):
+                fileinfo, digest = futures[future]
+                local_name = os.path.join(
+                    _mirror_dir(local_dir, fileinfo, remote_root),
+                    fileinfo.filename)
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error("Failed to sync {}: {}({})".format(
+                                 fileinfo.filename, e.__class__.__name__, e))
+                    failed.append((fileinfo, e))
+                else:
+                    synced.append(fileinfo)
+                    if journal is not None:
+                        journal.record(card, Direction.down, fileinfo,
+                                       local_dir)
+                    if digest is not None:
+                        journal.record_checksum(card, Direction.down,
+                                                local_name, fileinfo.path,
+                                                digest)
+                local_names.append(local_name)
+        except KeyboardInterrupt:
+            for future in futures:
+                future.cancel()
+            raise
+    for local_name in local_names:
+        snapshot.refresh(local_name)  # renamed by the flush
+    nbytes = sum(f.size for f in synced)
+    report = SyncReport(synced, skipped, failed, nbytes, time.time() - start)
+    _notify_report(Direction.down, report)
+    return report
+
+
+def down_by_time(*filters, remote_dir=DEFAULT_REMOTE_DIR, local_dir=".",
+                 url=URL, count=1, workers=DEFAULT_WORKERS, index=None,
+                 recursive=False, journal=None, fsync_policy=None):
     """Sync most recent file by date, time attribues"""
-    files = command.list_files(*filters, remote_dir=remote_dir)
+    files = list_remote_files(*filters, remote_dir=remote_dir, url=url,
+                              index=index, recursive=recursive)
     most_recent = sorted(files, key=lambda f: f.datetime)
     to_sync = most_recent[-count:]
     _notify_sync(Direction.down, to_sync)
-    down_by_files(to_sync[::-1], local_dir=local_dir)
+    return down_by_files(to_sync[::-1], local_dir=local_dir, url=url,
+                         workers=workers,
+                         remote_root=remote_dir if recursive else None,
+                         journal=journal, fsync_policy=fsync_policy)
 
 
-def down_by_name(*filters, remote_dir=DEFAULT_REMOTE_DIR, local_dir=".", count=1):
+def down_by_name(*filters, remote_dir=DEFAULT_REMOTE_DIR, local_dir=".",
+                 url=URL, count=1, workers=DEFAULT_WORKERS, index=None,
+                 recursive=False, journal=None, fsync_policy=None):
     """Sync files whose filename attribute is highest in alphanumeric order"""
-    files = command.list_files(*filters, remote_dir=remote_dir)
+    files = list_remote_files(*filters, remote_dir=remote_dir, url=url,
+                              index=index, recursive=recursive)
     greatest = sorted(files, key=lambda f: f.filename)
     to_sync = greatest[-count:]
     _notify_sync(Direction.down, to_sync)
-    down_by_files(to_sync[::-1], local_dir=local_dir)
+    return down_by_files(to_sync[::-1], local_dir=local_dir, url=url,
+                         workers=workers,
+                         remote_root=remote_dir if recursive else None,
+                         journal=journal, fsync_policy=fsync_policy)
+
+
+def list_remote_files(*filters, remote_dir=DEFAULT_REMOTE_DIR, url=URL,
+                      index=None, recursive=False):
+    """Lists the files in FlashAir's `remote_dir`, or with `recursive`
+    every file below it"""
+    if not recursive:
+        return (index or command).list_files(*filters, remote_dir=remote_dir,
+                                             url=url)
+    if index is not None:
+        index.revalidate(url)
+    return command.walk_remote(*filters, remote_dir=remote_dir, url=url,
+                               index=index)
+
+
+def plan_down(to_sync, local_dir=".", remote_root=None, snapshot=None):
+    """Sorts remote files into a `SyncPlan`: files missing locally
+    (`download`), files whose local copy has a different size (`replace`)
+    and files already there (`skip`). Local files are looked up in a
+    `LocalSnapshot`, which reads each directory once and only stats the
+    names that are also in `to_sync`. `remote_root` is as for
+    `down_by_files`."""
+    if snapshot is None:
+        snapshot = LocalSnapshot()
+    plan = SyncPlan([], [], [])
+    for fileinfo in to_sync:
+        local_dir_of_file = _mirror_dir(local_dir, fileinfo, remote_root)
+        local = snapshot.get(local_dir_of_file, fileinfo.filename)
+        if local is None:
+            plan.download.append(fileinfo)
+        elif local.size != fileinfo.size:
+            plan.replace.append(fileinfo)
+        else:
+            plan.skip.append(fileinfo)
+    return plan
+
+
+LocalFile = namedtuple("LocalFile", "size mtime")
+
+
+class LocalSnapshot:
+    """Sizes and modification times of the files in local directories.
+    The names in each directory are read with one `scandir` the first
+    time it's looked at; a file is only stat'ed when it's looked up, so
+    a big archive costs one stat per remote file, not per local file.
+    `refresh` a file after writing or removing it."""
+
+    def __init__(self):
+        self._dirs = {}  # directory -> {name: LocalFile, or None until stat'ed}
+        self._lock = threading.Lock()
+
+    def exists(self, local_dir, name):
+        """Returns True if `local_dir` holds `name`, without a stat"""
+        return name in self._dir(local_dir)
+
+    def get(self, local_dir, name):
+        """Returns a `LocalFile` for `name` in `local_dir`, or None"""
+        files = self._dir(local_dir)
+        if name not in files:
+            return None
+        if files[name] is None:
+            self.refresh(os.path.join(local_dir, name))
+        return files.get(name)
+
+    def refresh(self, path):
+        """Stats `path` again after it's been written or removed"""
+        local_dir, name = os.path.split(path)
+        files = self._dir(local_dir or ".")
+        try:
+            stat = os.stat(path)
+        except OSError:
+            files.pop(name, None)
+        else:
+            files[name] = LocalFile(stat.st_size, stat.st_mtime)
 
+    def _dir(self, local_dir):
+        key = os.path.normpath(local_dir)
+        with self._lock:
+            if key not in self._dirs:
+                self._dirs[key] = dict.fromkeys(_scan_dir(local_dir))
+            return self._dirs[key]
 
-def _sync_remote_file(local_dir, remote_file_info):
-    local = Path(local_dir, remote_file_info.filename)
-    local_name = str(local)
-    remote_size = remote_file_info.size
-    if local.exists():
-        local_size = local.stat().st_size
-        if local.stat().st_size == remote_size:
-            logger.info(
-                "Skipping '{}': already exists locally".format(
-                local_name))
-        else:
-            logger.warning(
-                "Removing {}: local size {} != remote size {}".format(
-                local_name, local_size, remote_size))
+
+def _scan_dir(local_dir):
+    """Returns the names of the (complete) files in `local_dir`"""
+    try:
+        entries = scandir(local_dir)
+    except OSError:
+        return []  # not created yet
+    with entries:
+        return [entry.name for entry in entries
+                if entry.is_file() and not _is_partial(entry.name)]
+
+
+def _mirror_dir(local_dir, fileinfo, remote_root=None):
+    """Returns the directory below `local_dir` that mirrors the remote
+    directory of `fileinfo` below `remote_root`. Without a `remote_root`,
+    that's just `local_dir`."""
+    if remote_root is None:
+        return local_dir
+    remote_dir = PurePosixPath("/", fileinfo.directory)
+    relative = remote_dir.relative_to(PurePosixPath("/", remote_root))
+    return str(Path(local_dir, *relative.parts))
+
+
+def _sync_remote_file(local_dir, remote_file_info, url=URL, digest=None,
+                      fsync_policy=None):
+    """Copies a remote file to `local_dir` unless an identically sized
+    copy is already there. Returns True if the file was transferred.
+    A `checksum.Digest` is fed the file as it's written, and the finished
+    file is committed with `fsync_policy`."""
+    local_name = str(Path(local_dir, remote_file_info.filename))
+    try:
+        local_size = os.stat(local_name).st_size
+    except OSError:
+        local_size = None
+    if local_size == remote_file_info.size:
+        logger.info("Skipping '{}': already exists locally".format(
+                    local_name))
+        return False
+    _download_remote_file(local_dir, remote_file_info, url,
+                          replace=local_size is not None, digest=digest,
+                          fsync_policy=fsync_policy)
+    return True
+
+
+def _download_remote_file(local_dir, fileinfo, url=URL, replace=False,
+                          digest=None, fsync_policy=None):
+    """Copies a remote file to `local_dir`, first removing the local copy
+    if `replace` is set"""
+    local_name = str(Path(local_dir, fileinfo.filename))
+    if replace:
+        logger.warning("Removing {}: local size != remote size {}".format(
+                       local_name, fileinfo.size))
+        try:
             os.remove(local_name)
-            _stream_to_file(local_name, remote_file_info)
+        except FileNotFoundError:
+            pass
     else:
-        _stream_to_file(local_name, remote_file_info)
+        os.makedirs(local_dir, exist_ok=True)
+    _stream_to_file(local_name, fileinfo, url, digest=digest,
+                    fsync_policy=fsync_policy)
 
 
-def _stream_to_file(local_name, fileinfo):
+def _stream_to_file(local_name, fileinfo, url=URL,
+                    chunk_size=DEFAULT_CHUNK_SIZE, digest=None,
+                    fsync_policy=None):
     logger.info("Copying remote file {} to {}".format(
                 fileinfo.path, local_name))
-    streaming_file = _get_file(fileinfo)
-    _write_file_safely(local_name, fileinfo, streaming_file)
-
-
-def _get_file(fileinfo):
-    url = urljoin(URL, fileinfo.path)
-    logger.info("Requesting file: {}".format(url))
-    return requests.get(url, stream=True)
+    part_name = local_name + PART_SUFFIX
+    offset = _resume_offset(part_name, fileinfo)
+    if offset == fileinfo.size:
+        # download finished before we got the chance to rename it
+        if digest is not None:
+            digest.reset()
+            digest.update_from_file(part_name, offset)
+        _finish_part_file(part_name, local_name, fsync_policy)
+        return
+    # closing the response hands its connection back to `cgi.pool`
+    with _get_file(fileinfo, offset, url) as streaming_file:
+        _write_file_safely(local_name, fileinfo, streaming_file, offset,
+                           chunk_size, digest, fsync_policy)
+
+
+def _get_file(fileinfo, offset=0, url=URL):
+    headers = {}
+    if offset:
+        headers["Range"] = "bytes={:d}-".format(offset)
+    prepped_request = cgi.prep_file_get(fileinfo.path, url=url,
+                                        headers=headers)
+    if offset:
+        logger.info("Requesting file: {} (from byte {:d})".format(
+                    prepped_request.url, offset))
+    else:
+        logger.info("Requesting file: {}".format(prepped_request.url))
+    return cgi.send(prepped_request, stream=True)
 
 
-def _write_file_safely(local_path, fileinfo, response):
-    """attempts to stream a remote file into a local file object,
-    removes the local file if it's interrupted by any error"""
+def _write_file_safely(local_path, fileinfo, response, offset=0,
+                       chunk_size=DEFAULT_CHUNK_SIZE, digest=None,
+                       fsync_policy=None):
+    """attempts to stream a remote file into a local ".part" file,
+    which is renamed to `local_path` once complete. If interrupted by any
+    error, the partial file is kept so the download can be resumed later."""
+    part_path = local_path + PART_SUFFIX
     try:
-        _write_file(local_path, fileinfo, response)
+        _write_file(part_path, fileinfo, response, offset, chunk_size,
+                    digest=digest)
     except BaseException as e:
         logger.warning("{} interrupted writing {} -- "
-                       "cleaning up partial file".format(
+                       "keeping partial file for resume".format(
                        e.__class__.__name__, local_path))
-        os.remove(local_path)
         raise e
+    _finish_part_file(part_path, local_path, fsync_policy)
+
+
+def _write_file(part_path, fileinfo, response, offset=0,
+                chunk_size=DEFAULT_CHUNK_SIZE, readinto=True, digest=None):
+    """Writes the body of `response` into the ".part" file `part_path`
+    from byte `offset`.
 
+    The rest of the file is preallocated, and the body is read from the
+    socket into a reusable per-thread buffer, so a download allocates
+    next to nothing per chunk. Responses that can't be read that way
+    (or `readinto=False`) go through `response.iter_content`.
 
-def _write_file(local_path, fileinfo, response):
+    A `checksum.Digest` is fed the whole file: what's already in
+    `part_path` before `offset`, then each chunk as it's written.
+    A body that ends short of `fileinfo.size` raises an error."""
     start = time.time()
-    pbar_size = fileinfo.size / (5 * 10**5)
-    pbar = tqdm.tqdm(total=int(pbar_size))
-    if response.status_code == 200:
-        with open(local_path, "wb") as outfile:
-            for chunk in response.iter_content(5*10**5):
-                progress = len(chunk) / (5 * 10**5)
-                _update_pbar(pbar, progress)
-                outfile.write(chunk)
+    if response.status_code == 206 and _range_start(response) == offset:
+        flags = os.O_WRONLY | os.O_CREAT
+    elif response.status_code == 200:
+        if offset:
+            logger.warning("Server ignored range request for {}; "
+                           "downloading all of it".format(fileinfo.filename))
+        flags, offset = os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0
     else:
-        raise requests.RequestException("Expected status code 200")
+        raise requests.RequestException("Expected status code 200 or 206")
+    if digest is not None:
+        digest.reset()
+        if offset:
+            digest.update_from_file(part_path, offset)
+    body = _raw_body(response) if readinto else None
+    pbar_size = fileinfo.size / (5 * 10**5)
+    pbar = tqdm.tqdm(total=int(pbar_size), initial=int(offset / (5 * 10**5)))
+    progress = _progress_updater(pbar, 5 * 10**5)
+    throttled_progress = _throttled(progress)
+    done = offset
+    with trace.span("sync.write_file", file=fileinfo.filename) as span, \
+            open(os.open(part_path, flags, 0o666), "wb",
+                 buffering=0) as outfile:
+        outfile.seek(offset)
+        preallocated = _preallocate(outfile, part_path, fileinfo, offset)
+        try:
+            if body is not None:
+                buf, allocated = _read_buffer(chunk_size)
+                span.add(buffers=int(allocated))
+                view = memoryview(buf)
+                while True:
+                    n = body.readinto(view)
+                    if not n:
+                        break
+                    with trace.span("sync.disk_write"):
+                        _write_all(outfile, view[:n])
+                    if digest is not None:
+                        digest.update(view[:n])
+                    done += n
+                    span.add(bytes=n)
+                    throttled_progress(done - offset, fileinfo.size)
+                # the body was read behind urllib3's back, so it has to be
+                # told whether the connection can be reused; after a short
+                # read (readinto gives 0 on early EOF) it can't be
+                if done == fileinfo.size:
+                    response.raw.release_conn()
+                else:
+                    response.close()
+            else:
+                for chunk in response.iter_content(chunk_size):
+                    with trace.span("sync.disk_write"):
+                        outfile.write(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+                    done += len(chunk)
+                    span.add(bytes=len(chunk), buffers=1)
+                    throttled_progress(done - offset, fileinfo.size)
+        finally:
+            if preallocated:
+                _release_preallocation(outfile, part_path, fileinfo, done)
+    progress(done - offset, fileinfo.size)
     pbar.close()
+    if done != fileinfo.size:
+        raise requests.RequestException(
+            "Got {:d} of {:d} bytes of {}".format(done, fileinfo.size,
+                                                  fileinfo.filename))
     duration = time.time() - start
+    nbytes = done - offset
     logger.info("Wrote {} in {:0.2f} s ({:0.2f} MB, {:0.2f} MB/s)".format(
-                fileinfo.filename, duration, fileinfo.size / 10 ** 6,
-                fileinfo.size / (duration * 10 ** 6)))
+                fileinfo.filename, duration, nbytes / 10 ** 6,
+                nbytes / (max(duration, 1e-6) * 10 ** 6)))
+
+
+def _raw_body(response):
+    """Returns the `http.client.HTTPResponse` underneath a streamed
+    `requests` response, which can `readinto` a buffer without allocating
+    a new bytes object per chunk. Returns None if the body has to be
+    decoded or the response didn't come from urllib3."""
+    body = getattr(getattr(response, "raw", None), "_fp", None)
+    if not hasattr(body, "readinto"):
+        return None
+    if response.headers.get("Content-Encoding", "identity") != "identity":
+        return None
+    return body
+
+
+_buffers = threading.local()
+
+
+def _read_buffer(size):
+    """Returns this thread's reusable read buffer of `size` bytes and
+    whether it had to be allocated"""
+    buf = getattr(_buffers, "buffer", None)
+    if buf is not None and len(buf) == size:
+        return buf, False
+    _buffers.buffer = buf = bytearray(size)
+    return buf, True
+
+
+def _write_all(outfile, view):
+    """Writes all of `view` to an unbuffered file, which may take
+    more than one write"""
+    while view:
+        view = view[outfile.write(view):]
+
+
+def _preallocate(outfile, part_path, fileinfo, offset):
+    """Reserves disk space for the rest of a download, so a large file
+    isn't fragmented and a full disk is noticed up front. Returns True
+    if the space was reserved.
+
+    Preallocating makes the part file as big as the finished download,
+    so its size no longer says how much was written. The sidecar is
+    marked while that's the case; if the process dies before
+    `_release_preallocation`, `_resume_offset` sees the mark and starts
+    over rather than trusting the size."""
+    if not hasattr(os, "posix_fallocate") or fileinfo.size <= offset:
+        return False
+    part_info_name = _part_info_path(part_path)
+    _write_part_info(part_info_name, dict(_part_info(fileinfo),
+                                          preallocated=True))
+    try:
+        os.posix_fallocate(outfile.fileno(), offset, fileinfo.size - offset)
+    except OSError as e:
+        logger.debug("Can't preallocate {}: {}".format(part_path, e))
+        _write_part_info(part_info_name, _part_info(fileinfo))
+        return False
+    return True
+
+
+def _release_preallocation(outfile, part_path, fileinfo, done):
+    """Cuts a preallocated part file back to the `done` bytes actually
+    written and unmarks its sidecar, so the download can be resumed"""
+    if done < fileinfo.size:
+        os.ftruncate(outfile.fileno(), done)
+    _write_part_info(_part_info_path(part_path), _part_info(fileinfo))
+
+
+def _throttled(update, interval=PROGRESS_INTERVAL):
+    """Wraps a progress callback so it runs at most once every
+    `interval` seconds"""
+    last = None
+
+    def throttled(*args):
+        nonlocal last
+        now = time.monotonic()
+        if last is None or now - last >= interval:
+            last = now
+            update(*args)
+    return throttled
+
+
+def _range_start(response):
+    """Returns the first byte position of a 206 response's Content-Range"""
+    content_range = response.headers.get("Content-Range", "")
+    try:
+        unit, byte_range = content_range.split(" ", 1)
+        return int(byte_range.split("-", 1)[0])
+    except ValueError:
+        return None
+
+
+##############################################
+# Partial (resumable) download bookkeeping
+
+def _resume_offset(part_name, fileinfo):
+    """Returns the number of bytes of `fileinfo` already in `part_name`.
+    A partial file is only trusted if its sidecar records the same remote
+    size and FAT timestamp; otherwise it's discarded and 0 is returned."""
+    part_info_name = _part_info_path(part_name)
+    expected = _part_info(fileinfo)
+    try:
+        with open(part_info_name) as info_file:
+            recorded = json.load(info_file)
+        part_size = os.stat(part_name).st_size
+    except (OSError, ValueError):
+        recorded, part_size = None, 0
+    if recorded == expected and part_size <= fileinfo.size:
+        if part_size:
+            logger.info("Resuming {} at {:d} of {:d} bytes".format(
+                        part_name, part_size, fileinfo.size))
+        return part_size
+    if os.path.exists(part_name):
+        logger.warning("Discarding stale partial file {}".format(part_name))
+        os.remove(part_name)
+    _write_part_info(part_info_name, expected)
+    return 0
+
+
+def _finish_part_file(part_name, local_name, fsync_policy=None):
+    (fsync_policy or _EACH_FILE).commit(part_name, local_name)
+
+
+def _part_info(fileinfo):
+    datetime = getattr(fileinfo, "datetime", None)
+    fat_time = None
+    if datetime is not None:
+        fat_time = fattime.encode(datetime.float_timestamp)
+    return {"path": fileinfo.path, "size": fileinfo.size,
+            "fat_time": fat_time}
+
+
+def _write_part_info(part_info_name, part_info):
+    with open(part_info_name, "w") as info_file:
+        json.dump(part_info, info_file)
+
+
+def _part_info_path(part_name):
+    assert part_name.endswith(PART_SUFFIX), \
+        "Not a {} file: {}".format(PART_SUFFIX, part_name)
+    return part_name[:-len(PART_SUFFIX)] + PART_INFO_SUFFIX
+
+
+def _is_partial(name):
+    return name.endswith(PART_SUFFIX) or name.endswith(PART_INFO_SUFFIX)
 
 
 def _update_pbar(pbar, val):
@@ -254,67 +1115,360 @@ def _update_pbar(pbar, val):
                      e.__class__.__name__, e))
 
 
+##############################################
+# Durability of finished downloads
+
+class FsyncPolicy:
+    """Decides when finished downloads are flushed to disk.
+
+    Downloads are written to a ".part" file that's renamed once complete,
+    so other programs never see a half-written file under its real name.
+    That holds if tfatool crashes, but after a power cut or an OS crash
+    a renamed file can still turn up empty unless its data was fsynced
+    before the rename, and the rename itself can be lost unless its
+    directory was fsynced after.
+
+    * "file": each file is fsynced, renamed, then its directory fsynced.
+      Nothing is lost, at the cost of two fsyncs per file.
+    * "batch": finished files keep their ".part" names until `files` of
+      them are done, or `seconds` after the first. Then each is fsynced,
+      they're all renamed, and each of their directories is fsynced once.
+      The download functions also `flush` whenever they run out of files.
+      A crash can only lose the renames of the last batch, whose ".part"
+      files are picked up again by the next download.
+    * "off": files are renamed right away and the OS writes them back
+      whenever it likes.
+
+    Pass one as `fsync_policy` to the download functions, `Pipeline`,
+    `TwoWaySync`, `Monitor` or `Supervisor`. Each of them makes a
+    "batch" policy of its own by default:
+
+    >>> sync.down_by_all(remote_dir="/DCIM", fsync_policy=FsyncPolicy("file"))
+    """
+
+    modes = ("file", "batch", "off")
+
+    def __init__(self, mode="batch", files=DEFAULT_FSYNC_FILES,
+                 seconds=DEFAULT_FSYNC_SECONDS):
+        if mode not in self.modes:
+            raise ValueError("Unknown fsync mode {!r} (choose from "
+                             "{})".format(mode, ", ".join(self.modes)))
+        self.mode = mode
+        self.files = files
+        self.seconds = seconds
+        self.fsyncs = 0
+        self._pending = []  # (part name, local name) of finished files
+        self._first = None  # when the first of them was finished
+        self._lock = threading.Lock()
+
+    def commit(self, part_name, local_name):
+        """Renames a finished ".part" file to `local_name`, right away or
+        with the rest of its batch"""
+        if self.mode == "off":
+            _rename_part_file(part_name, local_name)
+            return
+        if self.mode == "file":
+            self._fsync(part_name)
+            _rename_part_file(part_name, local_name)
+            self._fsync(os.path.dirname(local_name) or ".")
+            return
+        with self._lock:
+            if (part_name, local_name) not in self._pending:
+                self._pending.append((part_name, local_name))
+            if self._first is None:
+                self._first = time.monotonic()
+            due = (len(self._pending) >= self.files or
+                   time.monotonic() - self._first >= self.seconds)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Fsyncs and renames the files finished since the last flush,
+        then fsyncs their directories"""
+        with self._lock:
+            pending, self._pending, self._first = self._pending, [], None
+        if not pending:
+            return
+        dirs = []
+        with trace.span("sync.fsync", files=len(pending)) as span:
+            for part_name, _ in pending:
+                self._fsync(part_name)
+            for part_name, local_name in pending:
+                try:
+                    _rename_part_file(part_name, local_name)
+                except OSError as e:
+                    logger.warning("Can't rename {}: {}".format(part_name, e))
+                    continue
+                directory = os.path.dirname(local_name) or "."
+                if directory not in dirs:
+                    dirs.append(directory)
+            for directory in dirs:
+                self._fsync(directory)
+            span.set(dirs=len(dirs))
+        logger.debug("Flushed {:d} files in {:d} directories".format(
+                     len(pending), len(dirs)))
+
+    def _fsync(self, path):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return  # moved or deleted since
+        try:
+            os.fsync(fd)
+            with self._lock:
+                self.fsyncs += 1
+        except OSError as e:
+            # e.g. directories can't be fsynced on Windows
+            logger.debug("Can't fsync {}: {}".format(path, e))
+        finally:
+            os.close(fd)
+
+
+# Used by the low-level download functions when they're called without
+# a policy: nothing is left pending
+_EACH_FILE = FsyncPolicy("file")
+
+
+def _rename_part_file(part_name, local_name):
+    os.replace(part_name, local_name)
+    try:
+        os.remove(_part_info_path(part_name))
+    except OSError:
+        pass
+
+
+def _stat_finished(local_name):
+    """Stats a finished download, which may still be waiting under its
+    ".part" name for its `FsyncPolicy` batch to be flushed"""
+    for name in (local_name, local_name + PART_SUFFIX, local_name):
+        try:
+            return os.stat(name)
+        except FileNotFoundError:
+            continue  # not renamed yet, or renamed in between
+    raise FileNotFoundError(local_name)
+
+
+@contextmanager
+def _flushing(fsync_policy):
+    """Flushes `fsync_policy` when the block is done, however it ends"""
+    try:
+        yield
+    finally:
+        fsync_policy.flush()
+
+
 ###########################################
 # Local and remote file watcher-generators
 
-def watch_local_files(*filters, local_dir="."):
+def watch_local_files(*filters, local_dir=".", use_inotify=None,
+                      scheduler=None):
+    """Generates (new files, all files) set pairs for `local_dir`.
+    On Linux, inotify is used and files only count as new once they've been
+    closed after writing or moved into `local_dir`. Elsewhere (or with
+    `use_inotify=False`) the directory is rescanned on every iteration.
+    Without a `poll.PollScheduler`, each iteration checks once and returns
+    immediately; with one, iterations are paced by the scheduler."""
+    if use_inotify is None:
+        use_inotify = inotify.is_available()
+    if use_inotify:
+        return _watch_local_events(*filters, local_dir=local_dir,
+                                   scheduler=scheduler)
+    return _poll_local_files(*filters, local_dir=local_dir,
+                             scheduler=scheduler)
+
+
+def _poll_local_files(*filters, local_dir=".", scheduler=None):
     list_local = partial(list_local_files, *filters, local_dir=local_dir)
     old_files = new_files = set(list_local())
     while True:
         yield new_files - old_files, new_files
         old_files = new_files
-        new_files = set(list_local())
+        if scheduler:
+            scheduler.wait()
+        with trace.span("watch.local_poll"):
+            new_files = set(list_local())
+        if scheduler:
+            scheduler.record(new_files != old_files)
 
 
-def watch_remote_files(*filters, remote_dir="."):
-    command.memory_changed()  # clear change status to start
-    list_remote = partial(command.list_files,
-                          *filters, remote_dir=remote_dir)
+def _watch_local_events(*filters, local_dir=".", scheduler=None):
+    # the watcher is opened here, in the generator, rather than by the
+    # caller, so a generator that's never started can't leak its fd
+    try:
+        watcher = inotify.Watcher(local_dir)
+    except OSError as e:
+        logger.warning("Can't watch {} with inotify ({}); "
+                       "polling instead".format(local_dir, e))
+        yield from _poll_local_files(*filters, local_dir=local_dir,
+                                     scheduler=scheduler)
+        return
+    name_predicates, _, _ = split_filters(filters)
+    if scheduler:
+        scheduler.add_wake_callback(watcher.wake)
+    try:
+        files = {f.filename: f for f in
+                 list_local_files(*filters, local_dir=local_dir)}
+        new_files = set()
+        while True:
+            yield new_files, set(files.values())
+            new_files = set()
+            timeout = scheduler.interval if scheduler else 0
+            for mask, name in watcher.read_events(timeout):
+                if mask & inotify.IN_Q_OVERFLOW:
+                    logger.warning("inotify queue overflowed; "
+                                   "rescanning {}".format(local_dir))
+                    old_files = set(files.values())
+                    with trace.span("watch.local_rescan"):
+                        files = {f.filename: f for f in list_local_files(
+                                 *filters, local_dir=local_dir)}
+                    new_files = set(files.values()) - old_files
+                elif (not name or mask & inotify.IN_ISDIR or
+                      _is_partial(name)):
+                    continue  # e.g. IN_IGNORED, which names no file
+                elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                    old = files.pop(name, None)
+                    new_files.discard(old)
+                elif all(pred(name) for pred in name_predicates):
+                    try:
+                        stat = os.stat(os.path.join(local_dir, name))
+                    except OSError:
+                        continue  # already gone again
+                    info = _local_file_info(local_dir, name, stat)
+                    if all(filt(info) for filt in filters):
+                        new_files.discard(files.get(name))
+                        files[name] = info
+                        new_files.add(info)
+            if scheduler:
+                scheduler.record(bool(new_files))
+    finally:
+        if scheduler:
+            scheduler.remove_wake_callback(watcher.wake)
+        watcher.close()
+
+
+def watch_remote_files(*filters, remote_dir=".", url=URL, index=None,
+                       scheduler=None, recursive=False):
+    """Generates (new files, all files) set pairs for FlashAir's `remote_dir`.
+    Each iteration asks FlashAir whether its memory changed and only lists
+    `remote_dir` again if it did. Without a `poll.PollScheduler` it
+    returns immediately; with one, iterations are paced by the scheduler.
+    With `recursive`, files in subdirectories of `remote_dir` are
+    watched too."""
+    if index is None:
+        memory_changed = partial(command.memory_changed, url)
+    else:
+        memory_changed = _index_changes(index, url)
+    if recursive:
+        list_remote = partial(command.walk_remote, *filters,
+                              remote_dir=remote_dir, url=url, index=index)
+    elif index is None:
+        list_remote = partial(command.list_files,
+                              *filters, remote_dir=remote_dir, url=url)
+    else:
+        list_remote = partial(index.list_files, *filters, remote_dir=remote_dir,
+                              url=url, revalidate=False)
+    memory_changed()  # clear change status to start
     old_files = new_files = set(list_remote())
     while True:
         yield new_files - old_files, new_files
         old_files = new_files
-        if command.memory_changed():
-            new_files = set(list_remote())
+        if scheduler:
+            scheduler.wait()
+        with trace.span("watch.remote_poll") as span:
+            changed = memory_changed()
+            if changed:
+                with trace.span("watch.remote_list"):
+                    new_files = set(list_remote())
+            span.set(changed=bool(changed))
+        if scheduler:
+            scheduler.record(changed)
+
+
+def _index_changes(index, url):
+    """Returns a function that says whether FlashAir at `url` changed
+    since it was last called. The card's change flag is shared through
+    `index`, so other users of the index can't take a change from it."""
+    seen = [index.generation(url)]
+
+    def changed():
+        index.revalidate(url)
+        generation, last = index.generation(url), seen[0]
+        seen[0] = generation
+        return generation != last
+    return changed
 
 
 #####################################################
 # Synchronize ONCE in the UP direction (to FlashAir)
 
-def up_by_all(*filters, local_dir=".", remote_dir=DEFAULT_REMOTE_DIR, **_):
+def up_by_all(*filters, local_dir=".", remote_dir=DEFAULT_REMOTE_DIR,
+              url=URL, index=None, journal=None, **_):
     files = list_local_files(*filters, local_dir=local_dir)
-    up_by_files(list(files), remote_dir=remote_dir)
+    up_by_files(list(files), remote_dir=remote_dir, url=url, index=index,
+                journal=journal)
 
 
-def up_by_files(to_sync, remote_dir=DEFAULT_REMOTE_DIR, remote_files=None):
-    """Sync a given list of local files to `remote_dir` dir"""
+def up_by_files(to_sync, remote_dir=DEFAULT_REMOTE_DIR, remote_files=None,
+                url=URL, index=None, journal=None):
+    """Sync a given list of local files to `remote_dir` dir.
+    With a `journal.Journal`, each file synced is recorded (along with
+    its checksums, if the journal keeps them)."""
     if remote_files is None:
-        remote_files = command.map_files_raw(remote_dir=remote_dir)
-    for local_file in to_sync:
-        _sync_local_file(local_file, remote_dir, remote_files)
-
-
-def up_by_time(*filters, local_dir=".", remote_dir=DEFAULT_REMOTE_DIR, count=1):
+        remote_files = (index or command).map_files_raw(remote_dir=remote_dir,
+                                                        url=url)
+    if journal is not None:
+        card = journal.card_id(url)
+    try:
+        with upload.UploadSession(remote_dir, url=url) as session:
+            for local_file in to_sync:
+                digest = journal.digest() if journal is not None else None
+                copied = _sync_local_file(local_file, remote_files, session,
+                                          digest)
+                if journal is None:
+                    continue
+                journal.record(card, Direction.up, local_file,
+                               local_file.directory)
+                if copied and digest is not None:
+                    remote_path = str(PurePosixPath(remote_dir,
+                                                    local_file.filename))
+                    journal.record_checksum(card, Direction.up,
+                                            local_file.path, remote_path,
+                                            digest)
+    finally:
+        if index is not None and session.is_dirty:
+            index.invalidate(session.url, remote_dir)
+
+
+def up_by_time(*filters, local_dir=".", remote_dir=DEFAULT_REMOTE_DIR, url=URL,
+               count=1, index=None, journal=None):
     """Sync most recent file by date, time attribues"""
-    remote_files = command.map_files_raw(remote_dir=remote_dir)
+    remote_files = (index or command).map_files_raw(remote_dir=remote_dir,
+                                                    url=url)
     local_files = list_local_files(*filters, local_dir=local_dir)
     most_recent = sorted(local_files, key=lambda f: f.datetime)
     to_sync = most_recent[-count:]
     _notify_sync(Direction.up, to_sync)
-    up_by_files(to_sync[::-1], remote_dir, remote_files)
+    up_by_files(to_sync[::-1], remote_dir, remote_files, url=url,
+                index=index, journal=journal)
 
 
-def up_by_name(*filters, local_dir=".", remote_dir=DEFAULT_REMOTE_DIR, count=1):
+def up_by_name(*filters, local_dir=".", remote_dir=DEFAULT_REMOTE_DIR, url=URL,
+               count=1, index=None, journal=None):
     """Sync files whose filename attribute is highest in alphanumeric order"""
-    remote_files = command.map_files_raw(remote_dir=remote_dir)
+    remote_files = (index or command).map_files_raw(remote_dir=remote_dir,
+                                                    url=url)
     local_files = list_local_files(*filters, local_dir=local_dir)
     greatest = sorted(local_files, key=lambda f: f.filename)
     to_sync = greatest[-count:]
     _notify_sync(Direction.up, to_sync)
-    up_by_files(to_sync[::-1], remote_dir, remote_files)
+    up_by_files(to_sync[::-1], remote_dir, remote_files, url=url,
+                index=index, journal=journal)
 
 
-def _sync_local_file(local_file_info, remote_dir, remote_files):
+def _sync_local_file(local_file_info, remote_files, session, digest=None):
+    """Uploads a local file unless an identically sized copy is already
+    on FlashAir. Returns True if the file was transferred.
+    A `checksum.Digest` is fed the file as it's sent."""
     local_name = local_file_info.filename
     local_size = local_file_info.size
     if local_name in remote_files:
@@ -324,52 +1478,77 @@ def _sync_local_file(local_file_info, remote_dir, remote_files):
             logger.info(
                 "Skipping '{}' already exists on SD card".format(
                 local_name))
+            return False
         else:
             logger.warning(
                 "Removing remote file {}: "
                 "local size {} != remote size {}".format(
                 local_name, local_size, remote_size))
-            upload.delete_file(remote_file_info.path)
-            _stream_from_file(local_file_info, remote_dir)
+            session.delete(remote_file_info.path)
+            _stream_from_file(local_file_info, session, digest)
     else:
-        _stream_from_file(local_file_info, remote_dir)
+        _stream_from_file(local_file_info, session, digest)
+    return True
 
 
-def _stream_from_file(fileinfo, remote_dir):
+def _stream_from_file(fileinfo, session, digest=None):
     logger.info("Uploading local file {} to {}".format(
-                fileinfo.path, remote_dir))
-    _upload_file_safely(fileinfo, remote_dir)
+                fileinfo.path, session.remote_dir))
+    _upload_file_safely(fileinfo, session, digest)
 
 
-def _upload_file_safely(fileinfo, remote_dir):
+def _upload_file_safely(fileinfo, session, digest=None):
     """attempts to upload a local file to FlashAir,
     tries to remove the remote file if interrupted by any error"""
+    pbar = tqdm.tqdm(total=int(fileinfo.size / (5 * 10**5)))
+    progress = _progress_updater(pbar, 5 * 10**5)
     try:
-        upload.upload_file(fileinfo.path, remote_dir=remote_dir)
+        session.upload(fileinfo.path, progress=progress, digest=digest)
     except BaseException as e:
         logger.warning("{} interrupted writing {} -- "
                        "cleaning up partial remote file".format(
                        e.__class__.__name__, fileinfo.path))
-        upload.delete_file(fileinfo.path)
+        remote_path = str(PurePosixPath(session.remote_dir, fileinfo.filename))
+        session.delete(remote_path)
         raise e
+    finally:
+        pbar.close()
+
+
+def _progress_updater(pbar, units):
+    """Makes a (bytes_done, bytes_total) callback that advances `pbar`
+    by one step every `units` bytes"""
+    reported = 0
+
+    def update(done, _):
+        nonlocal reported
+        steps = int(done / units) - reported
+        if steps > 0:
+            reported += steps
+            _update_pbar(pbar, steps)
+    return update
 
 
 def list_local_files(*filters, local_dir="."):
     all_entries = scandir(local_dir)
-    file_entries = (e for e in all_entries if e.is_file())
+    file_entries = (e for e in all_entries
+                    if e.is_file() and not _is_partial(e.name))
     for entry in file_entries:
-        stat = entry.stat()
-        size = stat.st_size
-        datetime = arrow.get(stat.st_mtime)
-        path = str(Path(local_dir, entry.name))
-        info = SimpleFileInfo(local_dir, entry.name, path, size, datetime)
+        info = _local_file_info(local_dir, entry.name, entry.stat())
         if all(filt(info) for filt in filters):
             yield info
 
 
+def _local_file_info(local_dir, name, stat):
+    path = str(Path(local_dir, name))
+    datetime = arrow.get(stat.st_mtime)
+    return SimpleFileInfo(local_dir, name, path, stat.st_size, datetime)
+
+
 def list_local_files_raw(*filters, local_dir="."):
     all_entries = scandir(local_dir)
     all_files = (e for e in all_entries if e.is_file() and
+                 not _is_partial(e.name) and
                  all(filt(e) for filt in filters))
     for entry in all_files:
         path = str(Path(local_dir, entry.name))
@@ -383,6 +1562,14 @@ def _notify_sync(direction, files):
         "\n".join("  " + f.filename for f in files)))
 
 
+def _notify_report(direction, report):
+    logger.info("{:s} report: {:d} synced, {:d} skipped, {:d} failed "
+                "({:0.2f} MB in {:0.2f} s, {:0.2f} MB/s)".format(
+                direction, len(report.synced), len(report.skipped),
+                len(report.failed), report.nbytes / 10**6,
+                report.duration, report.rate))
+
+
 def _notify_sync_ready(num_old_files, from_dir, to_dir):
     logger.info("Ready to sync new files from {} to {} "
                 "({:d} existing files ignored)".format(
@@ -0,0 +1,151 @@
+"""Opt-in timing of tfatool's HTTP requests, transfers and polls.
+
+Tracing is off by default. While it's off, `span` returns a shared no-op
+object, so the instrumented code pays for little more than a function call.
+
+>>> tracer = trace.enable()
+>>> sync.down_by_all(local_dir="photos")
+>>> trace.disable()
+>>> tracer.save("trace.json")  # open in chrome://tracing or Perfetto
+"""
+
+import json
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+
+_tracer = None
+
+
+def enable(tracer=None):
+    """Starts recording spans into `tracer` (a new `Tracer` by default)"""
+    global _tracer
+    _tracer = tracer or Tracer()
+    return _tracer
+
+
+def disable():
+    """Stops recording spans. Returns the tracer that was recording."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+def active():
+    return _tracer
+
+
+def span(name, **args):
+    """Times a `with` block as a span called `name`. Keyword arguments
+    are attached to the span; counts can be added to it while it's open
+    with `add`, e.g. `span.add(bytes=len(chunk))`."""
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return _Span(tracer, name, args)
+
+
+class Tracer:
+    """Collects finished spans as Chrome trace events"""
+
+    def __init__(self):
+        self.events = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record(self, name, start, duration, args):
+        event = {
+            "name": name,
+            "cat": name.partition(".")[0],
+            "ph": "X",
+            "ts": (start - self._start) * 10**6,
+            "dur": duration * 10**6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def chrome_trace(self):
+        """Returns the spans in Chrome's trace-event format"""
+        with self._lock:
+            events = list(self.events)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save(self, path):
+        with open(path, "w") as outfile:
+            json.dump(self.chrome_trace(), outfile)
+
+    def summary(self):
+        """Returns one row per span name: (name, count, total s, mean ms,
+        max ms, MB, requests), ordered by total time"""
+        totals = OrderedDict()
+        with self._lock:
+            events = list(self.events)
+        for event in events:
+            count, total, longest, nbytes, requests = totals.get(
+                event["name"], (0, 0, 0, 0, 0))
+            duration = event["dur"] / 10**6
+            totals[event["name"]] = (
+                count + 1, total + duration, max(longest, duration),
+                nbytes + event["args"].get("bytes", 0),
+                requests + event["args"].get("requests", 0))
+        rows = [(name, count, total, total / count * 1000, longest * 1000,
+                 nbytes / 10**6, requests)
+                for name, (count, total, longest, nbytes, requests)
+                in totals.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+
+SUMMARY_FIELDS = ["span", "count", "total s", "mean ms", "max ms", "MB",
+                  "requests"]
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.args[key] = self.args.get(key, 0) + value
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *_):
+        duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.record(self.name, self.start, duration, self.args)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def add(self, **counts):
+        pass
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
@@ -1,21 +1,68 @@
-import math
+import io
 import os
-import arrow
+import uuid
 
 from functools import partial
 
-from . import cgi
+from . import cgi, fattime, trace
 from .info import DEFAULT_REMOTE_DIR, DEFAULT_MASTERCODE, URL
 from .info import WriteProtectMode, Upload, ResponseCode
 from requests import RequestException
 
 
 def upload_file(local_path: str, url=URL, remote_dir=DEFAULT_REMOTE_DIR):
-    set_write_protect(WriteProtectMode.on, url=url)
-    set_upload_dir(remote_dir, url=url)
-    set_creation_time(local_path, url=url)
-    post_file(local_path, url=url)
-    set_write_protect(WriteProtectMode.off, url=url)
+    with UploadSession(remote_dir, url=url) as session:
+        session.upload(local_path)
+
+
+class UploadSession:
+    """Uploads a batch of files to one remote directory. Write protection
+    and the upload directory are set once, just before the first upload,
+    so each file only costs an FTIME request and the POST itself.
+    Write protection is switched off again when the session is closed.
+    `is_dirty` records whether the session has written to the card.
+
+    >>> with UploadSession("/DCIM") as session:
+    ...     for path in paths:
+    ...         session.upload(path)
+    """
+
+    def __init__(self, remote_dir=DEFAULT_REMOTE_DIR, url=URL):
+        self.remote_dir = remote_dir
+        self.url = url
+        self.is_open = False
+        self.is_dirty = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        set_write_protect(WriteProtectMode.on, url=self.url)
+        set_upload_dir(self.remote_dir, url=self.url)
+        self.is_open = True
+
+    def upload(self, local_path: str, progress=None, digest=None):
+        with trace.span("upload.upload_file", file=local_path) as span:
+            if not self.is_open:
+                self.open()
+            set_creation_time(local_path, url=self.url)
+            self.is_dirty = True
+            response = post_file(local_path, url=self.url, progress=progress,
+                                 digest=digest)
+            span.add(bytes=os.path.getsize(local_path))
+        return response
+
+    def delete(self, remote_file: str):
+        self.is_dirty = True
+        return delete_file(remote_file, url=self.url)
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            set_write_protect(WriteProtectMode.off, url=self.url)
 
 
 def set_write_protect(mode: WriteProtectMode, url=URL):
@@ -34,7 +81,7 @@ def set_upload_dir(remote_dir: str, url=URL):
 
 def set_creation_time(local_path: str, url=URL):
     mtime = os.stat(local_path).st_mtime
-    fat_time = _encode_time(mtime)
+    fat_time = fattime.encode(mtime)
     encoded_time = _str_encode_time(fat_time)
     response = get(url=url, **{Upload.creation_time: encoded_time})
     if response.text != ResponseCode.success:
@@ -42,14 +89,85 @@ def set_creation_time(local_path: str, url=URL):
     return response
 
 
-def post_file(local_path: str, url=URL):
-    files = {local_path: open(local_path, "rb")}
-    response = post(url=url, req_kwargs=dict(files=files))
+def post_file(local_path: str, url=URL, progress=None, digest=None):
+    """POSTs a local file to upload.cgi. The multipart body is streamed
+    from disk, so memory use doesn't grow with the size of the file.
+    `progress` is an optional callable taking (bytes_sent, total_bytes).
+    An optional `checksum.Digest` is fed the file as it's sent."""
+    with MultipartFile(local_path, progress=progress, digest=digest) as body:
+        headers = {"Content-Type": body.content_type}
+        response = post(url=url, req_kwargs=dict(data=body, headers=headers))
     if response.status_code != 200:
         raise UploadError("Failed to post file", response)
     return response
 
 
+class MultipartFile:
+    """A file-like multipart/form-data body holding a single file.
+    The file is read in chunks as the request is sent and the total
+    length is known up front, so the request goes out with a
+    Content-Length header instead of chunked transfer encoding."""
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, local_path: str, progress=None, digest=None):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary={}".format(
+            self.boundary)
+        filename = os.path.basename(local_path).replace('"', "%22")
+        head = ('--{0}\r\nContent-Disposition: form-data; name="file"; '
+                'filename="{1}"\r\n'
+                'Content-Type: application/octet-stream\r\n\r\n').format(
+                self.boundary, filename).encode("utf-8")
+        tail = "\r\n--{}--\r\n".format(self.boundary).encode("ascii")
+        self._file = open(local_path, "rb")
+        self.file_size = os.fstat(self._file.fileno()).st_size
+        self._parts = [io.BytesIO(head), self._file, io.BytesIO(tail)]
+        self._length = len(head) + self.file_size + len(tail)
+        self._progress = progress
+        self._digest = digest
+        if digest is not None:
+            digest.reset()
+        self.sent = 0
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        chunk = self.read(self.chunk_size)
+        while chunk:
+            yield chunk
+            chunk = self.read(self.chunk_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length - self.sent
+        chunks = []
+        while size > 0 and self._parts:
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            if self._digest is not None and self._parts[0] is self._file:
+                self._digest.update(chunk)
+            chunks.append(chunk)
+            size -= len(chunk)
+        data = b"".join(chunks) if len(chunks) != 1 else chunks[0]
+        self.sent += len(data)
+        if self._progress and data:
+            self._progress(self.sent, self._length)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
 def delete_file(remote_file: str, url=URL):
     response = get(url=url, **{Upload.delete: remote_file})
     if response.status_code != 200:
@@ -81,16 +199,6 @@ def _str_encode_time(encoded_time: int):
     return "{0:#0{1}x}".format(encoded_time, 10)
 
 
-def _encode_time(mtime: float):
-    """Encode a mtime float as a 32-bit FAT time"""
-    dt = arrow.get(mtime)
-    dt = dt.to("local")
-    date_val = ((dt.year - 1980) << 9) | (dt.month << 5) | dt.day
-    secs = dt.second + dt.microsecond / 10**6
-    time_val = (dt.hour << 11) | (dt.minute << 5) | math.floor(secs / 2)
-    return (date_val << 16) | time_val
-
-
 class UploadError(RequestException):
     def __init__(self, msg, response):
         self.msg = msg
@@ -0,0 +1,72 @@
+import threading
+
+
+class WorkQueue:
+    """Threads that find work and threads that do it, sharing a queue.
+
+    `sync.Pipeline` and `supervisor.Supervisor` both run this way.
+    Subclasses list their threads in `_thread_targets`, pop queued work
+    in `_pop` (called with `_work` held) and name the `PollScheduler` of
+    each polling thread in `_schedulers`, so `stop` can wake them.
+    """
+
+    def __init__(self):
+        self.running = threading.Event()
+        self._work = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        assert not self._threads, "Already started"
+        self.running.set()
+        for name, target, args in self._thread_targets():
+            self._threads.append(threading.Thread(target=target, args=args,
+                                                  name=name))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stops polling. Transfers in progress are finished first,
+        but queued files are left for the next run."""
+        self.running.clear()
+        for scheduler in self._schedulers():
+            scheduler.wake()
+        with self._work:
+            self._work.notify_all()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        self.join()
+
+    def _take(self, wait=True):
+        """Takes the next piece of work. Returns None once stopped,
+        or if nothing's queued and `wait` is False."""
+        with self._work:
+            while self.running.is_set():
+                item = self._pop()
+                if item is not None:
+                    self._work.notify_all()  # a poller may be waiting for room
+                    return item
+                if not wait:
+                    return None
+                self._work.wait()
+            return None
+
+    def _thread_targets(self):
+        """Yields (name, target, args) for each thread to start"""
+        raise NotImplementedError
+
+    def _pop(self):
+        """Returns the next piece of work and marks it active, or None"""
+        raise NotImplementedError
+
+    def _schedulers(self):
+        return []